@@ -4,7 +4,7 @@ from dataclasses import dataclass, astuple
 from typing import Tuple, cast
 from unittest import TestCase
 
-import mercantile as T
+from . import tile_util as T  # mercantile-like, vectorized
 
 
 llclapier   = T.LngLat(7.42 , 44.115)
@@ -86,14 +86,12 @@ class BBox:
     def snap_to_xyz(self: 'BBox', z:int, mode='~'):
         """A bit like `mercantile.bounding_tile` but with custom z"""
         assert mode in ('~', '+', '-')  # closest / enlarge / crop
-        import mercantile as T
         w, s, e, n = self.w, self.s,  self.e, self.n
-        tnw_big = T.tile(w, n, z)  # NW origin (== OSM web... ; != TMS MBTiles)
-        tse_sml = T.tile(e, s, z)
-        nw_sml = T.ul(T.Tile(tnw_big.x+1, tnw_big.y+1, z)) # >T<ile
-        nw_big = T.ul(tnw_big)
-        se_sml = T.ul(tse_sml)
-        se_big = T.ul(T.Tile(tse_sml.x+1, tse_sml.y+1, z)) # >T<ile
+        xw, yn = T.xyz_tiles(w, n, z)  # NW origin (== OSM web... ; != TMS MBTiles)
+        xe, ys = T.xyz_tiles(e, s, z)
+        corner = lambda x, y: T.LngLat(*map(float, T.ul(x, y, z)))
+        nw_sml, nw_big = corner(xw + 1, yn + 1), corner(xw, yn)
+        se_sml, se_big = corner(xe, ys), corner(xe + 1, ys + 1)
         if mode == '+':  # biggest (enlarge)
             return BBox(w=nw_big.lng, s=se_big.lat, e=se_big.lng, n=nw_big.lat)
         elif mode == '-': # smallest (crop)
@@ -106,6 +104,17 @@ class BBox:
                 n=closest_to(n, nw_sml.lat, nw_big.lat))
         raise NotImplementedError
 
+    def xyz_chunks(self: 'BBox', z:int) -> 'list[BBox]':
+        """Bounds of the XYZ tiles of zoom `z` covering the bbox, row by row, eg to split a job"""
+        import mercantile as T
+        tiles = sorted(T.tiles(self.w, self.s, self.e, self.n, zooms=z), key=lambda t: (t.y, t.x))
+        return [BBox(*T.bounds(t)) for t in tiles]
+
+    def xy_bounds(self) -> str:
+        """EPSG:3857 `xmin ymin xmax ymax`, eg for `gdalwarp -te_srs EPSG:3857 -te`"""
+        (xmin, ymin), (xmax, ymax) = T.xy(self.w, self.s), T.xy(self.e, self.n)
+        return f'{xmin:.6f} {ymin:.6f} {xmax:.6f} {ymax:.6f}'
+
 
 def enlarge(bb: T.LngLatBbox, eps=0.001):
     return BBox.from_llbb(bb).enlarge(eps=eps).to_llbb()
@@ -162,6 +171,13 @@ class BBoxTest(TestCase):
         self.assertEqual(foo.snap_to_xyz(9), BBox(7.03125, 46.07323062540836, 8.4375, 47.04018214480666))
         self.assertEqual(foo.snap_to_xyz(16),BBox(7.6959228515625, 46.498392258597626, 7.80029296875, 46.600393037345476))
 
+    def test_chunks(self):
+        chunks = foo.xyz_chunks(9)
+        self.assertEqual(len(chunks), 4)
+        self.assertEqual(chunks[0].e, chunks[1].w)
+        self.assertEqual(chunks[0].s, chunks[2].n)
+        self.assertEqual(BBox(chunks[0].w, chunks[3].s, chunks[3].e, chunks[0].n), foo.snap_to_xyz(9, '+'))
+
     def test_intersect(self):
         assert not bbwalps.intersect(bbcalps)
         assert not bbcalps.intersect(bbealps)
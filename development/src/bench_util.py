@@ -0,0 +1,261 @@
+"""Benchmarks of `mbt_util` operations, on synthetic MBTiles of 1e4 to 1e7 tiles.
+
+   `synthetic_mbt` writes a reproducible (seeded) tile set: a square pyramid around a point,
+   with random holes, PNG-like blobs whose sizes follow a log-normal distribution (like real
+   slope tiles: incompressible data, a few KB), and a share of duplicate blobs (like the
+   uniform tiles of flat or empty areas). Blobs only *look* like PNGs (signature + random data):
+   no operation benchmarked here decodes them.
+
+   `benchmark` runs each operation `repeat` times in a forked process, so its peak RSS
+   (`wait4`) is its own, and reports latency percentiles, throughput (source tiles per second)
+   and peak memory, compared with a baseline saved by a previous run:
+
+       python -m src.bench_util --sizes 1e4 1e6 --save bench.json
+       python -m src.bench_util --sizes 1e4 1e6 --baseline bench.json
+"""
+import argparse
+import contextlib
+import json
+import math
+import os
+import shutil
+import struct
+import tempfile
+from time import perf_counter
+from unittest import TestCase
+
+import numpy as np
+
+from .mbt_util import (LLBb, MBTiles, Tileset, apply_to_tiles, compute_strictest_bounds, create_stats,
+                       cut_to_lnglat, insert_tiles, lnglat2tms, mbt_merge, num2tile, real_bounds,
+                       remove_lnglat, set_real_bounds, tile_count, update_mbt_meta)
+
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+WORKDIR = '~/.cache/eslope-bench'
+SMALL_OPS = 1000
+
+
+def synthetic_mbt(dest: str, n_tiles: int, *, zmax=14, zmin=None, lng=7., lat=45.5, holes=.1, dup=.3,
+                  median_kb=4., sigma=.8, uniques=256, dedup=False, stats=False, seed=0,
+                  batch=50_000, log=print) -> int:
+    """Create `dest` with `n_tiles` tiles from `zmin` (default: `zmax - 6`) to `zmax`,
+       in squares centered on `lng, lat` whose sides halve at each lower zoom.
+       :param holes: share of missing tiles in the squares
+       :param dup: share of tiles which are one of `uniques` small blobs (a few hundred bytes,
+          the most common ones much more frequent), the others are all distinct
+       :param median_kb, sigma: log-normal size distribution of distinct blobs, in KB
+       :param dedup, stats: layout of `dest`, see `create_mbt`
+       :return: number of tiles written (`n_tiles`, unless the squares reach the world's size)"""
+    zmin = max(zmax - 6, 0) if zmin is None else zmin
+    rng = np.random.default_rng(seed)
+    noise = rng.bytes(1 << 20)
+    common = [PNG_SIGNATURE + rng.bytes(int(s)) for s in rng.integers(80, 400, uniques)]
+    # zmax side such that the squares of all zooms (4/3 of zmax's) hold n_tiles after holes
+    side = math.ceil(math.sqrt(n_tiles * .75 / (1 - holes)))
+    _, xc, yc = lnglat2tms(zmax, lng=lng, lat=lat)
+    n, rows = 0, []
+    with MBTiles(dest, create=True, dedup=dedup) as mbt:
+        if stats:
+            create_stats(mbt, log=lambda *a: None)
+        for z in range(zmin, zmax + 1):
+            s = min(math.ceil(side / 2 ** (zmax - z)), 2 ** z)
+            x0 = min(max((xc >> (zmax - z)) - s // 2, 0), 2 ** z - s)
+            y0 = min(max((yc >> (zmax - z)) - s // 2, 0), 2 ** z - s)
+            for y in range(y0, y0 + s):
+                xs = x0 + np.flatnonzero(rng.random(s) >= holes)
+                sizes = np.clip(rng.lognormal(math.log(median_kb * 1024), sigma, len(xs)), 64, 60_000).astype(int)
+                offsets = rng.integers(0, len(noise) - 60_000, len(xs))
+                common_idx = np.where(rng.random(len(xs)) < dup, (rng.random(len(xs)) ** 3 * uniques).astype(int), -1)
+                for x, size, off, c in zip(xs.tolist(), sizes.tolist(), offsets.tolist(), common_idx.tolist()):
+                    if n == n_tiles:
+                        break
+                    blob = common[c] if c >= 0 else \
+                        PNG_SIGNATURE + struct.pack('<BII', z, x, y) + noise[off:off + size]
+                    rows.append((z, x, y, blob))
+                    n += 1
+                if len(rows) >= batch:
+                    with mbt.batch() as dbc:
+                        insert_tiles(dbc, rows)
+                    rows = []
+        if rows:  # the last batch, also when the squares are capped to the world
+            with mbt.batch() as dbc:
+                insert_tiles(dbc, rows)
+        name = os.path.basename(dest)[:-len('.mbtiles')]
+        update_mbt_meta(mbt, name=name, desc=f'synthetic, seed {seed}', format='png', _type='overlay')
+        set_real_bounds(mbt)
+    log(f'synthetic {dest}: {n} tiles, z{zmin}-{zmax}')
+    return n
+
+
+def _inner_bounds(src: str) -> LLBb:
+    """The central quarter of the bounds of `src`"""
+    w, s, e, n = real_bounds(src)[2]
+    dx, dy = (e - w) / 4, (n - s) / 4
+    return LLBb(w + dx, s + dy, e - dx, n - dy)
+
+
+def _reverse_data(z, x, y, im):
+    return im[::-1]
+
+
+def _bench_merge(src, tmp):
+    mbt_merge(src, dest=f'{tmp}/merged.mbtiles', log=lambda *a: None)
+
+def _bench_cut(src, tmp):
+    cut_to_lnglat(src, _inner_bounds(src), f'{tmp}/cut.mbtiles', log=lambda *a: None)
+
+def _bench_remove(src, tmp):
+    remove_lnglat(src, f'{tmp}/removed.mbtiles', _inner_bounds(src), log=lambda *a: None)
+
+def _bench_apply(src, tmp):
+    apply_to_tiles(src, f'{tmp}/applied.mbtiles', _reverse_data, processes=os.cpu_count(), log=lambda *a: None)
+
+def _bench_strictest(src, tmp):
+    compute_strictest_bounds(src)
+
+def _bench_small_ops(src, tmp, handle: bool):
+    """`SMALL_OPS` `num2tile` of `src`, each followed by an `insert_tiles` of that tile into
+       a new file, given paths or `MBTiles` handles"""
+    dest = f'{tmp}/small.mbtiles'
+    with MBTiles(src, readonly=True) as mbt:
+        coords = mbt.db.execute('SELECT zoom_level, tile_column, tile_row FROM tiles LIMIT ?', (SMALL_OPS,)).fetchall()
+    MBTiles(dest, create=True).close()
+    reader, writer = (MBTiles(src, readonly=True), MBTiles(dest)) if handle else (src, dest)
+    try:
+        for z, x, y in coords:
+            insert_tiles(writer, [(z, x, y, num2tile(reader, z, x, y, flip_y=False))])
+    finally:
+        if handle:
+            reader.close()
+            writer.close()
+
+
+OPERATIONS = {
+    'mbt_merge': _bench_merge,
+    'cut_to_lnglat': _bench_cut,
+    'remove_lnglat': _bench_remove,
+    'apply_to_tiles': _bench_apply,
+    'real_bounds': lambda src, tmp: real_bounds(src),
+    'compute_strictest_bounds': _bench_strictest,
+    'Tileset.from_db': lambda src, tmp: Tileset.from_db(src),
+    'small_ops_path': lambda src, tmp: _bench_small_ops(src, tmp, handle=False),
+    'small_ops_handle': lambda src, tmp: _bench_small_ops(src, tmp, handle=True),
+}
+
+
+def run_forked(fun, *args) -> tuple[float, float]:
+    """Run `fun(*args)` in a forked process, silenced. -> (seconds, peak RSS in MB)
+       The RSS includes the pages of this process the child touched, so keep this one small."""
+    r, w = os.pipe()
+    pid = os.fork()
+    if not pid:  # child
+        os.close(r)
+        try:
+            with open(os.devnull, 'w') as null, contextlib.redirect_stdout(null):
+                start = perf_counter()
+                fun(*args)
+                os.write(w, json.dumps(perf_counter() - start).encode())
+            code = 0
+        except BaseException as e:
+            os.write(w, json.dumps(repr(e)).encode())
+            code = 1
+        os._exit(code)
+    os.close(w)
+    with os.fdopen(r) as f:
+        out = json.loads(f.read() or 'null')
+    _, status, ru = os.wait4(pid, 0)
+    if os.waitstatus_to_exitcode(status) or not isinstance(out, float):
+        raise RuntimeError(f'{getattr(fun, "__name__", fun)} failed: {out}')
+    return out, ru.ru_maxrss / 1024
+
+
+def benchmark(sizes=(10_000,), ops=tuple(OPERATIONS), repeat=3, workdir=WORKDIR, baseline='', save='',
+              regression=1.2, log=print, **synthetic) -> dict[str, dict]:
+    """Run `ops` on a synthetic MBTiles (kept in `workdir`) of each size.
+       :param baseline: JSON of a previous run (see `save`), to compare median times with
+       :param synthetic: more `synthetic_mbt` arguments
+       :return: {`op@size`: {p50_s, p90_s, max_s, tiles_per_s, rss_mb}}"""
+    workdir = os.path.expanduser(workdir)
+    os.makedirs(workdir, exist_ok=True)
+    before = {}
+    if baseline:
+        with open(os.path.expanduser(baseline)) as f:
+            before = json.load(f)
+    results = {}
+    log(f'{"operation":<32} {"p50_s":>8} {"p90_s":>8} {"max_s":>8} {"tiles/s":>10} {"rss_MB":>7}')
+    for size in map(int, sizes):
+        suffix = ''.join(f'-{k}{v}' for k, v in sorted(synthetic.items()))
+        src = f'{workdir}/synthetic-{size}{suffix}.mbtiles'
+        if not os.path.exists(src):
+            synthetic_mbt(src, size, log=log, **synthetic)
+        with MBTiles(src, readonly=True) as mbt, mbt.batch() as dbc:
+            n = tile_count(dbc)
+        for op in ops:
+            times, rss = [], 0.
+            for _ in range(repeat):
+                tmp = tempfile.mkdtemp(dir=workdir)
+                try:
+                    t, m = run_forked(OPERATIONS[op], src, tmp)
+                finally:
+                    shutil.rmtree(tmp)
+                times.append(t)
+                rss = max(rss, m)
+            p50, p90 = np.percentile(times, [50, 90])
+            key = f'{op}@{size}'
+            results[key] = {'p50_s': round(p50, 4), 'p90_s': round(p90, 4), 'max_s': round(max(times), 4),
+                            'tiles_per_s': round(n / p50), 'rss_mb': round(rss, 1)}
+            r = results[key]
+            line = f'{key:<32} {p50:>8.3f} {p90:>8.3f} {r["max_s"]:>8.3f} {r["tiles_per_s"]:>10} {rss:>7.0f}'
+            if key in before and before[key]['p50_s']:
+                ratio = p50 / before[key]['p50_s']
+                line += f'  x{ratio:.2f}' + (' REGRESSION' if ratio > regression else '')
+            log(line)
+    if save:
+        with open(os.path.expanduser(save), 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    return results
+
+
+class TestBench(TestCase):
+    def test_synthetic_and_run(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            src = f'{tmp}/s.mbtiles'
+            self.assertEqual(synthetic_mbt(src, 3000, zmax=10, log=lambda *a: None), 3000)
+            with MBTiles(src, readonly=True) as mbt, mbt.batch() as dbc:
+                (n, distinct, zmin, zmax), = dbc.execute(
+                    'SELECT COUNT(*), COUNT(DISTINCT tile_data), MIN(zoom_level), MAX(zoom_level) FROM tiles')
+            self.assertEqual((n, zmin, zmax), (3000, 4, 10))
+            self.assertLess(distinct, .8 * n)
+            capped = synthetic_mbt(f'{tmp}/capped.mbtiles', 10_000, zmax=5, log=lambda *a: None)
+            self.assertLess(capped, 10_000)  # the squares are the whole world
+            self.assertEqual(sum(Tileset.from_db(f'{tmp}/capped.mbtiles').counts().values()), capped)
+            self.assertEqual(Tileset.from_db(src).counts()[10], n - sum(
+                c for z, c in Tileset.from_db(src).counts().items() if z < 10))
+            lines = []
+            res = benchmark([2000], ['real_bounds', 'mbt_merge'], repeat=2, workdir=tmp, log=lines.append, zmax=10)
+            self.assertEqual(set(res), {'real_bounds@2000', 'mbt_merge@2000'})
+            self.assertGreater(res['mbt_merge@2000']['rss_mb'], 0)
+            with open(f'{tmp}/base.json', 'w') as f:
+                json.dump({k: {**v, 'p50_s': v['p50_s'] / 10} for k, v in res.items()}, f)
+            benchmark([2000], ['real_bounds'], repeat=1, workdir=tmp, baseline=f'{tmp}/base.json',
+                      log=lines.append, zmax=10)
+            self.assertIn('REGRESSION', lines[-1])
+            res = benchmark([2000], ['small_ops_path', 'small_ops_handle'], repeat=1, workdir=tmp,
+                            log=lines.append, zmax=10)
+            self.assertLess(res['small_ops_handle@2000']['p50_s'], res['small_ops_path@2000']['p50_s'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark mbt_util operations on synthetic MBTiles')
+    parser.add_argument('--sizes', nargs='+', type=float, default=[1e4])
+    parser.add_argument('--ops', nargs='+', choices=list(OPERATIONS), default=list(OPERATIONS))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--workdir', default=WORKDIR)
+    parser.add_argument('--baseline', default='')
+    parser.add_argument('--save', default='')
+    parser.add_argument('--dedup', action='store_true', help='deduplicated layout')
+    parser.add_argument('--stats', action='store_true', help='with zoom_stats')
+    a = parser.parse_args()
+    benchmark(a.sizes, a.ops, a.repeat, a.workdir, a.baseline, a.save,
+              **{k: True for k in ('dedup', 'stats') if getattr(a, k)})
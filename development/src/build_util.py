@@ -0,0 +1,199 @@
+"""Incremental build graph: unlike `reuse=True`, which only checks that an output exists,
+   a step re-runs when anything it depends on changed: input file contents, arguments,
+   the code of its function, upstream steps, or tool versions. Keys are recorded in a JSON manifest.
+   Steps whose dependencies are done run concurrently, on threads: they are typically
+   GDAL commands or functions with their own process pool.
+
+       g = BuildGraph('build.json')
+       slope = g.step(merge_slopes, src='in.vrt', dest='slopes-z16.tif', z=16)
+       g.step(slope_mbt, 'eslo13near', z=16, src=slope, dest='eslo-z16.mbtiles', inputs=[clr])
+       g.run()
+"""
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import hashlib
+import inspect
+import json
+import os
+from subprocess import CalledProcessError, check_output
+import tempfile
+import threading
+from time import time
+from typing import Callable
+from unittest import TestCase
+
+
+TOOLS = ('gdalinfo --version',)
+
+
+class Step:
+    """A call `fun(*args, **kwargs)`, where arguments that are `Step`s are replaced by their output"""
+    def __init__(self, name: str, fun: Callable, args: tuple, kwargs: dict, inputs=(), output: str=None):
+        self.name, self.fun, self.args, self.kwargs = name, fun, args, kwargs
+        self.inputs = [os.path.expanduser(p) for p in inputs]
+        self.output = output
+        self.deps = [a for a in (*args, *kwargs.values()) if isinstance(a, Step)]
+
+    def __repr__(self):
+        return f'Step({self.name!r})'
+
+    def __fspath__(self):
+        return self.output
+
+    def call(self):
+        resolve = lambda a: a.output if isinstance(a, Step) else a
+        return self.fun(*map(resolve, self.args), **{k: resolve(v) for k, v in self.kwargs.items()})
+
+
+def tool_versions(tools=TOOLS) -> dict[str, str]:
+    versions = {}
+    for cmd in tools:
+        try:
+            versions[cmd] = check_output(cmd, shell=True, text=True).strip()
+        except (CalledProcessError, OSError):
+            versions[cmd] = 'missing'
+    return versions
+
+
+def file_hash(path: str, chunk=1 << 20) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while data := f.read(chunk):
+            h.update(data)
+    return h.hexdigest()
+
+
+def _code_hash(fun: Callable) -> str:
+    try:
+        return hashlib.sha256(inspect.getsource(fun).encode()).hexdigest()
+    except (OSError, TypeError):
+        return getattr(fun, '__qualname__', repr(fun))
+
+
+class BuildGraph:
+    """Steps and their manifest. Input files are hashed by content, once per (size, mtime)."""
+    def __init__(self, manifest='build-manifest.json', tools=TOOLS, log=print):
+        self.manifest_path = os.path.expanduser(manifest)
+        self.steps: dict[str, Step] = {}
+        self.tools = tools
+        self.log = log
+        self._versions = None
+        self._lock = threading.Lock()
+        self.manifest = {'steps': {}, 'files': {}}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+
+    def step(self, fun: Callable, *args, name: str=None, inputs=(), output: str=None, **kwargs) -> Step:
+        """Add a step. Its output is `output`, by default the `dest` argument.
+           `inputs`: files it reads that are not visible in its arguments, eg a palette.
+           String arguments naming existing files are inputs too."""
+        output = output or kwargs.get('dest')
+        name = name or output or fun.__name__
+        assert name not in self.steps, f'duplicate step {name}'
+        step = Step(name, fun, args, kwargs, inputs, os.path.expanduser(output) if output else None)
+        self.steps[name] = step
+        return step
+
+    def _file_hash(self, path: str) -> str:
+        st = os.stat(path)
+        with self._lock:
+            cached = self.manifest['files'].get(path)
+        if cached and cached[:2] == [st.st_size, st.st_mtime_ns]:
+            return cached[2]
+        digest = file_hash(path)
+        with self._lock:
+            self.manifest['files'][path] = [st.st_size, st.st_mtime_ns, digest]
+        return digest
+
+    def key(self, step: Step) -> str:
+        """Content key of a step, computed from its definition and its inputs only"""
+        if self._versions is None:
+            self._versions = tool_versions(self.tools)
+        def arg(a):
+            if isinstance(a, Step):
+                return {'step': self.key(a)}
+            if isinstance(a, str) and os.path.isfile(os.path.expanduser(a)) \
+                    and os.path.expanduser(a) != step.output:
+                return {'file': self._file_hash(os.path.expanduser(a))}
+            return repr(a)
+        desc = {
+            'fun': f'{step.fun.__module__}.{step.fun.__qualname__}',
+            'code': _code_hash(step.fun),
+            'args': [arg(a) for a in step.args],
+            'kwargs': {k: arg(v) for k, v in sorted(step.kwargs.items())},
+            'inputs': [self._file_hash(p) for p in step.inputs],
+            'tools': self._versions,
+        }
+        return hashlib.sha256(json.dumps(desc, sort_keys=True).encode()).hexdigest()
+
+    def is_fresh(self, step: Step) -> bool:
+        done = self.manifest['steps'].get(step.name)
+        return bool(done) and done['key'] == self.key(step) and (not step.output or os.path.exists(step.output))
+
+    def plan(self) -> list[str]:
+        """Names of the steps `run` would execute"""
+        return [s.name for s in self.steps.values() if not self.is_fresh(s)]
+
+    def save(self):
+        with self._lock:
+            tmp = self.manifest_path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self.manifest, f, indent=1, sort_keys=True)
+            os.replace(tmp, self.manifest_path)
+
+    def _run_step(self, step: Step) -> bool:
+        if self.is_fresh(step):
+            self.log('Up to date:', step.name)
+            return False
+        self.log('Run:', step.name)
+        start = time()
+        step.call()
+        done = {'key': self.key(step), 'output': step.output, 'seconds': round(time() - start, 1)}
+        with self._lock:
+            self.manifest['steps'][step.name] = done
+        self.save()
+        return True
+
+    def run(self, max_workers=os.cpu_count()) -> dict[str, bool]:
+        """Run stale steps, each once its dependencies are done. -> {name: ran}"""
+        results, pending, running = {}, dict(self.steps), {}
+        with ThreadPoolExecutor(max_workers) as pool:
+            while pending or running:
+                for name, step in list(pending.items()):
+                    if all(d.name in results for d in step.deps):
+                        running[pool.submit(self._run_step, step)] = name
+                        del pending[name]
+                assert running, f'dependency cycle or unknown step in {list(pending)}'
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    results[running.pop(fut)] = fut.result()
+        self.save()
+        return results
+
+
+def _write(dest: str, *parts: str):
+    with open(dest, 'w') as f:
+        f.write(''.join(open(p).read() if os.path.isfile(p) else p for p in parts))
+
+
+class TestBuildGraph(TestCase):
+    def test_incremental(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            p = lambda name: os.path.join(tmp, name)
+            _write(p('dem.txt'), 'dem')
+            _write(p('a.clr'), 'A')
+            _write(p('b.clr'), 'B')
+            def graph():
+                g = BuildGraph(p('manifest.json'), tools=(), log=lambda *a: None)
+                slope = g.step(_write, p('slope.txt'), p('dem.txt'), output=p('slope.txt'), name='slope')
+                g.step(_write, p('za.txt'), slope, inputs=[p('a.clr')], output=p('za.txt'))
+                g.step(_write, p('zb.txt'), slope, p('b.clr'), output=p('zb.txt'))
+                return g
+            self.assertEqual(graph().run(), {'slope': True, p('za.txt'): True, p('zb.txt'): True})
+            self.assertEqual(graph().plan(), [])
+            _write(p('b.clr'), 'B2')
+            self.assertEqual(graph().plan(), [p('zb.txt')])
+            self.assertEqual(graph().run(), {'slope': False, p('za.txt'): False, p('zb.txt'): True})
+            self.assertEqual(open(p('zb.txt')).read(), 'demB2')
+            os.remove(p('slope.txt'))
+            self.assertEqual(graph().plan(), ['slope'])
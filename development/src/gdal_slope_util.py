@@ -1,22 +1,16 @@
+from multiprocessing import Pool
 import os
 from pathlib import Path
 from posixpath import realpath
 import re
-from subprocess import check_call, check_output, CalledProcessError
-from time import time
-
-try:
-    # like os.system but with live output
-    from IPython.utils.process import system  #type:ignore
-    def check_run(cmd):  # type:ignore
-        r = system(cmd)
-        if r: raise CalledProcessError(r, cmd)
-        return r
-except ImportError:
-    def check_run(cmd):
-        return check_call(cmd, shell=True)
 
+from .build_util import BuildGraph, Step
 from .mbt_util import mbt_merge
+from .palette_util import load_palette
+from .pyramid_util import build_pyramid, render_values, tif_to_values
+from .render_util import render_mbt
+from .run_util import check_run, timed
+from .slope_util import slope_tif
 from .bbox import BBox
 
 resolutions = [
@@ -49,10 +43,10 @@ def isfile(path):
 
 
 def gdalwarp(src:str, dest:str, z=16, precision='', mode='nearest',
-        extent:'BBox|str'='', default_opt=DFLT_WARP_OPT, extra_opt='', reuse=False):
+        extent:'BBox|str'='', default_opt=DFLT_WARP_OPT, extra_opt='', reuse=False, te_srs='WGS84'):
     """ Gdalwarp wrapper
         :param z: to reproject/resample to a TMS zoom level `z`
-        :param extent: eg `-te w s e n` in WGS84
+        :param extent: eg `-te w s e n` in `te_srs` (WGS84 by default)
         :param default_opt: to override default compression/tiling/tif etc
         :param extra_opt: any additional option"""
     if reuse and isfile(dest): print('Reuse', dest) ; return 0
@@ -64,19 +58,20 @@ def gdalwarp(src:str, dest:str, z=16, precision='', mode='nearest',
       gdalwarp {precision} \\
         {default_opt} \\
         -t_srs EPSG:3857 {tr} -r {mode} \\
-        -te_srs WGS84 {extent} {extra_opt} \\
+        -te_srs {te_srs} {extent} {extra_opt} \\
         {src} {dest}'''))
 
 
 def merge_slopes(*,
         src: str, dest: str, z=16, precision='-ot Byte',
-        extent:'BBox|str'='', default_opt=DFLT_WARP_OPT, extra_opt='', reuse=False):
+        extent:'BBox|str'='', default_opt=DFLT_WARP_OPT, extra_opt='', reuse=False, te_srs='WGS84'):
     """Merge/reproject/resample to a TMS zoom level `z`
-       Also rounds to Byte by default"""
+       Also rounds to Byte by default.
+       `src` slopes can be made with `slope_util.slope_tif` (Byte, nodata 255) instead of `gdaldem slope`"""
     mode='nearest' if z == 16 else 'q3'
     extra_opt += ' -dstnodata 255 '  # to go with -ot Byte
     gdalwarp(src=src, dest=dest, z=z, precision=precision, mode=mode,
-             extent=extent, default_opt=default_opt, extra_opt=extra_opt, reuse=reuse)
+             extent=extent, default_opt=default_opt, extra_opt=extra_opt, reuse=reuse, te_srs=te_srs)
 
 
 # def make_western_alps(*,
@@ -121,11 +116,12 @@ def make_ovr(*, src: str, dest='', z,
     return dest
 
 
-def slope_mbt(cname:str, *, z:int, options='', src='', dest='', reuse=False):
-    """ Transforms DEM into color-coded slope mbtiles.
+def slope_mbt(cname:str, *, z:int, options='', src='', dest='', reuse=False, processes=os.cpu_count()):
+    """ Transforms slope raster into color-coded slope mbtiles,
+        like `gdaldem color-relief -nearest_color_entry -co TILE_FORMAT=png8` (see `render_mbt`).
         :input cname: colorname eg `eslo13near`, to be found in `CMAPDIR/gdaldem-slope-{cname}.clr`
         :input zlevel: eg `16`
-        :input options: gdaldem options eg `-alpha`
+        :input options: gdaldem options, only `-alpha` is supported
     """
     if src:
         # keep folder, insert cname and z in file name
@@ -135,43 +131,109 @@ def slope_mbt(cname:str, *, z:int, options='', src='', dest='', reuse=False):
         src = src or f'./slopes-z{z}.tif'
         dest = dest or f'./{cname}-z{z}.mbtiles'
     if reuse and isfile(dest): print('Reuse', dest) ; return dest
-    cmap = f'gdaldem-slope-{cname}.clr'
-    # set nodata value to white so mbtiles blends correctly
-    cmd = rf'''sed 's/nv \+0 \+0 \+0/nv  255 255 255/g' '{CMAPDIR}/{cmap}' '''
-    with open(f'/tmp/{cmap}', 'wb') as f:
-        f.write(check_output(printed(cmd), shell=True))
-    check_run(printed(rf'''\
-      gdaldem color-relief {src} /tmp/{cmap} {dest} \
-          -nearest_color_entry -co TILE_FORMAT=png8 {options}'''))
+    cmap = f'{CMAPDIR}/gdaldem-slope-{cname}.clr'
+    # nodata is white (rather than the black `nv` of the palettes) so mbtiles blends correctly
+    with timed(f'slope_mbt {cname} z{z}'):
+        render_mbt(os.path.expanduser(src), os.path.expanduser(dest), cmap, alpha='-alpha' in options,
+                   processes=processes, overwrite=True)
+    return dest
+
+OVERVIEW_PALETTES = {
+    16: 'eslo13near',
+    15: 'eslo13near',
+    14: 'eslo4near',
+    13: 'eslo4near',  # TBD oslo3near
+    # 12: 'oslo2near', # TBD
+}
+
+def _slope_mbt_chunk(args):
+    """One chunk of `chunked_slope_mbt`, in its own process"""
+    i, chunk, src, cname, z, workdir, mem_mb = args
+    os.environ['GDAL_CACHEMAX'] = str(mem_mb)
+    tif = f'{workdir}/chunk{i}-z{z}.tif'
+    merge_slopes(src=src, dest=tif, z=z, extent=f'-te {chunk.xy_bounds()}', te_srs='EPSG:3857',
+                 default_opt=DFLT_OPT + '-overwrite ', extra_opt=f'-wm {mem_mb}')
+    mbt = slope_mbt(cname, z=z, src=tif, processes=1)
+    os.remove(tif)
+    return mbt
+
+
+def chunked_slope_mbt(cname: str, *, src: str, dest: str, extent: BBox, z=16, zchunk=10,
+                      processes=os.cpu_count(), mem_mb=1024, workdir=''):
+    """`merge_slopes` then `slope_mbt` over a large `extent`, as tile-aligned chunks
+        (the XYZ tiles of zoom `zchunk` covering `extent`, see `BBox.xyz_chunks`),
+        each one warped and rendered in its own process, within a `mem_mb` GDAL cache
+        and warp memory. The chunk MBTiles are then merged into `dest`.
+        Chunks are warped in EPSG:3857 on the tile grid, so each pixel is computed as it
+        would be by a single run over the snapped extent (`extent.snap_to_xyz(zchunk, '+')`):
+        chunk edges are seamless, and no tile is in 2 chunks.
+    """
+    workdir = os.path.expanduser(workdir or os.path.dirname(os.path.realpath(os.path.expanduser(dest))))
+    chunks = extent.xyz_chunks(zchunk)
+    print(f'{len(chunks)} chunks at z{zchunk}, {processes} processes of {mem_mb}MB')
+    jobs = [(i, chunk, src, cname, z, workdir, mem_mb) for i, chunk in enumerate(chunks)]
+    with Pool(processes, maxtasksperchild=1) as pool:
+        files = pool.map(_slope_mbt_chunk, jobs, chunksize=1)
+    merge_new(*files, dest=os.path.expanduser(dest))
+    for f in files:
+        os.remove(f)
     return dest
 
-def make_overviews(src: str, dest='', reuse=False):
-    """Create an mbtile with lower zoom levels, from a z16 slope.
-        Makes overviews with Q3 method as necessary, but prefer making your own.
+
+def make_overviews(src: str, dest='', reuse=False, method='q3', processes=os.cpu_count(),
+                   zooms=OVERVIEW_PALETTES):
+    """Create an mbtile with lower zoom levels, from a z16 Byte slope.
+        Overviews are resampled tile by tile from their 4 children (see `pyramid_util`),
+        with Q3 method by default, instead of one `make_ovr` warp of `src` per zoom.
+        See `overview_steps` to only redo what changed.
     """
-    zooms = {
-        16: 'eslo13near',
-        15: 'eslo13near',
-        14: 'eslo4near',
-        13: 'eslo4near',  # TBD oslo3near
-        # 12: 'oslo2near', # TBD
-    }
     if os.path.exists(dest):
         if reuse:
              print('Reuse', dest)
              return dest
         else:
             os.remove(dest)
-    files=[]
-    for i, (z, cname) in enumerate(zooms.items()):
-        chkpoint = time()
-        zoomed_slope = src if z==16 else make_ovr(src=src, z=z, reuse=reuse)
-        if zoomed_slope:
-            to_merge = slope_mbt(cname, z=z, src=zoomed_slope, reuse=reuse)
-            files.append(os.path.expanduser(to_merge))  # f'{cname}-z{z}.mbtiles')
-        print(f'Step {i+1}/{len(zooms)} completed in {round(time()-chkpoint,1)} seconds')
+    values = re.sub(r'(\.tif)?$', '-values.mbtiles', os.path.expanduser(src), count=1)
+    with timed('tif_to_values'):
+        tif_to_values(src, values, processes=processes, reuse=reuse, overwrite=True)
+    with timed('build_pyramid'):
+        build_pyramid(values, max(zooms), min(zooms), method=method, processes=processes)
+    with timed('render_values'):
+        render_values(values, dest, {z: f'{CMAPDIR}/gdaldem-slope-{cname}.clr' for z, cname in zooms.items()},
+                      processes=processes, overwrite=True)
+    return dest
 
-    mbt_merge(*files, dest=dest)
+
+def values_pyramid(src: str, dest: str, zfrom: int, zto: int, method='q3', processes=os.cpu_count()):
+    """`tif_to_values` then `build_pyramid`, as one build step"""
+    tif_to_values(src, dest, processes=processes, overwrite=True)
+    build_pyramid(dest, zfrom, zto, method=method, processes=processes)
+    return dest
+
+
+def merge_new(*sources: str, dest: str):
+    """`mbt_merge` into a new `dest`, as one build step"""
+    if os.path.exists(dest):
+        os.remove(dest)
+    with timed('merge'):
+        mbt_merge(*sources, dest=dest)
+    return dest
+
+
+def overview_steps(graph: BuildGraph, src: str, dest: str, zooms=OVERVIEW_PALETTES, method='q3',
+                   processes=os.cpu_count()) -> Step:
+    """Add `make_overviews` to `graph`, as one step per zoom palette, so eg changing
+       one palette only recolors its zooms, without recomputing the pyramid.
+       Per-zoom renders are kept next to `dest`, as `{dest}-z{z}.mbtiles`."""
+    src, dest = os.path.expanduser(src), os.path.expanduser(dest)
+    values = graph.step(values_pyramid, src, dest=re.sub(r'(\.tif)?$', '-values.mbtiles', src, count=1),
+                        zfrom=max(zooms), zto=min(zooms), method=method, processes=processes)
+    renders = []
+    for z, cname in zooms.items():
+        clr = f'{CMAPDIR}/gdaldem-slope-{cname}.clr'
+        renders.append(graph.step(render_values, values, dest=f'{dest[:-len(".mbtiles")]}-z{z}.mbtiles',
+                                  clrs={z: clr}, processes=processes, overwrite=True, inputs=[clr]))
+    return graph.step(merge_new, *renders, dest=dest)
 
 
 def eslo_tiny(path: str, cname='eslo13bnear', res=0, where='/tmp', reuse=False):
@@ -187,13 +249,22 @@ def eslo_tiny(path: str, cname='eslo13bnear', res=0, where='/tmp', reuse=False):
     if is_slope:
         check_run(f'ln -sf {path} {p_slope}')
     else:
-        cmd = f'gdaldem slope {path} {DFLT_OPT} {p_slope}'
-        print(cmd); check_run(cmd)
+        slope_tif(path, p_slope, byte=False)
     cmap = f'{CMAPDIR}/gdaldem-slope-{cname}.clr'
     p_relief = f'{where}/tiny_{cname}.png'
-    check_run(printed(f'gdaldem color-relief {p_slope} {cmap} {p_relief} -nearest_color_entry'))
+    colorize_tif(p_slope, cmap, p_relief)
     return p_relief
 
+
+def colorize_tif(src: str, clr: str, dest: str, mode='nearest'):
+    """Like `gdaldem color-relief src clr dest [-nearest_color_entry]` to a RGB image (eg png),
+       with a compiled `Palette` (Float32 slopes go through its high-resolution LUT)"""
+    from osgeo import gdal
+    import PIL.Image
+    band = gdal.Open(os.path.expanduser(src)).GetRasterBand(1)
+    rgba = load_palette(clr, band.GetNoDataValue(), mode=mode)(band.ReadAsArray())
+    PIL.Image.fromarray(rgba[..., :3]).save(os.path.expanduser(dest))
+
 def relief_tiny(*paths: str, res=0, where='/tmp'):
     """For quick overviews. If file is big, use eg res=200. Detects `slope` in file name"""
     path = ' '.join(map(str, paths))
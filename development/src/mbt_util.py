@@ -1,5 +1,8 @@
 import contextlib
+import hashlib
+from collections import deque
 from decimal import Decimal
+from multiprocessing import Pool
 import os
 from pprint import pformat
 import shutil
@@ -7,26 +10,107 @@ import sqlite3
 import tempfile
 from typing import List, Tuple, Union, Iterable, SupportsRound as Numeric
 from unittest import TestCase
+from urllib.request import pathname2url
 
-try:
-    import mercantile as T
-except ImportError:
-    print('WARN: mercantile features not available')
-    from unittest.mock import MagicMock as  T
-LLBb = T.LngLatBbox
+import numpy as np
 
+from .tile_util import LngLat, LngLatBbox as LLBb, Tile, bbox_tms, tms_bounds, tms_tiles
+
+
+DB = Union[str, os.PathLike, sqlite3.Connection, sqlite3.Cursor, 'MBTiles']  # : 'TypeAlias'
+
+
+class MBTiles:
+    """Long-lived handle on an MBTiles file, accepted by every function taking a `DB`.
+       Avoids paying connection setup (and losing the page cache) at each call in loops
+       over `num2tile`, `insert_tiles`... Statements are prepared once and reused from
+       sqlite3's per-connection cache, as long as their SQL text is constant.
+       Each call commits on exit, unless grouped in a `with mbt.batch():` block.
+       PRAGMAs default to speed over durability (`synchronous=NORMAL`, memory temp store);
+       `journal_mode` is persistent in the file so it is left unchanged unless given.
+       For concurrent access, use `journal_mode='WAL'` on the writer, and one `reader()`
+       per thread/process: readers then never block, nor are blocked by, the writer.
+       :param create: create the file and tables if needed (`dedup`: see `create_mbt`)
+    """
+    def __init__(self, path, *, create=False, dedup=False, readonly=False, journal_mode: str=None,
+                 synchronous='NORMAL', mmap_size=256 << 20, cache_size=-64 << 10,
+                 temp_store='MEMORY', cached_statements=256):
+        self.path = os.path.expanduser(os.fspath(path))
+        assert os.path.exists(self.path) or create and not readonly, f'Not found: {self.path}'
+        self.readonly = readonly
+        self.pragmas = dict(journal_mode=journal_mode, synchronous=synchronous, mmap_size=mmap_size,
+                            cache_size=cache_size, temp_store=temp_store)
+        self.cached_statements = cached_statements
+        uri = f'file:{pathname2url(self.path)}?mode=' + ('ro' if readonly else 'rwc')
+        self.db = sqlite3.connect(uri, uri=True, cached_statements=cached_statements)
+        register_functions(self.db)
+        for k, v in self.pragmas.items():
+            if v is not None and not (readonly and k == 'journal_mode'):
+                self.db.execute(f'PRAGMA {k}={v}')
+        self._depth = 0
+        if create:
+            create_mbt(self, dedup=dedup)
+
+    def __repr__(self):
+        return f'MBTiles({self.path!r}{", readonly" if self.readonly else ""})'
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Cursor whose writes are all committed at once at the end of the (outermost) block"""
+        self._depth += 1
+        dbc = self.db.cursor()
+        try:
+            yield dbc
+        finally:
+            dbc.close()
+            self._depth -= 1
+            if not self._depth and self.db.in_transaction:
+                self.db.commit()
+
+    def reader(self):
+        """A new read-only handle on the same file, eg for another thread"""
+        return MBTiles(self.path, readonly=True, **{k: v for k, v in self.pragmas.items() if k != 'journal_mode'},
+                       cached_statements=self.cached_statements)
+
+    def checkpoint(self):
+        """Commit and, in WAL mode, flush the WAL into the main file (eg before copying it)"""
+        if not self.readonly:
+            self.db.commit()
+            self.db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def close(self):
+        if not self.readonly:
+            self.db.commit()
+        self.db.close()
+
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        self.close()
+
+
+def mbt_path(mbt: 'str|os.PathLike|MBTiles') -> str:
+    """For functions working at the file level: path of `mbt`, made complete on disk first"""
+    if isinstance(mbt, MBTiles):
+        mbt.checkpoint()
+        return mbt.path
+    return os.fspath(mbt) if mbt else mbt
 
-DB = Union[str, os.PathLike, sqlite3.Connection, sqlite3.Cursor]  # : 'TypeAlias'
 
 @contextlib.contextmanager
 def cursor(sqlite_or_path: DB, create=False):
     """Gracefully handle opening/closing db if necessary."""
+    if isinstance(sqlite_or_path, MBTiles):
+        with sqlite_or_path.batch() as dbc:
+            yield dbc
+        return
     owndb = isinstance(sqlite_or_path, Union[str, bytes, os.PathLike])
     assert not owndb or os.path.exists(sqlite_or_path) or create, \
         f'Not found in {os.curdir}: {sqlite_or_path}'  # type: ignore
     db = sqlite3.connect(sqlite_or_path) if owndb else sqlite_or_path
     owncur = isinstance(db, sqlite3.Connection)
     dbc = db.cursor() if owncur else db
+    register_functions(dbc.connection)
     try:
         yield dbc
     finally:
@@ -42,8 +126,8 @@ def mbt_info(mbt_or_cur: DB):
         assert os.path.exists(mbt_or_cur), "Invalid path: " + mbt_or_cur
 
     with cursor(mbt_or_cur) as c:
-        res = c.execute("SELECT 'zoom =', MIN(zoom_level), MAX(zoom_level), '; n =', COUNT(*) "
-                        "FROM tiles ;").fetchall()
+        res = c.execute("SELECT 'zoom =', MIN(zoom_level), MAX(zoom_level), '; n =', "
+                        + ("SUM(tiles) FROM zoom_stats" if has_stats(c) else "COUNT(*) FROM tiles")).fetchall()
         if isinstance(mbt_or_cur, str):
             res.append(('*', round(os.path.getsize(mbt_or_cur) / res[0][4] / 1024), 'kb/tile'))
         try:
@@ -74,21 +158,14 @@ def get_bbounds(sqlite_or_path, dbn:str='main') -> LLBb:
 
 
 def tms2bbox(z, *, x, y) -> LLBb:
-    # Mercantile uses TXYZ but MBTiles use TMS -> flip
-    y = (1 << z) - y - 1
-    bb = T.xy_bounds(x, y, z)
-    sw = T.lnglat(bb.left, bb.bottom)
-    ne = T.lnglat(bb.right, bb.top)
-    return LLBb(west=sw.lng, south=sw.lat, east=ne.lng, north=ne.lat)
+    return LLBb(*map(float, tms_bounds(z, x, y)))
 
 
 def real_bounds(sqlite_or_path: DB, strict=False, dbn:str='main', zlevels:tuple=(), log=None) -> tuple[int, int, LLBb]:
     b_merge = b_intersection if strict else b_union
     bounds = None
     with cursor(sqlite_or_path) as dbc:
-        rows = dbc.execute(f"""SELECT zoom_level, MIN(tile_column) x1w, MAX(tile_column) x2e,
-                                                  MIN(tile_row) y1s, MAX(tile_row) y2n
-                               FROM {dbn}.tiles GROUP BY zoom_level""").fetchall()
+        rows = zoom_extents(dbc, dbn)
         zooms = [r[0] for r in rows]
         for z, x1w, x2e, y1s, y2n in rows:
             if not zlevels or z in zlevels:
@@ -127,7 +204,14 @@ def compute_center(sqlite_or_path: DB, bounds:LLBb=None, dbn:str='main'):
                 lngc = (bb.west + bb.east) / 2
                 latc = (bb.south + bb.north) / 2
                 print("Fallback `center` to first tile: ", z, x, y, lngc, latc)
-        return T.LngLat(lngc, latc), zc
+        return LngLat(lngc, latc), zc
+
+
+def _strictest_bbox(zwsen: list) -> LLBb:
+    """Intersection of the bounds of each zoom's `(z, w, s, e, n)` TMS ranges, rounded"""
+    z, w, s, e, n = np.array(zwsen).T
+    west_, south, east_, north = tms_bounds(z, w, s)[:2] + tms_bounds(z, e, n)[2:]
+    return LLBb(*(round(float(v), 5) for v in (west_.max(), south.max(), east_.min(), north.min())))
 
 
 def compute_inner_bounds(sqlite_or_path: DB):
@@ -143,11 +227,8 @@ def compute_inner_bounds(sqlite_or_path: DB):
         # then final UNION and SUM is just a way to pivot the data for clearer python code
         zwsen = dbc.execute(f"""
             WITH center AS MATERIALIZED (
-                SELECT zoom_level AS z,
-                    (MIN(tile_column) + MAX(tile_column)) / 2 AS c,
-                    (MIN(tile_row) + MAX(tile_row)) / 2 AS r
-                FROM tiles
-                GROUP BY zoom_level)
+                SELECT z, (x1w + x2e) / 2 AS c, (y1s + y2n) / 2 AS r
+                FROM ({_extents_query(dbc)}))
             SELECT z, SUM(x1w), SUM(y1s), SUM(x2e), SUM(y2n)
             FROM (
                 SELECT z, MIN(tile_column) x1w, 0 as y1s, MAX(tile_column) x2e, 0 as y2n
@@ -164,11 +245,7 @@ def compute_inner_bounds(sqlite_or_path: DB):
             GROUP BY z;
         """).fetchall()
         assert zwsen
-        west_ = max(tms2bbox(z, x=w, y=1).west  for z, w, s, e, n in zwsen)
-        south = max(tms2bbox(z, x=1, y=s).south for z, w, s, e, n in zwsen)
-        east_ = min(tms2bbox(z, x=e, y=1).east  for z, w, s, e, n in zwsen)
-        north = min(tms2bbox(z, x=1, y=n).north for z, w, s, e, n in zwsen)
-        return LLBb(*(round(n, 5) for n in (west_, south, east_, north)))
+        return _strictest_bbox(zwsen)
 
 
 def compute_strictest_bounds(sqlite_or_path: DB):
@@ -184,11 +261,8 @@ def compute_strictest_bounds(sqlite_or_path: DB):
         # then final UNION and SUM is just a way to pivot the data for clearer python code
         zwsen = dbc.execute(f"""
             WITH border AS MATERIALIZED (
-                SELECT zoom_level AS z,
-                    MIN(tile_column) cw, MAX(tile_column) ce,
-                    MIN(tile_row) rs, MAX(tile_row) rn
-                FROM tiles
-                GROUP BY zoom_level)
+                SELECT z, x1w cw, x2e ce, y1s rs, y2n rn
+                FROM ({_extents_query(dbc)}))
             SELECT z, SUM(x1w), SUM(y1s), SUM(x2e), SUM(y2n)
             FROM (
                 SELECT z, MIN(tile_column) x1w, 0 as y1s, MAX(tile_column) x2e, 0 as y2n
@@ -220,11 +294,7 @@ def compute_strictest_bounds(sqlite_or_path: DB):
             GROUP BY z;
         """).fetchall()
         assert zwsen
-        west_ = max(tms2bbox(z, x=w, y=1).west  for z, w, s, e, n in zwsen)
-        south = max(tms2bbox(z, x=1, y=s).south for z, w, s, e, n in zwsen)
-        east_ = min(tms2bbox(z, x=e, y=1).east  for z, w, s, e, n in zwsen)
-        north = min(tms2bbox(z, x=1, y=n).north for z, w, s, e, n in zwsen)
-        return LLBb(*(round(n, 5) for n in (west_, south, east_, north)))
+        return _strictest_bbox(zwsen)
 
 
 
@@ -247,6 +317,7 @@ def get_meta(mbt: DB, db='main'):
 
 def update_with(source, dest, log=print):
     """Updates all tiles in `dest` with their "updated" version in `source`, if it exists."""
+    source = mbt_path(source)
     assert source
     assert dest
     with cursor(dest) as dbc:
@@ -270,6 +341,8 @@ def update_with(source, dest, log=print):
 
 def create_index(mbt: DB, log=print):
     with cursor(mbt) as dbc:
+        if is_dedup(dbc):  # `map_index` is created with the layout
+            return
         # If no index, Ensure no duplicates in base file
         has_index, = dbc.execute("""
             SELECT COUNT(*) FROM sqlite_master
@@ -285,74 +358,105 @@ def create_index(mbt: DB, log=print):
 
 
 def mbt_merge(source, *more_sources:str, dest:str,
-              name='', description='', attrib='', bb:LLBb=None, zmin:int=0, zmax:int=0, log=print):
+              name='', description='', attrib='', bb:LLBb=None, zmin:int=0, zmax:int=0,
+              dedup:bool=None, log=print) -> dict[str, int]:
     """ Does a "real" merge, relying on [Upsert](https://www.sqlite.org/lang_UPSERT.html),
          which was added to SQLite with version 3.24.0 (2018-06-04).
         It relies on an index for the conflict detection,
          but at least `gdal` and *Atlas Creator* have none, so:
           * we deduplicate, keep *last*
           * we create the index as needed
+        Sources are attached together (by groups, up to SQLite's limit), and each one is merged
+         with a single indexed `INSERT ... SELECT`, restricted to `bb` and `zmin..zmax`.
         (!) Assumes same image format
-        (!) Later sources will take precedence on, overwrite and be "on top of" earlier ones
+        (!) Sources are in increasing priority: later sources will take precedence on,
+            overwrite and be "on top of" earlier ones, and of an existing `dest`
+        :param dedup: layout of a new `dest` (see `create_mbt`), by default that of `source`.
+          An existing `dest` keeps its own layout, whatever the sources'.
+        :return: number of tiles merged from each source
     """
+    source, dest = mbt_path(source), mbt_path(dest)
+    sources = (source, *map(mbt_path, more_sources))
     assert source
     assert dest.endswith('.mbtiles')
     new_mbt = not os.path.exists(dest)
+    copy_meta = False
     if new_mbt:
         name = name or dest[:-8]  # force a name
-        if bb:
-            cut_to_lnglat(source, bb=bb, dest=dest, zmin=zmin, zmax=zmax, log=log)
+        if bb or zmin or zmax:
+            if dedup is None:
+                with cursor(source) as dbc:
+                    dedup = is_dedup(dbc)
+            create_mbt(dest, dedup=dedup)
+            copy_meta = True
         else:
-            log(f'cp {source} {dest}')
-            shutil.copyfile(source, os.path.expanduser(dest))
-            log('<<>>', source[:-8], ':', mbt_info(source))
-    else:
-        more_sources = (source, *more_sources)
+            if dedup:
+                dedup_mbt(source, dest, log=log)
+            else:
+                log(f'cp {source} {dest}')
+                shutil.copyfile(source, os.path.expanduser(dest))
+            sources = sources[1:]
     db = sqlite3.connect(dest)
+    register_functions(db)
     dbc = db.cursor()
+    counts = {}
     try:
         create_index(dbc)
         meta = dict(dbc.execute('SELECT * FROM metadata').fetchall())
-        descm = f"Merge of the following files:\n* {meta['name']} : {meta.get('description', '')}\n"
-
-        mbtcut = os.path.join(tempfile.gettempdir(), 'tmp.mbtiles')
-        for source in more_sources:
-            log('<<', source[:-8], ':', mbt_info(source))
-            if bb:
-                cut_to_lnglat(source, bb=bb, dest=mbtcut, zmin=zmin, zmax=zmax,
-                              log=lambda *a, **k: None, overwrite=True)
-                source = mbtcut
-            # >> Merge tiles
-            where = ''
-            if zmin: where += 'zoom_level >= %s' % zmin
-            if zmax: where += 'zoom_level <= %s' % zmax
-            where = where or 'true'
-            dbc.executescript(f'''
-                ATTACH "{source}" AS source;
-                INSERT INTO main.tiles
-                    SELECT * FROM source.tiles WHERE {where}
-                    ON CONFLICT (zoom_level, tile_column, tile_row)
-                    DO UPDATE SET tile_data=excluded.tile_data;
-            ''')
-            # >> Merge description and bounds
-            smeta = dict(dbc.execute('SELECT * FROM source.metadata').fetchall())
-            meta.update(smeta)
-            if 'name' in smeta:
-                descm += f"* {smeta['name']} : {smeta.get('description','')}\n"
-
-            # >> Detach to make room for next source
-            dbc.execute(f'DETACH source;')
-            if bb: os.unlink(mbtcut)
-            log('>>', dest[:-8], ':', mbt_info(dbc))
+        descm = "Merge of the following files:\n"
+        if 'name' in meta:
+            descm += f"* {meta['name']} : {meta.get('description', '')}\n"
+
+        max_attached = db.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)
+        for g in range(0, len(sources), max_attached):
+            group = sources[g:g + max_attached]
+            for i, src in enumerate(group):
+                dbc.execute(f'ATTACH "{src}" AS source{i}')
+            for i, src in enumerate(group):
+                # >> Merge tiles
+                counts[src] = copy_tiles(dbc, f'source{i}', 'main', merge_where(dbc, f'source{i}', bb, zmin, zmax))
+                log('<<', src[:-8], ':', counts[src], 'tiles')
+                # >> Merge description and bounds
+                if copy_meta:
+                    dbc.execute(f'INSERT INTO main.metadata SELECT * FROM source{i}.metadata')
+                    copy_meta = False
+                smeta = dict(dbc.execute(f'SELECT * FROM source{i}.metadata').fetchall())
+                if 'name' in smeta:
+                    descm += f"* {smeta['name']} : {smeta.get('description','')}\n"
+            # >> Detach to make room for next sources
+            db.commit()
+            for i in range(len(group)):
+                dbc.execute(f'DETACH source{i};')
 
         set_real_bounds(dbc, log=log)
         if new_mbt:  # otherwise keep existing meta
             print('Created:', name)
             update_mbt_meta(dbc, name=name, desc=description or descm, attrib=attrib)
+        log('>>', dest[:-8], ':', sum(counts.values()), 'tiles merged')
     finally:
         dbc.close()
         db.commit()
         db.close()
+    return counts
+
+
+def merge_where(dbc: sqlite3.Cursor, dbn: str, bb:LLBb=None, zmin:int=0, zmax:int=0) -> str:
+    """SQL condition selecting the tiles of `dbn` within `bb` (border tiles included) and zoom levels,
+       as one (index-friendly) term per zoom level"""
+    zcond = ' AND '.join([f'zoom_level >= {zmin}'] * bool(zmin) + [f'zoom_level <= {zmax}'] * bool(zmax))
+    if not bb:
+        return zcond or 'true'
+    if not zmin or not zmax:
+        (zmindb, zmaxdb), = dbc.execute(f'SELECT min(zoom_level), max(zoom_level) FROM {dbn}.tiles')
+        if zmindb is None:
+            return 'false'
+        zmin, zmax = zmin or zmindb, zmax or zmaxdb
+    terms = []
+    for z in range(zmin, zmax + 1):
+        xwest, ysouth, xeast, ynorth = bbox2tms(z, bb)
+        terms.append(f'''(zoom_level = {z} AND tile_column BETWEEN {xwest} AND {xeast}
+                                           AND tile_row BETWEEN {ysouth} AND {ynorth})''')
+    return '\n OR '.join(terms) or 'false'
 
 # check that bounds merge work correctly
 
@@ -366,7 +470,10 @@ class TestMbt(TestCase):
                     LLBb(Decimal('6.768'), Decimal('44.088'), Decimal('7.734'), Decimal('46.012')))
 
 
-def create_mbt(dbc: DB, dbn:str='main'):
+def create_mbt(dbc: DB, dbn:str='main', dedup=False, stats=False):
+    """:param dedup: use the deduplicated layout: `map` of keys to `images` by content,
+          exposed as a `tiles` view (writable through triggers). See `DEDUP_SCHEMA`.
+       :param stats: maintain the `zoom_stats` table, see `create_stats`"""
     with cursor(dbc, create=True) as dbc:
         script = f'''
 
@@ -377,17 +484,304 @@ def create_mbt(dbc: DB, dbn:str='main'):
                 tile_data BLOB NOT NULL,
                 UNIQUE (zoom_level, tile_column, tile_row)
             );
-
+            CREATE UNIQUE INDEX IF NOT EXISTS {dbn}.zxy ON tiles (zoom_level, tile_column, tile_row);
+        ''' if not dedup else DEDUP_SCHEMA.format(dbn=dbn)
+        script += f'''
             CREATE TABLE IF NOT EXISTS {dbn}.metadata (
                 name TEXT,
                 value TEXT
             );
 
-            CREATE UNIQUE INDEX IF NOT EXISTS {dbn}.zxy ON tiles (zoom_level, tile_column, tile_row);
             CREATE UNIQUE INDEX IF NOT EXISTS {dbn}.meta ON metadata (name);
 
         '''
         dbc.executescript(script)
+        if stats:
+            create_stats(dbc, dbn, log=lambda *a: None)
+
+
+# Same table names as `mbutil`. Every write (helpers here, or the triggers) first looks the image
+# up by content, through the `images_length` index, so each blob is stored once whatever the path.
+# New images get `tile_hash(tile_data)` as `tile_id` from the helpers, a random key of the same
+# shape from the triggers. Triggers on `map` drop images no longer referenced, and those on the
+# `tiles` view let the usual INSERT (without upsert)/UPDATE/DELETE work unchanged, with SQL
+# built-ins only (for GDAL, the sqlite3 CLI, ...).
+DEDUP_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS {dbn}.map (
+        zoom_level INTEGER NOT NULL,
+        tile_column INTEGER NOT NULL,
+        tile_row INTEGER NOT NULL,
+        tile_id TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS {dbn}.images (
+        tile_data BLOB NOT NULL,
+        tile_id TEXT NOT NULL
+    );
+    CREATE UNIQUE INDEX IF NOT EXISTS {dbn}.map_index ON map (zoom_level, tile_column, tile_row);
+    CREATE INDEX IF NOT EXISTS {dbn}.map_tile_id ON map (tile_id);
+    CREATE UNIQUE INDEX IF NOT EXISTS {dbn}.images_id ON images (tile_id);
+    CREATE INDEX IF NOT EXISTS {dbn}.images_length ON images (length(tile_data));
+
+    CREATE VIEW IF NOT EXISTS {dbn}.tiles AS
+        SELECT map.zoom_level AS zoom_level, map.tile_column AS tile_column,
+               map.tile_row AS tile_row, images.tile_data AS tile_data
+        FROM map JOIN images ON images.tile_id = map.tile_id;
+
+    CREATE TRIGGER IF NOT EXISTS {dbn}.map_gc_update AFTER UPDATE OF tile_id ON map
+    WHEN OLD.tile_id != NEW.tile_id BEGIN
+        DELETE FROM images WHERE tile_id = OLD.tile_id
+            AND NOT EXISTS (SELECT 1 FROM map WHERE tile_id = OLD.tile_id);
+    END;
+    CREATE TRIGGER IF NOT EXISTS {dbn}.map_gc_delete AFTER DELETE ON map BEGIN
+        DELETE FROM images WHERE tile_id = OLD.tile_id
+            AND NOT EXISTS (SELECT 1 FROM map WHERE tile_id = OLD.tile_id);
+    END;
+
+    DROP TRIGGER IF EXISTS {dbn}.tiles_insert;
+    CREATE TRIGGER {dbn}.tiles_insert INSTEAD OF INSERT ON tiles BEGIN
+        INSERT INTO images (tile_id, tile_data)
+            SELECT lower(hex(randomblob(16))), NEW.tile_data WHERE NOT EXISTS (SELECT 1 FROM images
+                WHERE length(tile_data) = length(NEW.tile_data) AND tile_data = NEW.tile_data);
+        INSERT INTO map (zoom_level, tile_column, tile_row, tile_id)
+            VALUES (NEW.zoom_level, NEW.tile_column, NEW.tile_row, (SELECT tile_id FROM images
+                WHERE length(tile_data) = length(NEW.tile_data) AND tile_data = NEW.tile_data))
+            ON CONFLICT (zoom_level, tile_column, tile_row) DO UPDATE SET tile_id=excluded.tile_id;
+    END;
+    DROP TRIGGER IF EXISTS {dbn}.tiles_update;
+    CREATE TRIGGER {dbn}.tiles_update INSTEAD OF UPDATE OF tile_data ON tiles BEGIN
+        INSERT INTO images (tile_id, tile_data)
+            SELECT lower(hex(randomblob(16))), NEW.tile_data WHERE NOT EXISTS (SELECT 1 FROM images
+                WHERE length(tile_data) = length(NEW.tile_data) AND tile_data = NEW.tile_data);
+        UPDATE map SET tile_id = (SELECT tile_id FROM images
+                WHERE length(tile_data) = length(NEW.tile_data) AND tile_data = NEW.tile_data)
+            WHERE zoom_level = OLD.zoom_level AND tile_column = OLD.tile_column AND tile_row = OLD.tile_row;
+    END;
+    CREATE TRIGGER IF NOT EXISTS {dbn}.tiles_delete INSTEAD OF DELETE ON tiles BEGIN
+        DELETE FROM map
+            WHERE zoom_level = OLD.zoom_level AND tile_column = OLD.tile_column AND tile_row = OLD.tile_row;
+    END;
+'''
+
+
+def tile_hash(tile_data: bytes) -> str:
+    """Content key of the deduplicated layout (md5 hex, like `mbutil`)"""
+    return hashlib.md5(tile_data).hexdigest()
+
+
+def register_functions(db: sqlite3.Connection):
+    """SQL functions needed by the deduplicated layout"""
+    db.create_function('tile_hash', 1, tile_hash, deterministic=True)
+
+
+def _image_id(dbn: str, data: str) -> str:
+    """SQL subquery for the `tile_id` of the image of content `data` in the deduplicated layout"""
+    return f'''(SELECT tile_id FROM {dbn}.images
+              WHERE length(tile_data) = length({data}) AND tile_data = {data})'''
+
+
+def is_dedup(dbc: sqlite3.Cursor, dbn='main') -> bool:
+    n, = dbc.execute(f"SELECT COUNT(*) FROM {dbn}.sqlite_master WHERE type='view' AND name='tiles'").fetchone()
+    return bool(n)
+
+
+def copy_tiles(dbc: sqlite3.Cursor, src='source', dest='main', where='true') -> int:
+    """`INSERT ... SELECT` the tiles matching `where` from the `src` db to the `dest` db
+       (both attached to `dbc`), overwriting existing ones, whatever the layout on each side.
+       :return: number of tiles copied"""
+    if not is_dedup(dbc, dest):
+        dbc.execute(f'''
+            INSERT INTO {dest}.tiles (zoom_level, tile_column, tile_row, tile_data)
+            SELECT zoom_level, tile_column, tile_row, tile_data FROM {src}.tiles WHERE {where}
+            ON CONFLICT (zoom_level, tile_column, tile_row) DO UPDATE SET tile_data=excluded.tile_data''')
+        return dbc.rowcount
+    if is_dedup(dbc, src):  # no need to hash again
+        images = f'''SELECT tile_id, tile_data FROM {src}.images
+                     WHERE tile_id IN (SELECT tile_id FROM {src}.map WHERE {where})'''
+    else:
+        images = f'SELECT tile_hash(tile_data), tile_data FROM {src}.tiles WHERE {where}'
+    # the select is evaluated before inserting: same blobs within `src` are ignored by `tile_id`
+    dbc.execute(f'''
+        INSERT OR IGNORE INTO {dest}.images (tile_id, tile_data)
+        SELECT * FROM ({images}) new WHERE {_image_id(dest, 'new.tile_data')} IS NULL''')
+    dbc.execute(f'''
+        INSERT INTO {dest}.map (zoom_level, tile_column, tile_row, tile_id)
+        SELECT zoom_level, tile_column, tile_row, {_image_id(dest, 'src.tile_data')}
+        FROM {src}.tiles src WHERE {where}
+        ON CONFLICT (zoom_level, tile_column, tile_row) DO UPDATE SET tile_id=excluded.tile_id''')
+    return dbc.rowcount
+
+
+def dedup_report(sqlite_or_path: DB, dbn='main', log=print) -> dict:
+    """Tiles, distinct images, and bytes saved by deduplication (or that it would save)"""
+    with cursor(sqlite_or_path) as dbc:
+        if is_dedup(dbc, dbn):
+            n, size = dbc.execute(f'''SELECT COUNT(*), SUM(LENGTH(tile_data))
+                                      FROM {dbn}.map JOIN {dbn}.images USING (tile_id)''').fetchone()
+            nuniq, usize = dbc.execute(f'SELECT COUNT(*), SUM(LENGTH(tile_data)) FROM {dbn}.images').fetchone()
+        else:
+            (n, size), = dbc.execute(f'SELECT COUNT(*), SUM(LENGTH(tile_data)) FROM {dbn}.tiles')
+            nuniq, usize = dbc.execute(f'''SELECT COUNT(*), SUM(l) FROM (
+                SELECT MAX(LENGTH(tile_data)) l FROM {dbn}.tiles GROUP BY tile_hash(tile_data))''').fetchone()
+        res = dict(tiles=n, images=nuniq, bytes=size or 0, unique_bytes=usize or 0,
+                   saved_bytes=(size or 0) - (usize or 0))
+        log(f"{n} tiles -> {nuniq} images: {res['saved_bytes'] / 2**20:.1f} MB saved "
+            f"of {res['bytes'] / 2**20:.1f} MB")
+        return res
+
+
+def dedup_mbt(source: str, dest: str='', overwrite=False, log=print) -> dict:
+    """Convert `source` to the deduplicated layout (into `dest`, or in place with a backup)"""
+    source, dest = validate_src_dst(source, dest or source, overwrite)
+    create_mbt(dest, dedup=True)
+    with cursor(dest) as dbc:
+        dbc.execute(f'ATTACH "{source}" AS source')
+        copy_tiles(dbc, 'source', 'main')
+        dbc.execute('INSERT INTO main.metadata SELECT * FROM source.metadata')
+        dbc.connection.commit()
+        dbc.execute('DETACH source')
+        report = dedup_report(dbc, log=log)
+    log(f'{source}: {os.path.getsize(source) >> 20} MB -> {dest}: {os.path.getsize(dest) >> 20} MB')
+    return report
+
+
+# Per-zoom extent, count and bytes, kept current by triggers on the table holding the keys
+# (so also for writes by other tools, eg gdal). Deleting a tile on the extent border only
+# marks the zoom `stale`: readers then scan that zoom's tiles, until the write helpers here
+# (or `refresh_stats`) recompute its extent.
+# INSERT OR REPLACE (common in other tools) deletes the previous row without firing the DELETE
+# trigger: `zoom_stats_replace` remembers that row in `zoom_stats_replaced`, for the INSERT trigger
+# to discount it. Upserts (DO UPDATE) go through the UPDATE trigger, which forgets it.
+STATS_TRIGGERS = ('insert', 'replace', 'update', 'delete')
+STATS_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS {dbn}.zoom_stats (
+        zoom_level INTEGER PRIMARY KEY,
+        min_column INTEGER NOT NULL, max_column INTEGER NOT NULL,
+        min_row INTEGER NOT NULL, max_row INTEGER NOT NULL,
+        tiles INTEGER NOT NULL, bytes INTEGER NOT NULL,
+        stale INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE TABLE IF NOT EXISTS {dbn}.zoom_stats_replaced (
+        zoom_level INTEGER NOT NULL, tile_column INTEGER NOT NULL, tile_row INTEGER NOT NULL,
+        bytes INTEGER NOT NULL,
+        PRIMARY KEY (zoom_level, tile_column, tile_row)
+    ) WITHOUT ROWID;
+    CREATE TRIGGER IF NOT EXISTS {dbn}.zoom_stats_replace BEFORE INSERT ON {table}
+    WHEN EXISTS (SELECT 1 FROM {table} WHERE {new_key}) BEGIN
+        INSERT OR REPLACE INTO zoom_stats_replaced (zoom_level, tile_column, tile_row, bytes)
+        VALUES (NEW.zoom_level, NEW.tile_column, NEW.tile_row, {key_bytes});
+    END;
+    CREATE TRIGGER IF NOT EXISTS {dbn}.zoom_stats_insert AFTER INSERT ON {table} BEGIN
+        INSERT INTO zoom_stats (zoom_level, min_column, max_column, min_row, max_row, tiles, bytes)
+        VALUES (NEW.zoom_level, NEW.tile_column, NEW.tile_column, NEW.tile_row, NEW.tile_row, 1, {new_bytes})
+        ON CONFLICT (zoom_level) DO UPDATE SET
+            min_column = MIN(min_column, excluded.min_column), max_column = MAX(max_column, excluded.max_column),
+            min_row = MIN(min_row, excluded.min_row), max_row = MAX(max_row, excluded.max_row),
+            tiles = tiles + 1, bytes = bytes + excluded.bytes;
+        UPDATE zoom_stats SET tiles = tiles - 1,
+            bytes = bytes - (SELECT bytes FROM zoom_stats_replaced WHERE {new_key})
+        WHERE zoom_level = NEW.zoom_level AND EXISTS (SELECT 1 FROM zoom_stats_replaced WHERE {new_key});
+        DELETE FROM zoom_stats_replaced WHERE {new_key};
+    END;
+    CREATE TRIGGER IF NOT EXISTS {dbn}.zoom_stats_update BEFORE UPDATE OF {data} ON {table} BEGIN
+        UPDATE zoom_stats SET bytes = bytes - {old_bytes} + {new_bytes} WHERE zoom_level = NEW.zoom_level;
+        DELETE FROM zoom_stats_replaced WHERE {new_key};
+    END;
+    CREATE TRIGGER IF NOT EXISTS {dbn}.zoom_stats_delete BEFORE DELETE ON {table} BEGIN
+        UPDATE zoom_stats SET tiles = tiles - 1, bytes = bytes - {old_bytes},
+            stale = stale OR OLD.tile_column IN (min_column, max_column) OR OLD.tile_row IN (min_row, max_row)
+        WHERE zoom_level = OLD.zoom_level;
+        DELETE FROM zoom_stats WHERE zoom_level = OLD.zoom_level AND tiles = 0;
+        DELETE FROM zoom_stats_replaced
+        WHERE zoom_level = OLD.zoom_level AND tile_column = OLD.tile_column AND tile_row = OLD.tile_row;
+    END;
+'''
+
+def has_stats(dbc: sqlite3.Cursor, dbn='main') -> bool:
+    n, = dbc.execute(f"SELECT COUNT(*) FROM {dbn}.sqlite_master WHERE type='table' AND name='zoom_stats'").fetchone()
+    return bool(n)
+
+
+def create_stats(sqlite_or_path: DB, dbn='main', log=print):
+    """Add (or rebuild) the `zoom_stats` table, and the triggers maintaining it.
+       `real_bounds`, `mbt_info`, `tile_count`... then answer without scanning the tiles."""
+    new_key = 'zoom_level = NEW.zoom_level AND tile_column = NEW.tile_column AND tile_row = NEW.tile_row'
+    with cursor(sqlite_or_path) as dbc:
+        if is_dedup(dbc, dbn):
+            fmt = dict(table='map', data='tile_id',
+                       new_bytes='(SELECT LENGTH(tile_data) FROM images WHERE tile_id = NEW.tile_id)',
+                       old_bytes='(SELECT LENGTH(tile_data) FROM images WHERE tile_id = OLD.tile_id)',
+                       key_bytes=f'''(SELECT LENGTH(tile_data) FROM images
+                                     WHERE tile_id = (SELECT tile_id FROM map WHERE {new_key}))''')
+        else:
+            fmt = dict(table='tiles', data='tile_data',
+                       new_bytes='LENGTH(NEW.tile_data)', old_bytes='LENGTH(OLD.tile_data)',
+                       key_bytes=f'(SELECT LENGTH(tile_data) FROM tiles WHERE {new_key})')
+        for trigger in STATS_TRIGGERS:  # rebuilt too, eg for dbs created by an older version
+            dbc.execute(f'DROP TRIGGER IF EXISTS {dbn}.zoom_stats_{trigger}')
+        dbc.executescript(STATS_SCHEMA.format(dbn=dbn, new_key=new_key, **fmt))
+        dbc.execute(f'DELETE FROM {dbn}.zoom_stats_replaced')
+        dbc.execute(f'DELETE FROM {dbn}.zoom_stats')
+        dbc.execute(f'''
+            INSERT INTO {dbn}.zoom_stats (zoom_level, min_column, max_column, min_row, max_row, tiles, bytes)
+            SELECT zoom_level, MIN(tile_column), MAX(tile_column), MIN(tile_row), MAX(tile_row),
+                   COUNT(*), SUM(LENGTH(tile_data))
+            FROM {dbn}.tiles GROUP BY zoom_level''')
+        log(f'zoom_stats: {dbc.rowcount} zoom levels')
+
+
+def drop_stats(sqlite_or_path: DB, dbn='main'):
+    with cursor(sqlite_or_path) as dbc:
+        for trigger in STATS_TRIGGERS:
+            dbc.execute(f'DROP TRIGGER IF EXISTS {dbn}.zoom_stats_{trigger}')
+        dbc.execute(f'DROP TABLE IF EXISTS {dbn}.zoom_stats_replaced')
+        dbc.execute(f'DROP TABLE IF EXISTS {dbn}.zoom_stats')
+
+
+def refresh_stats(sqlite_or_path: DB, dbn='main'):
+    """Recompute the extent of the `stale` zoom levels of `zoom_stats`, if the db has it"""
+    with cursor(sqlite_or_path) as dbc:
+        if has_stats(dbc, dbn):
+            dbc.execute(f'''
+                UPDATE {dbn}.zoom_stats SET (min_column, max_column, min_row, max_row, stale) =
+                    (SELECT MIN(tile_column), MAX(tile_column), MIN(tile_row), MAX(tile_row), 0
+                     FROM {dbn}.tiles WHERE tiles.zoom_level = zoom_stats.zoom_level)
+                WHERE stale''')
+
+
+def verify_stats(sqlite_or_path: DB, dbn='main', log=print) -> dict:
+    """Compare `zoom_stats` with a full scan, eg for files modified by tools ignoring triggers.
+       :return: {z: (stored, actual)} for zoom levels which differ"""
+    with cursor(sqlite_or_path) as dbc:
+        refresh_stats(dbc, dbn)
+        stored = {row[0]: row[1:] for row in dbc.execute(f'''
+            SELECT zoom_level, min_column, max_column, min_row, max_row, tiles, bytes FROM {dbn}.zoom_stats''')}
+        actual = {row[0]: row[1:] for row in dbc.execute(f'''
+            SELECT zoom_level, MIN(tile_column), MAX(tile_column), MIN(tile_row), MAX(tile_row),
+                   COUNT(*), SUM(LENGTH(tile_data))
+            FROM {dbn}.tiles GROUP BY zoom_level''')}
+        diff = {z: (stored.get(z), actual.get(z)) for z in stored.keys() | actual.keys()
+                if stored.get(z) != actual.get(z)}
+        log('zoom_stats:', 'OK' if not diff else f'differs: {diff}')
+        return diff
+
+
+def _extents_query(dbc: sqlite3.Cursor, dbn='main') -> str:
+    """SQL subquery for (z, x1w, x2e, y1s, y2n) per zoom level: from `zoom_stats` if the db has it,
+       scanning only the tiles of its `stale` zoom levels, else from a full scan. Read only."""
+    scan = f'''SELECT zoom_level z, MIN(tile_column) x1w, MAX(tile_column) x2e, MIN(tile_row) y1s, MAX(tile_row) y2n
+               FROM {dbn}.tiles'''
+    if not has_stats(dbc, dbn):
+        return f'{scan} GROUP BY zoom_level'
+    return f'''SELECT zoom_level z, min_column x1w, max_column x2e, min_row y1s, max_row y2n
+               FROM {dbn}.zoom_stats WHERE NOT stale
+               UNION ALL
+               {scan} WHERE zoom_level IN (SELECT zoom_level FROM {dbn}.zoom_stats WHERE stale)
+               GROUP BY zoom_level'''
+
+
+def zoom_extents(dbc: sqlite3.Cursor, dbn='main') -> list[tuple[int, int, int, int, int]]:
+    """(z, x1w, x2e, y1s, y2n) per zoom level, see `_extents_query`"""
+    return dbc.execute(f'SELECT * FROM ({_extents_query(dbc, dbn)}) ORDER BY z').fetchall()
 
 
 def transfer_metadata(dbc: sqlite3.Cursor):
@@ -433,6 +827,17 @@ def insert_tiles(sqlite_or_path, rows: 'List[Tuple[int, int, int, bytes]]', dbn=
     # y = (1 << z) - y - 1
     if rows:
         with cursor(sqlite_or_path) as dbc:
+            if is_dedup(dbc, dbn):
+                dbc.executemany(f'''
+                    INSERT OR IGNORE INTO {dbn}.images (tile_id, tile_data)
+                    SELECT ?1, ?2 WHERE {_image_id(dbn, '?2')} IS NULL''',
+                    [(tile_hash(im), im) for *_, im in rows])
+                dbc.executemany(f'''
+                    INSERT INTO {dbn}.map (zoom_level, tile_column, tile_row, tile_id)
+                    VALUES (?1, ?2, ?3, {_image_id(dbn, '?4')})
+                    ON CONFLICT (zoom_level, tile_column, tile_row)
+                    DO UPDATE SET tile_id=excluded.tile_id ''', rows)
+                return
             dbc.executemany(f'''
                 INSERT INTO {dbn}.tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?,?,?,?)
                 ON CONFLICT (zoom_level, tile_column, tile_row)
@@ -455,6 +860,7 @@ def remove_tiles(dbc, zxys: 'List[Tuple[int, int, int]]'):
         dbc.executemany(f'''
             DELETE FROM tiles WHERE
              zoom_level=? AND tile_column=? AND tile_row=?''', zxys)
+        refresh_stats(dbc)
 
 
 def sample_tile(mbt_or_cur: DB):
@@ -475,47 +881,36 @@ def num2tile(sqlite_or_path: DB, z:int, x:int, y:int, flip_y:bool, what='tile_da
         return (row[0] if len(row) == 1 else row) if row else None
 
 
-def xyz2tile(dbc, t: 'T.Tile', flip_y=True, **kw):
+def xyz2tile(dbc, t: Tile, flip_y=True, **kw):
     # Mercantile uses TXYZ but MBTiles use TMS -> flip
     return num2tile(dbc, t.z, t.x, t.y, flip_y=flip_y, **kw)
 
 
 def lnglat2tile(dbc:'sqlite3.Cursor|str', z, *, lng:float, lat: float, **kw):
-    """Wrapper for mercantile as it uses XYZ while MBTiles uses TMS
-       It also does not support Decimal"""
-    x, y, z = T.tile(lng, lat, z)
-    return num2tile(dbc, z, x, y, flip_y=True, **kw)
+    """Tile data at a point (see `tile_util`, which also takes Decimals)"""
+    _, x, y = lnglat2tms(z, lng=lng, lat=lat)
+    return num2tile(dbc, z, x, y, flip_y=False, **kw)
 
 
 def lnglat2tms(z, *, lng, lat):
-    x, y, z = T.tile(lng, lat, z)
-    y = (1 << z) - y - 1
-    return z, x, y
-
-# def tms2lnglat(z, *, lng, lat):
-#     n = 2 ^ zoom
-#     lon_deg = xtile / n * 360.0 - 180.0
-#     lat_rad = arctan(sinh(π * (1 - 2 * ytile / n)))
-#     lat_deg = lat_rad * 180.0 / π
-
-# import math
-# def lnglat2tms(lng, lat, z):
-#   lat_rad = math.radians(lat)
-#   n = 2.0 ** z
-#   x = ((lng + 180.0) / 360.0 * n)
-#   y = int(n * (1.0 - math.asinh(math.tan(lat_rad)) / math.pi) / 2.0)
-#   y = (1 << z) - y - 1
-#   return z, x, y
-
-# def num2deg(xtile, ytile, zoom):
-#   n = 2.0 ** zoom
-#   lon_deg = xtile / n * 360.0 - 180.0
-#   lat_rad = math.atan(math.sinh(math.pi * (1 - 2 * ytile / n)))
-#   lat_deg = math.degrees(lat_rad)
-#   return (lat_deg, lon_deg)
-
-
-def get_all_tiles(sqlite_or_path: DB, q='', arraysize=1000): # <- ~30MB RAM
+    x, y = tms_tiles(float(lng), float(lat), z)
+    return z, int(x), int(y)
+
+
+def bbox2tms(z, bb: LLBb, epsilon=0.1**5) -> tuple[int, int, int, int]:
+    """West, south, east, north TMS tile ranges of the tiles intersecting `bb` (border *included*).
+       `epsilon` avoids including a whole row/column for a bb snapped on tiles, it is around 1 pixel at z16"""
+    return tuple(map(int, bbox_tms(z, *bb, epsilon)))
+
+
+def get_all_tiles(sqlite_or_path: DB, q='', arraysize=1000,  # <- ~30MB RAM
+                  max_bytes=0, after=None, zero_copy=False):
+    """Iterate over (z, x, y, tile_data).
+       With `max_bytes`, switch to `stream_tiles`: `q` must then be a bare `WHERE` clause."""
+    if max_bytes:
+        yield from stream_tiles(sqlite_or_path, where=_bare_where(q), after=after,
+                                max_bytes=max_bytes, zero_copy=zero_copy)
+        return
     with cursor(sqlite_or_path) as dbc:
         dbc.execute('SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles ' + q)
         while rows:= dbc.fetchmany(arraysize):
@@ -523,7 +918,15 @@ def get_all_tiles(sqlite_or_path: DB, q='', arraysize=1000): # <- ~30MB RAM
                 yield row
 
 
-def get_all_coords(sqlite_or_path: DB, q='', arraysize=1000, dbn='main'): # <- ~30MB RAM
+def get_all_coords(sqlite_or_path: DB, q='', arraysize=1000, dbn='main',  # <- ~30MB RAM
+                   max_bytes=0, after=None):
+    """Iterate over (z, x, y). `max_bytes`: see `get_all_tiles`"""
+    if max_bytes:
+        with cursor(sqlite_or_path) as dbc:
+            for rows in keyset_pages(dbc, 'zoom_level, tile_column, tile_row', where=_bare_where(q),
+                                     after=after, max_bytes=max_bytes, dbn=dbn):
+                yield from rows
+        return
     with cursor(sqlite_or_path) as dbc:
         dbc.execute(f'SELECT zoom_level, tile_column, tile_row FROM {dbn}.tiles {q}')
         while rows:= dbc.fetchmany(arraysize):
@@ -531,7 +934,67 @@ def get_all_coords(sqlite_or_path: DB, q='', arraysize=1000, dbn='main'): # <- ~
                 yield row
 
 
+def _bare_where(q: str):
+    q = q.strip()
+    assert not q or q[:5].upper() == 'WHERE', f'expected a bare WHERE clause, got: {q}'
+    assert not any(kw in q.upper() for kw in ('LIMIT', 'ORDER BY')), 'paginated query can not LIMIT/ORDER'
+    return q[5:]
+
+
+ROW_OVERHEAD = 150  # bytes of python objects per (z, x, y, ...) row, on top of the blob
+
+def keyset_pages(dbc: sqlite3.Cursor, cols: str, where='', after=None,
+                 max_bytes=32 << 20, dbn='main'):
+    """Yield pages (lists) of `cols` rows from `tiles`, in (z, x, y) order, each roughly
+       under `max_bytes`.
+       Pages are fetched entirely and the next one starts after the last (z, x, y) key seen,
+       so no statement (nor read lock) is held between pages: the caller can write
+       to the same db meanwhile, and a scan can be resumed with `after=(z, x, y)`.
+       Page length adapts to the average row size seen so far (the last column is
+       measured if it is a blob), growing at most 2x per page.
+       Relies on the `zxy` unique index (see `create_index`) for both filtering and order.
+    """
+    assert cols.startswith('zoom_level, tile_column, tile_row')
+    cond = f'({where})' if where and where.strip() else 'true'
+    limit = 16
+    while True:
+        if after:
+            rows = dbc.execute(f'''
+                SELECT {cols} FROM {dbn}.tiles
+                WHERE {cond} AND (zoom_level, tile_column, tile_row) > (?, ?, ?)
+                ORDER BY zoom_level, tile_column, tile_row LIMIT ?''', (*after, limit)).fetchall()
+        else:
+            rows = dbc.execute(f'''
+                SELECT {cols} FROM {dbn}.tiles WHERE {cond}
+                ORDER BY zoom_level, tile_column, tile_row LIMIT ?''', (limit,)).fetchall()
+        if not rows:
+            return
+        yield rows
+        if len(rows) < limit:
+            return
+        after = rows[-1][:3]
+        size = sum(len(r[-1]) if isinstance(r[-1], bytes) else 0 for r in rows) + ROW_OVERHEAD * len(rows)
+        limit = max(1, min(2 * limit, max_bytes * len(rows) // size))
+
+
+def stream_tiles(sqlite_or_path: DB, where='', after=None, max_bytes=32 << 20,
+                 zero_copy=False, dbn='main'):
+    """Like `get_all_tiles`, but memory is bounded by `max_bytes` rather than a row count,
+       and the scan does not keep a SELECT open. See `keyset_pages`.
+       :param where: SQL condition on the `tiles` columns (without the `WHERE`)
+       :param after: (z, x, y) key to resume from (excluded)
+       :param zero_copy: yield `memoryview`s on the fetched blobs, so slicing does not copy"""
+    with cursor(sqlite_or_path) as dbc:
+        for rows in keyset_pages(dbc, 'zoom_level, tile_column, tile_row, tile_data',
+                                 where=where, after=after, max_bytes=max_bytes, dbn=dbn):
+            if zero_copy:
+                rows = [(z, x, y, memoryview(im)) for z, x, y, im in rows]
+            yield from rows
+
+
 def tile_count(dbc: sqlite3.Cursor, dbn='main', q=''):
+    if not q and has_stats(dbc, dbn):
+        return int(dbc.execute(f'SELECT TOTAL(tiles) FROM {dbn}.zoom_stats').fetchone()[0])
     return int(dbc.execute(f'SELECT COUNT(*) FROM {dbn}.tiles {q}').fetchone()[0])
 
 
@@ -541,6 +1004,7 @@ def validate_src_dst(source, dest, overwrite=False, fun_inplace=False):
        * handle source==dest by moving source
        * fun_inplace: True for functions which can operate with source==dest
     """
+    source, dest = mbt_path(source), mbt_path(dest)
     dest = dest or source
     assert dest.endswith('.mbtiles') or dest.endswith('.mbt')
     if os.path.exists(dest):
@@ -559,8 +1023,47 @@ def validate_src_dst(source, dest, overwrite=False, fun_inplace=False):
     return source, dest
 
 
+_worker_fun = None
+
+def _init_apply_worker(fun):
+    global _worker_fun
+    _worker_fun = fun
+
+def _apply_batch(rows, fun=None):
+    """rows: list of (z, x, y, im) -> list of (new_im, z, x, y), ready for `update_tiles`"""
+    fun = fun or _worker_fun
+    return [(fun(z, x, y, im), z, x, y) for z, x, y, im in rows]
+
+
+def iter_tile_batches(dbc: sqlite3.Cursor, z: int, batch: int, dbname='main'):
+    """Yield lists of (z, x, y, im) in rowid order, `batch` tiles at a time.
+       Each batch is fully fetched before being yielded so no SELECT stays open
+       while the caller writes to the same connection."""
+    if is_dedup(dbc, dbname):  # a view has no rowid: use that of `map`
+        table, rowid = f'{dbname}.map JOIN {dbname}.images USING (tile_id)', 'map.rowid'
+    else:
+        table, rowid = f'{dbname}.tiles', 'rowid'
+    last = -1
+    while True:
+        rows = dbc.execute(f'''
+            SELECT {rowid}, zoom_level, tile_column, tile_row, tile_data FROM {table}
+            WHERE zoom_level = ? AND {rowid} > ? ORDER BY {rowid} LIMIT ?''', (z, last, batch)).fetchall()
+        if not rows:
+            return
+        last = rows[-1][0]
+        yield [row[1:] for row in rows]
+
+
 def apply_to_tiles(source: str, dest: str, fun, zooms: list[int]=[],
-                   dbname='main', overwrite=False, log=print):
+                   dbname='main', overwrite=False, processes=1, batch=256, log=print):
+    """Replace every tile by `fun(z, x, y, tile_data)`, zoom level by zoom level.
+       :param processes: if > 1, `fun` runs on a pool of worker processes
+          (so it must be picklable, ie a module-level function).
+          Tiles are sent in rowid-ordered batches, and at most `2*processes` batches are
+          in flight, so memory stays bounded. Results are written back in order, by this
+          process only, one `executemany` transaction per batch.
+       :param batch: number of tiles per batch / transaction
+    """
     assert dest and dest != source
     source, dest = validate_src_dst(source, dest, overwrite)
     if dest != source:
@@ -569,23 +1072,37 @@ def apply_to_tiles(source: str, dest: str, fun, zooms: list[int]=[],
         shutil.copyfile(source, dest)
     log('<<>>', source[:-8], ':', mbt_info(source))
     n = 0
-    with cursor(dest) as dbc:
-        if not zooms:
-            (zmin, zmax), = dbc.execute('SELECT min(zoom_level), max(zoom_level) FROM main.tiles')
-            zooms = list(range(zmin, zmax+1))
-        for z in zooms:
-            it = get_all_tiles(dbc, q=f'WHERE zoom_level = {z}')
-            # OPTIM could do batches of ~100, insert with executemany
-            for zoom_level, tile_column, tile_row, tile_data in it:
-                n += 1
-                new_data = fun(zoom_level, tile_column, tile_row, tile_data)
-                q = f'''UPDATE {dbname}.tiles SET tile_data = ?
-                        WHERE zoom_level=? AND tile_column=? AND tile_row=?  '''
-                dbc.execute(q, (new_data, zoom_level, tile_column, tile_row))
+    pool = None
+    inflight = deque()
+
+    def write_oldest():
+        rows = inflight.popleft().get() if pool else inflight.popleft()
+        update_tiles(dbc, rows, dbname=dbname)
+        dbc.connection.commit()
+        return len(rows)
+
+    try:  # the pool is terminated whatever fails, incl. opening `dest`
+        pool = Pool(processes, initializer=_init_apply_worker, initargs=(fun,)) if processes > 1 else None
+        with cursor(dest) as dbc:
+            if not zooms:
+                (zmin, zmax), = dbc.execute(f'SELECT min(zoom_level), max(zoom_level) FROM {dbname}.tiles')
+                zooms = list(range(zmin, zmax+1))
+            for z in zooms:
+                for rows in iter_tile_batches(dbc, z, batch, dbname=dbname):
+                    inflight.append(pool.apply_async(_apply_batch, (rows,)) if pool
+                                    else _apply_batch(rows, fun))
+                    if len(inflight) >= 2 * processes:
+                        n += write_oldest()
+                while inflight:
+                    n += write_oldest()
+    finally:
+        if pool:
+            pool.terminate()
     log(f"Changed {n} tiles")
 
 
 def cut_zoom(source: str, zooms: list[int], dest: str='', overwrite=False):
+    source, dest = mbt_path(source), mbt_path(dest)
     assert source.endswith('.mbtiles')
     assert not dest or dest.endswith('.mbtiles')
     if not dest:
@@ -596,7 +1113,6 @@ def cut_zoom(source: str, zooms: list[int], dest: str='', overwrite=False):
     create_mbt(dest)
     with cursor(source) as dbc:
         dbc.execute(f'ATTACH "{dest}" AS dest;')
-        nprev = 0
         for z in zooms:
             q = f'''
                 INSERT INTO dest.tiles (zoom_level, tile_column, tile_row, tile_data)
@@ -605,26 +1121,28 @@ def cut_zoom(source: str, zooms: list[int], dest: str='', overwrite=False):
                 WHERE zoom_level = {z}
                 '''
             dbc.execute(q)
-            n, = dbc.execute('SELECT COUNT(*) FROM dest.tiles')
-            print('z', z, ':', n[0] - nprev)
-            nprev = n[0]
+            print('z', z, ':', dbc.rowcount)
         transfer_metadata(dbc)
         set_real_bounds(dbc, dbn='dest')
     return dest
 
 
 def cut_to_lnglat(source: str, bb: LLBb, dest: str='', zmin=None, zmax=None,
-                  dbn='main', overwrite=False, log=print):
+                  dbn='main', overwrite=False, dedup:bool=None, log=print):
     """Cut MBTiles to given box, *including* tiles containing the border
+    :param dedup: layout of `dest` (see `create_mbt`), by default that of `source`
     TODO use bbox.snap_to_xyz instead of duplicating functionality?"""
     source, dest = validate_src_dst(source, dest, overwrite, fun_inplace=False)
     log(mbt_info(source))
     log('cut_to_lnglat', source, '->', dest)
-    create_mbt(dest)
+    if dedup is None:
+        with cursor(source) as dbc:
+            dedup = is_dedup(dbc, dbn)
+    create_mbt(dest, dedup=dedup)
     epsilon = 0.1**5 # around 1 pixel at z16
     with cursor(source) as dbc:
         dbc.execute(f'ATTACH "{dest}" AS dest;')
-        nprev = 0
+        extents = {z: ext for z, *ext in zoom_extents(dbc, dbn)}
 
         if not zmin or not zmax:
             (zmindb, zmaxdb), = dbc.execute(f'SELECT min(zoom_level), max(zoom_level) FROM {dbn}.tiles')
@@ -632,16 +1150,11 @@ def cut_to_lnglat(source: str, bb: LLBb, dest: str='', zmin=None, zmax=None,
             zmax = zmax or zmaxdb
             print(zmin, zmax, zmaxdb)
         for z in range(zmin, zmax+1):
-            (x1west, y1south, x2east, y2north), =\
-                dbc.execute(f'''SELECT
-                    min(tile_column), min(tile_row),
-                    max(tile_column), max(tile_row)
-                FROM {dbn}.tiles WHERE zoom_level = ?''', (z,))
-            if not x1west:
+            if z not in extents:
                 log(f'z{z}: no tiles, skipping')
                 continue
-            _, xwest, ysouth = lnglat2tms(z, lng=bb.west+epsilon, lat=bb.south+epsilon)
-            _, xeast, ynorth = lnglat2tms(z, lng=bb.east-epsilon, lat=bb.north-epsilon)
+            x1west, x2east, y1south, y2north = extents[z]
+            xwest, ysouth, xeast, ynorth = bbox2tms(z, bb, epsilon)
             xwest = max(xwest, x1west)
             ysouth = max(ysouth, y1south)
             xeast = min(xeast, x2east)
@@ -649,24 +1162,67 @@ def cut_to_lnglat(source: str, bb: LLBb, dest: str='', zmin=None, zmax=None,
             if xwest > xeast or ysouth > ynorth:
                 print(f"Warning: no overlap at zoom-level {z}, output may be unusable")
                 continue
-            q = f'''
-                INSERT INTO dest.tiles (zoom_level, tile_column, tile_row, tile_data)
-                SELECT zoom_level, tile_column, tile_row, tile_data
-                FROM {dbn}.tiles
-                WHERE zoom_level = {z}
+            n = copy_tiles(dbc, dbn, 'dest', f'''zoom_level = {z}
                   AND tile_column >= {xwest} AND tile_column <= {xeast}
-                  AND tile_row >= {ysouth} AND tile_row <= {ynorth}
-                ON CONFLICT (zoom_level, tile_column, tile_row)
-                DO UPDATE SET tile_data=excluded.tile_data;
-                '''
-            dbc.execute(q)
-            n, = dbc.execute('SELECT COUNT(*) FROM dest.tiles')
-            log(f'z {z}: +{n[0] - nprev} tiles: {xwest}<x<{xeast} {ysouth}<y<{ynorth}')
-            nprev = n[0]
+                  AND tile_row >= {ysouth} AND tile_row <= {ynorth}''')
+            log(f'z {z}: +{n} tiles: {xwest}<x<{xeast} {ysouth}<y<{ynorth}')
         transfer_metadata(dbc)
         set_real_bounds(dbc, dbn='dest', log=log)
 
 
+def split_by_extents(source: str, extents: 'dict[str, LLBb]', zmin: int=None, zmax: int=None,
+                     overwrite=False, dedup: bool=None, max_bytes=64 << 20, log=print) -> dict[str, int]:
+    """Like one `cut_to_lnglat` per `{dest: bb}` in `extents`, but reading `source` only once:
+       tiles are streamed in key order and routed to every `dest` whose extent (border tiles
+       included) contains them. Metadata, bounds and center of each `dest` are set at the end.
+       :param max_bytes: memory budget, for reading and for the pending writes of all outputs
+       :return: number of tiles written to each `dest`
+    """
+    source = mbt_path(source)
+    dests = {}
+    for dest, bb in extents.items():
+        _, dest = validate_src_dst(source, dest, overwrite)
+        dests[dest] = bb if isinstance(bb, LLBb) else LLBb(*bb)  # eg a `bbox.BBox`
+    log(mbt_info(source))
+    with cursor(source) as dbc:
+        dedup = is_dedup(dbc) if dedup is None else dedup
+        if not zmin or not zmax:
+            (zmindb, zmaxdb), = dbc.execute('SELECT min(zoom_level), max(zoom_level) FROM tiles')
+            zmin, zmax = zmin or zmindb, zmax or zmaxdb
+        outs = {dest: MBTiles(dest, create=True, dedup=dedup) for dest in dests}
+        ranges = {z: [(dest, *bbox2tms(z, bb)) for dest, bb in dests.items()] for z in range(zmin, zmax + 1)}
+        pending = {dest: [] for dest in dests}
+        counts = dict.fromkeys(dests, 0)
+        npending = 0
+        try:
+            for z, x, y, im in stream_tiles(dbc, where=f'zoom_level BETWEEN {zmin} AND {zmax}',
+                                            max_bytes=max_bytes // 2):
+                for dest, xwest, ysouth, xeast, ynorth in ranges[z]:
+                    if xwest <= x <= xeast and ysouth <= y <= ynorth:
+                        pending[dest].append((z, x, y, im))
+                        npending += len(im)
+                if npending > max_bytes // 2:
+                    for dest, rows in pending.items():
+                        insert_tiles(outs[dest], rows)
+                        counts[dest] += len(rows)
+                        rows.clear()
+                    npending = 0
+            for dest, rows in pending.items():
+                insert_tiles(outs[dest], rows)
+                counts[dest] += len(rows)
+            for dest, out in outs.items():
+                with out.batch() as odbc:
+                    odbc.executemany('INSERT INTO metadata (name, value) VALUES (?, ?) ON CONFLICT (name) DO NOTHING',
+                                     dbc.execute('SELECT name, value FROM metadata').fetchall())
+                    if counts[dest]:
+                        set_real_bounds(odbc, log=log)
+                log(f'{dest}: {counts[dest]} tiles')
+        finally:
+            for out in outs.values():
+                out.close()
+    return counts
+
+
 def remove_lnglat(source: str, dest: str='', bb: LLBb=None, zmin=None, zmax=None,
                   overwrite=False, log=print):
     """Create `dest` as a copy of `source` with the tiles inside given bbox, border included removed
@@ -682,7 +1238,7 @@ def remove_lnglat(source: str, dest: str='', bb: LLBb=None, zmin=None, zmax=None
     log('<<>>', source[:-8], ':', mbt_info(source))
     epsilon = 0.1**5 # around 1 pixel at z16
     with cursor(dest) as dbc:
-        nprev, = dbc.execute('SELECT COUNT(*) FROM main.tiles').fetchone()
+        nprev = tile_count(dbc)
         if not zmin or not zmax:
             (zmindb, zmaxdb), = dbc.execute('SELECT min(zoom_level), max(zoom_level) FROM main.tiles')
             zmin = zmin or zmindb
@@ -693,16 +1249,16 @@ def remove_lnglat(source: str, dest: str='', bb: LLBb=None, zmin=None, zmax=None
                 DELETE FROM main.tiles
                 WHERE zoom_level = {z}'''
             if bb:
-                _, xwest, ysouth = lnglat2tms(z, lng=bb.west+epsilon, lat=bb.south+epsilon)
-                _, xeast, ynorth = lnglat2tms(z, lng=bb.east-epsilon, lat=bb.north-epsilon)
+                xwest, ysouth, xeast, ynorth = bbox2tms(z, bb, epsilon)
                 q += f'''
                   AND tile_column >= {xwest} AND tile_column <= {xeast}
                   AND tile_row >= {ysouth} AND tile_row <= {ynorth}
                 '''
             dbc.execute(q)
-            n, = dbc.execute('SELECT COUNT(*) FROM main.tiles').fetchone()
+            n = tile_count(dbc)
             print('z', z, ': removed', nprev - n)
             nprev = n
+        refresh_stats(dbc)
         set_real_bounds(dbc, log=log)
     with cursor(dest) as dbc:
         dbc.execute('VACUUM')
@@ -713,9 +1269,10 @@ def remove_tile_xy(sqlite_or_path: DB, z: int, *, x, y):
             q = f'''DELETE FROM main.tiles
                     WHERE zoom_level = {z} AND tile_column = {x} AND tile_row = {y} '''
             dbc.execute(q)
+            refresh_stats(dbc)
 
 
-def remove_tile_ll(sqlite_or_path: DB, z: int, ll: T.LngLat):
+def remove_tile_ll(sqlite_or_path: DB, z: int, ll: LngLat):
     _, x, y= lnglat2tms(z, lng=ll.lng, lat=ll.lat)
     remove_tile_xy(sqlite_or_path, z, x=x, y=y)
 
@@ -724,6 +1281,7 @@ def remove_tile_ll(sqlite_or_path: DB, z: int, ll: T.LngLat):
 def discard_bbox_borders(source: str, dest: str, zooms: list[int]=[], dbname='main', log=print):
     """(Unused, and unstable)
        Discard one row/column of tiles at ech of the 4 edges & borders of the map"""
+    source, dest = mbt_path(source), mbt_path(dest)
     assert dest.endswith('.mbtiles')
     if dest != source:
         log(f'cp {source} {dest}')
@@ -734,7 +1292,7 @@ def discard_bbox_borders(source: str, dest: str, zooms: list[int]=[], dbname='ma
         if not zooms:
             (zmin, zmax), = dbc.execute(f'SELECT min(zoom_level), max(zoom_level) FROM {dbname}.tiles')
             zooms = list(range(zmin, zmax+1))
-        nprev, = dbc.execute(f'SELECT COUNT(*) FROM {dbname}.tiles')
+        nprev = tile_count(dbc, dbname)
         for z in zooms:
             (x1west, y1south, x2east, y2north), =\
                 dbc.execute(f'''SELECT
@@ -748,29 +1306,66 @@ def discard_bbox_borders(source: str, dest: str, zooms: list[int]=[], dbname='ma
                     OR tile_row == {y1south} OR tile_row == {y2north})
                 '''
             dbc.execute(q)
-            n, = dbc.execute(f'SELECT COUNT(*) FROM {dbname}.tiles')
-            print('z', z, ': removed', nprev[0] - n[0])
+            n = tile_count(dbc, dbname)
+            print('z', z, ': removed', nprev - n)
             nprev = n
 
 
 class Tileset:
+    """Set of TMS (z, x, y) tiles, as one boolean NumPy bitmap per zoom level,
+       cropped to that level's extent: `self.z[z] = (x0, y0, bitmap[y - y0, x - x0])`.
+       Costs 1 byte per tile of the extent (vs. ~70 for a python `set` of ints),
+       and set operations / counts are vectorized."""
     @classmethod
-    def from_db(cls, sqlite_or_path: DB, dbname='main'):
+    def from_db(cls, sqlite_or_path: DB, dbname='main', zooms: Iterable[int]=(), chunk=1 << 20):
         self = cls()
         with cursor(sqlite_or_path) as dbc:
-            dbc.execute(f'SELECT zoom_level, tile_column, tile_row FROM {dbname}.tiles ')
-            while rows:= dbc.fetchmany(10000):
-                for row in rows:
-                    self.s.add(self.zxy_to_i(*row))
+            for z, x0, x1, y0, y1 in zoom_extents(dbc, dbname):
+                if zooms and z not in zooms:
+                    continue
+                bm = np.zeros((y1 - y0 + 1, x1 - x0 + 1), dtype=bool)
+                dbc.execute(f'SELECT tile_column, tile_row FROM {dbname}.tiles WHERE zoom_level = ?', (z,))
+                while rows := dbc.fetchmany(chunk):
+                    xy = np.array(rows, dtype=np.int64)
+                    bm[xy[:, 1] - y0, xy[:, 0] - x0] = True
+                self.z[z] = (x0, y0, bm)
             return self
 
     def __init__(self) -> None:
-        self.s = set()
+        self.z: dict[int, tuple[int, int, np.ndarray]] = {}
 
     def __len__(self):
-        return len(self.s)
+        return sum(self.counts().values())
+    def counts(self) -> dict[int, int]:
+        return {z: int(np.count_nonzero(bm)) for z, (_, _, bm) in sorted(self.z.items())}
+    def extent(self, z) -> tuple[int, int, int, int]:
+        """x0, y0, x1, y1 (inclusive) of the bitmap at `z`, which may be larger than the tiles"""
+        x0, y0, bm = self.z[z]
+        return x0, y0, x0 + bm.shape[1] - 1, y0 + bm.shape[0] - 1
+
     def __contains__(self, zxy):
-        return self.zxy_to_i(*zxy) in self.s
+        z, x, y = zxy
+        if z not in self.z:
+            return False
+        x0, y0, bm = self.z[z]
+        return 0 <= y - y0 < bm.shape[0] and 0 <= x - x0 < bm.shape[1] and bool(bm[y - y0, x - x0])
+    def has_tile(self, z, x, y):
+        return (z, x, y) in self
+
+    def __iter__(self):
+        for z in sorted(self.z):
+            xs, ys = self.coords(z)
+            for x, y in zip(xs.tolist(), ys.tolist()):
+                yield z, x, y
+    def coords(self, z) -> tuple[np.ndarray, np.ndarray]:
+        """xs, ys arrays of the tiles at zoom `z`"""
+        x0, y0, bm = self.z[z]
+        ys, xs = np.nonzero(bm)
+        return xs + x0, ys + y0
+
+    def __eq__(self, other: 'Tileset'):
+        return len(self ^ other) == 0
+    __hash__ = None  # mutable
 
     @classmethod
     def i_to_zxy(cls, i):
@@ -786,6 +1381,301 @@ class Tileset:
         return (((z << 17) + x) << 17) + y
 
     def add_tile(self, z, x, y):
-        self.s.add(self.zxy_to_i(z, x, y))
-    def has_tile(self, z, x, y):
-        return (z, x, y) in self.s
+        self.add_tiles(z, np.array([x]), np.array([y]))
+    def add_tiles(self, z, xs: np.ndarray, ys: np.ndarray):
+        xs, ys = np.asarray(xs), np.asarray(ys)
+        if not len(xs):
+            return
+        x0, y0, x1, y1 = int(xs.min()), int(ys.min()), int(xs.max()), int(ys.max())
+        if z in self.z:
+            ex0, ey0, ex1, ey1 = self.extent(z)
+            x0, y0, x1, y1 = min(x0, ex0), min(y0, ey0), max(x1, ex1), max(y1, ey1)
+        bm = self._crop(z, x0, y0, x1, y1)
+        bm[ys - y0, xs - x0] = True
+        self.z[z] = (x0, y0, bm)
+
+    def _crop(self, z, x0, y0, x1, y1) -> np.ndarray:
+        """Copy of the bitmap at `z` over the given extent, padding with False"""
+        out = np.zeros((y1 - y0 + 1, x1 - x0 + 1), dtype=bool)
+        if z in self.z:
+            sx0, sy0, bm = self.z[z]
+            # overlap in absolute coordinates
+            ax0, ay0 = max(x0, sx0), max(y0, sy0)
+            ax1, ay1 = min(x1, sx0 + bm.shape[1] - 1), min(y1, sy0 + bm.shape[0] - 1)
+            if ax0 <= ax1 and ay0 <= ay1:
+                out[ay0 - y0:ay1 - y0 + 1, ax0 - x0:ax1 - x0 + 1] = \
+                    bm[ay0 - sy0:ay1 - sy0 + 1, ax0 - sx0:ax1 - sx0 + 1]
+        return out
+
+    def _combine(self, other: 'Tileset', op, zooms, union_extent: bool):
+        res = Tileset()
+        for z in zooms:
+            if union_extent:
+                ext = [t.extent(z) for t in (self, other) if z in t.z]
+                x0, y0 = min(e[0] for e in ext), min(e[1] for e in ext)
+                x1, y1 = max(e[2] for e in ext), max(e[3] for e in ext)
+            else:
+                x0, y0, x1, y1 = self.extent(z)
+            bm = op(self._crop(z, x0, y0, x1, y1), other._crop(z, x0, y0, x1, y1))
+            if bm.any():
+                res.z[z] = (x0, y0, bm)
+        return res
+
+    def __or__(self, other: 'Tileset'):
+        return self._combine(other, np.logical_or, set(self.z) | set(other.z), True)
+    def __and__(self, other: 'Tileset'):
+        return self._combine(other, np.logical_and, set(self.z) & set(other.z), False)
+    def __sub__(self, other: 'Tileset'):
+        return self._combine(other, lambda a, b: a & ~b, set(self.z), False)
+    def __xor__(self, other: 'Tileset'):
+        return self._combine(other, np.logical_xor, set(self.z) | set(other.z), True)
+    union, intersection, difference = __or__, __and__, __sub__
+
+    def project(self, zfrom: int, zto: int, max_bytes=1 << 28) -> 'Tileset':
+        """Tiles at `zto` covering the tiles at `zfrom`:
+           parents (any child present) if `zto < zfrom`, or all children if `zto > zfrom`.
+           Children take 4x the memory per zoom level, hence `max_bytes`: to compare with a finer
+           set, project that one up to its parents instead."""
+        res = Tileset()
+        if zfrom not in self.z:
+            return res
+        x0, y0, bm = self.z[zfrom]
+        if zto < zfrom:
+            f = 1 << (zfrom - zto)
+            px0, py0 = x0 // f, y0 // f
+            # pad so that the bitmap starts and ends on a parent boundary
+            left, bottom = x0 - px0 * f, y0 - py0 * f
+            right, top = -(left + bm.shape[1]) % f, -(bottom + bm.shape[0]) % f
+            padded = np.pad(bm, ((bottom, top), (left, right)))
+            ny, nx = padded.shape[0] // f, padded.shape[1] // f
+            res.z[zto] = (px0, py0, padded.reshape(ny, f, nx, f).any(axis=(1, 3)))
+        else:
+            f = 1 << (zto - zfrom)
+            if bm.size * f * f > max_bytes:
+                raise ValueError(f'z{zfrom} -> z{zto} needs {bm.size * f * f >> 20} MiB: '
+                                 f'project the z{zto} set to z{zfrom} instead')
+            res.z[zto] = (x0 * f, y0 * f, np.repeat(np.repeat(bm, f, axis=0), f, axis=1))
+        return res
+
+
+def _reverse_blob(z, x, y, im):
+    return im[::-1]
+
+class TestApplyToTiles(TestCase):
+    def test_parallel_same_as_serial(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            src = os.path.join(tmp, 'src.mbtiles')
+            create_mbt(src)
+            update_mbt_meta(src, name='t', format='png')
+            insert_tiles(src, [(z, x, y, b'%d-%d-%d' % (z, x, y))
+                               for z in (3, 4) for x in range(8) for y in range(8)])
+            for processes in (1, 3):
+                dest = os.path.join(tmp, f'p{processes}.mbtiles')
+                apply_to_tiles(src, dest, _reverse_blob, processes=processes, batch=7,
+                               log=lambda *a: None)
+                self.assertEqual(num2tile(dest, 4, 5, 6, flip_y=False), b'6-5-4')
+                self.assertEqual(tile_count(sqlite3.connect(dest).cursor()), 128)
+
+
+class TestStreamTiles(TestCase):
+    def test_pages_and_resume(self):
+        db = sqlite3.connect(':memory:')
+        create_mbt(db)
+        insert_tiles(db, [(z, x, y, bytes(100 * x)) for z in (1, 2) for x in range(4) for y in range(4)])
+        expected = list(get_all_tiles(db, q='WHERE zoom_level = 2 ORDER BY tile_column, tile_row'))
+        streamed = list(get_all_tiles(db, q='WHERE zoom_level = 2', max_bytes=1000))
+        self.assertEqual(streamed, expected)
+        pages = list(keyset_pages(db.cursor(), 'zoom_level, tile_column, tile_row, tile_data',
+                                  max_bytes=1000))
+        self.assertGreater(len(pages), 4)
+        resumed = list(stream_tiles(db, after=(2, 1, 3), zero_copy=True))
+        self.assertEqual(resumed[0][:3], (2, 2, 0))
+        self.assertIsInstance(resumed[0][3], memoryview)
+        self.assertEqual(list(get_all_coords(db, max_bytes=500, after=(2, 3, 2))), [(2, 3, 3)])
+
+
+class TestMBTilesHandle(TestCase):
+    def test_handle_and_wal_reader(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'h.mbtiles')
+            with MBTiles(path, create=True, journal_mode='WAL') as mbt:
+                with mbt.batch():
+                    for x in range(30):
+                        insert_tiles(mbt, [(5, x, 1, b'im%d' % x)])
+                update_mbt_meta(mbt, name='h', format='png')
+                reader = mbt.reader()
+                insert_tiles(mbt, [(5, 31, 1, b"late")])
+                self.assertEqual(num2tile(reader, 5, 7, 1, flip_y=False), b'im7')
+                self.assertEqual(num2tile(reader, 5, 31, 1, flip_y=False), b'late')
+                with self.assertRaises(sqlite3.OperationalError):
+                    insert_tiles(reader, [(5, 0, 0, b'')])
+                reader.close()
+                cut_zoom(mbt, [5], dest=os.path.join(tmp, 'z5.mbtiles'))
+            self.assertEqual(get_meta(path)['name'], 'h')
+            self.assertEqual(tile_count(sqlite3.connect(os.path.join(tmp, "z5.mbtiles")).cursor()), 31)
+
+
+class TestTileset(TestCase):
+    def test_bitmaps(self):
+        db = sqlite3.connect(':memory:')
+        create_mbt(db)
+        insert_tiles(db, [(10, x, y, b'') for x in range(101, 105) for y in range(201, 203)])
+        ts = Tileset.from_db(db)
+        self.assertEqual(ts.counts(), {10: 8})
+        self.assertTrue(ts.has_tile(10, 101, 201))
+        self.assertNotIn((10, 100, 201), ts)
+        other = Tileset()
+        other.add_tiles(10, np.array([104, 105]), np.array([202, 202]))
+        self.assertEqual(len(ts | other), 9)
+        self.assertEqual(list(ts & other), [(10, 104, 202)])
+        self.assertEqual(len(ts - other), 7)
+        parents = ts.project(10, 9)
+        self.assertEqual(sorted(parents), [(9, 50, 100), (9, 50, 101), (9, 51, 100), (9, 51, 101),
+                                           (9, 52, 100), (9, 52, 101)])
+        self.assertEqual(parents.project(9, 10).counts(), {10: 24})
+        with self.assertRaises(ValueError):
+            parents.project(9, 25)  # 24 GiB
+        self.assertEqual(ts, Tileset.from_db(db))
+
+
+class TestDedup(TestCase):
+    def test_dedup_layout(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            plain, dedup = os.path.join(tmp, 'plain.mbtiles'), os.path.join(tmp, 'dedup.mbtiles')
+            create_mbt(plain)
+            update_mbt_meta(plain, name='p', format='png')
+            insert_tiles(plain, [(6, x, y, b'white' if x % 2 else b'%d' % y) for x in range(4) for y in range(4)])
+            report = dedup_mbt(plain, dedup, log=lambda *a: None)
+            self.assertEqual((report['tiles'], report['images']), (16, 5))
+            self.assertEqual(report['saved_bytes'], dedup_report(plain, log=lambda *a: None)['saved_bytes'])
+            self.assertEqual(sorted(get_all_tiles(dedup)), sorted(get_all_tiles(plain)))
+            # writes through helpers and through the view, without leaving orphan images
+            insert_tiles(dedup, [(6, 0, 0, b'white')])
+            with cursor(dedup) as dbc:
+                update_tiles(dbc, [(b'new', 6, 0, 1)])
+                remove_tiles(dbc, [(6, 0, 2), (6, 2, 2)])
+                self.assertEqual(dbc.execute('SELECT COUNT(*) FROM images').fetchone()[0], 5)
+            self.assertEqual(num2tile(dedup, 6, 0, 1, flip_y=False), b'new')
+            # and through the view by plain SQLite, without `tile_hash`
+            db = sqlite3.connect(dedup)
+            with db:
+                db.execute('INSERT INTO tiles VALUES (7, 0, 0, ?)', (b'white',))
+                db.execute('INSERT INTO tiles VALUES (7, 0, 1, ?)', (b'foreign',))
+                db.execute('UPDATE tiles SET tile_data = ? WHERE zoom_level = 7 AND tile_row = 0', (b'foreign',))
+                self.assertEqual(db.execute('SELECT COUNT(*), COUNT(DISTINCT tile_data) FROM images').fetchone(), (6, 6))
+                self.assertEqual(db.execute('SELECT tile_data FROM tiles WHERE zoom_level = 7').fetchall(),
+                                 [(b'foreign',)] * 2)
+                db.execute('DELETE FROM tiles WHERE zoom_level = 7')
+                self.assertEqual(db.execute('SELECT COUNT(*) FROM images').fetchone()[0], 5)
+            db.close()
+            # both paths find the same image
+            insert_tiles(dedup, [(7, 0, 0, b'foreign')])
+            db = sqlite3.connect(dedup)
+            with db:
+                db.execute('INSERT INTO tiles VALUES (7, 0, 1, ?)', (b'foreign',))
+            db.close()
+            insert_tiles(dedup, [(7, 0, 2, b'foreign')])
+            with cursor(dedup) as dbc:
+                self.assertEqual(dbc.execute('SELECT COUNT(*) FROM images WHERE tile_data = ?', (b'foreign',)).fetchone()[0], 1)
+                other = os.path.join(tmp, 'other.mbtiles')
+                create_mbt(other, dedup=True)
+                dbc.execute(f'ATTACH "{other}" AS other')
+                db = sqlite3.connect(other)
+                with db:
+                    db.execute('INSERT INTO tiles VALUES (8, 0, 0, ?)', (b'foreign',))
+                db.close()
+                self.assertEqual(copy_tiles(dbc, 'main', 'other', 'zoom_level = 7'), 3)
+                self.assertEqual(dbc.execute('SELECT COUNT(*) FROM other.images').fetchone()[0], 1)
+                dbc.execute('DELETE FROM tiles WHERE zoom_level = 7')
+            self.assertEqual(dedup_report(dedup, log=lambda *a: None)['images'], 5)
+            cut = os.path.join(tmp, 'cut.mbtiles')
+            cut_to_lnglat(dedup, bb=tms2bbox(6, x=1, y=1), dest=cut, log=lambda *a: None)
+            with cursor(cut) as dbc:
+                self.assertTrue(is_dedup(dbc))
+                self.assertEqual(tile_count(dbc), 1)
+            merged = os.path.join(tmp, 'merged.mbtiles')
+            mbt_merge(plain, dedup, dest=merged, dedup=True, log=lambda *a: None)
+            with cursor(merged) as dbc:
+                self.assertTrue(is_dedup(dbc))
+                self.assertEqual(tile_count(dbc), 16)  # union: removed tiles come back from `plain`
+            self.assertEqual(num2tile(merged, 6, 0, 1, flip_y=False), b'new')
+
+
+class TestMerge(TestCase):
+    def test_priority_bbox_zooms(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = [os.path.join(tmp, f's{i}.mbtiles') for i in range(3)]
+            for i, path in enumerate(paths):
+                create_mbt(path)
+                update_mbt_meta(path, name=f's{i}', format='png')
+                insert_tiles(path, [(z, x, y, b'%d' % i) for z in (4, 5, 6)
+                                    for x in range(i, 8 + i) for y in range(8)])
+            dest = os.path.join(tmp, 'merged.mbtiles')
+            bb = tms2bbox(5, x=2, y=1)
+            counts = mbt_merge(*paths, dest=dest, bb=bb, zmin=5, zmax=6, log=lambda *a: None)
+            self.assertEqual(list(counts.values()), [5, 5, 5])  # 1 at z5 + 2x2 at z6, from each
+            self.assertEqual(num2tile(dest, 6, 5, 3, flip_y=False), b'2')
+            with cursor(dest) as dbc:
+                self.assertEqual(dbc.execute('SELECT DISTINCT zoom_level FROM tiles').fetchall(), [(5,), (6,)])
+            self.assertEqual(get_meta(dest)['format'], 'png')
+            # zmin and zmax together (used to be concatenated without AND)
+            counts = mbt_merge(paths[1], dest=dest, zmin=4, zmax=4, log=lambda *a: None)
+            self.assertEqual(counts, {paths[1]: 64})
+
+
+class TestSplit(TestCase):
+    def test_split_same_as_cuts(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            src = os.path.join(tmp, 'src.mbtiles')
+            create_mbt(src)
+            update_mbt_meta(src, name='src', format='png')
+            insert_tiles(src, [(z, x, y, b'%d-%d-%d' % (z, x, y)) for z in (5, 6)
+                               for x in range(2 ** z // 2) for y in range(2 ** z // 2)])
+            extents = {os.path.join(tmp, 'a.mbtiles'): tms2bbox(4, x=1, y=1),
+                       os.path.join(tmp, 'b.mbtiles'): b_union(tms2bbox(4, x=1, y=1), tms2bbox(4, x=2, y=2))}
+            counts = split_by_extents(src, extents, log=lambda *a: None)
+            self.assertEqual(list(counts.values()), [4 + 16, 16 + 64])
+            for dest, bb in extents.items():
+                cut = dest.replace('.mbtiles', '-cut.mbtiles')
+                cut_to_lnglat(src, bb=bb, dest=cut, log=lambda *a: None)
+                self.assertEqual(sorted(get_all_tiles(dest)), sorted(get_all_tiles(cut)))
+                self.assertEqual(get_meta(dest), get_meta(cut))
+
+
+class TestStats(TestCase):
+    def test_stats_follow_writes(self):
+        for dedup in (False, True):
+            with tempfile.TemporaryDirectory() as tmp:
+                src = os.path.join(tmp, 'src.mbtiles')
+                create_mbt(src, dedup=dedup, stats=True)
+                insert_tiles(src, [(z, x, y, b'%d' % (x % 2)) for z in (3, 4) for x in range(4) for y in range(3)])
+                insert_tiles(src, [(4, 0, 0, b'longer')])  # upsert
+                remove_tile_xy(src, 4, x=3, y=2)  # on the border
+                remove_tile_xy(src, 3, x=1, y=1)  # inside
+                with cursor(src) as dbc:
+                    self.assertEqual(tile_count(dbc), 22)
+                    self.assertEqual(zoom_extents(dbc), [(3, 0, 3, 0, 2), (4, 0, 3, 0, 2)])
+                    # a border tile deleted by another tool: read without writing, then refreshed
+                    dbc.execute('DELETE FROM tiles WHERE zoom_level = 3 AND tile_column = 3')
+                    dbc.connection.commit()
+                    with MBTiles(src, readonly=True) as mbt, mbt.batch() as ro:
+                        self.assertEqual(zoom_extents(ro), [(3, 0, 2, 0, 2), (4, 0, 3, 0, 2)])
+                        self.assertEqual(real_bounds(ro)[2], real_bounds(dbc)[2])
+                    self.assertEqual(dbc.execute('SELECT COUNT(*) FROM zoom_stats WHERE stale').fetchone()[0], 1)
+                    insert_tiles(dbc, [(3, 3, 0, b'0')])
+                    remove_tiles(dbc, [(3, 3, 0)])
+                    self.assertEqual(dbc.execute('SELECT COUNT(*) FROM zoom_stats WHERE stale').fetchone()[0], 0)
+                    self.assertEqual(verify_stats(dbc, log=lambda *a: None), {})
+                    # as other tools write: INSERT OR REPLACE, INSERT OR IGNORE
+                    for verb in ('INSERT OR REPLACE', 'INSERT OR IGNORE', 'INSERT OR REPLACE'):
+                        dbc.execute(f"{verb} INTO tiles VALUES (4, 1, 0, x'00010203')")
+                        self.assertEqual(verify_stats(dbc, log=lambda *a: None), {}, verb)
+                    insert_tiles(dbc, [(4, 1, 0, b'1')])  # upsert
+                    self.assertEqual(verify_stats(dbc, log=lambda *a: None), {})
+                    self.assertEqual(dbc.execute('SELECT COUNT(*) FROM zoom_stats_replaced').fetchone()[0], 0)
+                    with_stats = real_bounds(dbc)
+                    drop_stats(dbc)
+                    self.assertEqual(real_bounds(dbc), with_stats)
+                    remove_tile_xy(dbc, 4, x=3, y=0)
+                    create_stats(dbc, log=lambda *a: None)
+                    self.assertEqual(verify_stats(dbc, log=lambda *a: None), {})
@@ -0,0 +1,445 @@
+"""The tiles of one zoom level of an MBTiles or PMTiles, decoded in parallel into a single raster,
+   on the EPSG:3857 tile grid, without GDAL round trips.
+
+   `mosaic` maps one zoom level of image tiles (eg PNG8 slopes) as palette indices or RGB,
+   with a validity mask, for region-wide statistics or visual QA at high zooms.
+   `dem_mosaic` decodes Terrarium or Terrain-RGB elevation tiles (eg Mapterhorn extracts)
+   to a Float32 DTM, replacing `trr2tif`'s `gdal_calc.py` pass (and its intermediate GeoTIFF
+   of the RGB bands): the result feeds `slope_util.slope_tif` directly.
+
+   Destinations are either a tiled, compressed GeoTIFF (`.tif`, needs GDAL), or a `.npy`
+   memory-mapped array, which workers write into directly, plus a `.npy.vrt` so GDAL
+   opens it with its geotransform.
+"""
+from collections import deque
+import io
+from multiprocessing import Pool
+import os
+import tempfile
+from typing import Callable, Iterator, NamedTuple
+from unittest import TestCase
+
+import numpy as np
+import PIL.Image
+
+from .mbt_util import LLBb, MBTiles, bbox2tms, insert_tiles, real_bounds, update_mbt_meta, zoom_extents
+from .palette_util import clr_path
+from .pmtiles_util import PMTiles, mbt_to_pmtiles
+from .png_util import CLEAR, optimize_png, rgba_palette
+from .render_util import WHITE, WORLD, Colorizer, encode_png8
+from .slope_util import CREATION_OPTIONS
+
+
+def decode_terrarium(rgb: np.ndarray) -> np.ndarray:
+    """Mapzen Terrarium: `(R * 256 + G + B / 256) - 32768` meters"""
+    r, g, b = (rgb[..., i].astype(np.float32) for i in range(3))
+    return r * 256 + g + b / 256 - 32768
+
+
+def decode_terrain_rgb(rgb: np.ndarray) -> np.ndarray:
+    """Mapbox Terrain-RGB: `-10000 + (R * 256² + G * 256 + B) * 0.1` meters"""
+    r, g, b = (rgb[..., i].astype(np.int64) for i in range(3))
+    return (-10000 + (r * 65536 + g * 256 + b) * .1).astype(np.float32)
+
+
+ENCODINGS = {'terrarium': decode_terrarium, 'terrain-rgb': decode_terrain_rgb}
+
+
+def _decode_dem(data: bytes, encoding: str, nodata: float) -> np.ndarray:
+    """Float32 elevations of an RGB(A) tile, `nodata` where transparent"""
+    rgba = np.asarray(PIL.Image.open(io.BytesIO(data)).convert('RGBA'))
+    dem = ENCODINGS[encoding](rgba)
+    dem[rgba[..., 3] == 0] = nodata
+    return dem
+
+
+def tile_size(data: bytes) -> int:
+    w, h = PIL.Image.open(io.BytesIO(data)).size
+    assert w == h, f'{w}x{h} tiles'
+    return w
+
+
+# == Tiles of one zoom level ==
+
+def zoom_range(source: str, z: int, bbox: LLBb = None) -> 'tuple[int, int, int, int]|None':
+    """XYZ x0, x1, y0, y1 (inclusive, north to south) of the tiles of `source` at zoom `z`,
+       within `bbox` if given. None if there are none."""
+    if source.endswith('.pmtiles'):
+        with PMTiles(source) as pmt:
+            h = pmt.header
+            ext = bbox2tms(z, LLBb(h.min_lon_e7 / 1e7, h.min_lat_e7 / 1e7, h.max_lon_e7 / 1e7, h.max_lat_e7 / 1e7))
+    else:
+        with MBTiles(source, readonly=True) as mbt, mbt.batch() as dbc:
+            ext = {zz: (x1, y1, x2, y2) for zz, x1, x2, y1, y2 in zoom_extents(dbc)}.get(z)
+    if ext is None:
+        return None
+    xw, ys, xe, yn = ext
+    if bbox:
+        bw, bs, be, bn = bbox2tms(z, bbox)
+        xw, ys, xe, yn = max(xw, bw), max(ys, bs), min(xe, be), min(yn, bn)
+    if xw > xe or ys > yn:
+        return None
+    flip = lambda y: (1 << z) - 1 - y
+    return xw, xe, flip(yn), flip(ys)
+
+
+def zoom_tiles(source: str, z: int, x0: int, x1: int, y0: int, y1: int,
+               arraysize=256) -> Iterator[tuple[int, int, bytes]]:
+    """(x, y, tile_data) of the tiles of zoom `z` in XYZ ranges `x0..x1, y0..y1`"""
+    n = (1 << z) - 1
+    if source.endswith('.pmtiles'):
+        with PMTiles(source) as pmt:
+            for _, x, y, data in pmt.zoom(z):
+                if x0 <= x <= x1 and y0 <= n - y <= y1:
+                    yield x, n - y, data
+        return
+    with MBTiles(source, readonly=True) as mbt:
+        dbc = mbt.db.execute('''
+            SELECT tile_column, tile_row, tile_data FROM tiles WHERE zoom_level = ?
+            AND tile_column BETWEEN ? AND ? AND tile_row BETWEEN ? AND ?''', (z, x0, x1, n - y1, n - y0))
+        while rows := dbc.fetchmany(arraysize):
+            for x, y, data in rows:
+                yield x, n - y, data
+
+
+def first_tile(source: str, z: int, ext: tuple) -> 'bytes|None':
+    tiles = zoom_tiles(source, z, *ext)
+    first = next(tiles, None)
+    tiles.close()
+    return first and first[2]
+
+
+def zoom_geotransform(z: int, x0: int, y0: int, tile=256) -> tuple:
+    """GDAL geotransform of a raster whose top left tile is XYZ x0, y0"""
+    res = 2 * WORLD / tile / 2 ** z
+    return (-WORLD + x0 * tile * res, res, 0., WORLD - y0 * tile * res, 0., -res)
+
+
+# == Parallel decoding into a raster ==
+
+_worker: dict = {}
+
+def _init_mosaic_worker(decode: Callable, npy: str, mask_npy: str, x0: int, y0: int, tile: int):
+    """Workers write into the `.npy` memmaps if any, else return the decoded tiles"""
+    _worker.update(decode=decode, x0=x0, y0=y0, tile=tile,
+                   out=np.load(npy, mmap_mode='r+') if npy else None,
+                   mask=np.load(mask_npy, mmap_mode='r+') if mask_npy else None)
+
+
+def _mosaic_batch(rows: list[tuple[int, int, bytes]]) -> list[tuple]:
+    """-> [(x, y, array, valid)], arrays are None once written in the memmaps"""
+    decode, out, mask, t = _worker['decode'], _worker['out'], _worker['mask'], _worker['tile']
+    done = []
+    for x, y, data in rows:
+        arr = decode(data)
+        arr, valid = arr if isinstance(arr, tuple) else (arr, None)
+        if out is None:
+            done.append((x, y, arr, valid))
+            continue
+        r, c = (y - _worker['y0']) * t, (x - _worker['x0']) * t
+        out[r:r + t, c:c + t] = arr
+        if mask is not None:
+            mask[r:r + t, c:c + t] = valid
+        done.append((x, y, None, None))
+    return done
+
+
+def _write_vrt(npy: str, arr: np.ndarray, gt: tuple, nodata: float):
+    """GDAL raw VRT over the (C order, little endian) data of the `.npy`"""
+    dtype = {np.dtype(np.float32): 'Float32', np.dtype(np.uint8): 'Byte'}[arr.dtype]
+    height, width = arr.shape[:2]
+    bands = arr.shape[2] if arr.ndim == 3 else 1
+    size = arr.dtype.itemsize
+    xml = [f'<VRTDataset rasterXSize="{width}" rasterYSize="{height}">',
+           '  <SRS>EPSG:3857</SRS>', f'  <GeoTransform>{", ".join(map(repr, gt))}</GeoTransform>']
+    for b in range(bands):
+        xml += [f'  <VRTRasterBand dataType="{dtype}" band="{b + 1}" subClass="VRTRawRasterBand">',
+                f'    <NoDataValue>{nodata!r}</NoDataValue>' if nodata is not None else '',
+                f'    <SourceFilename relativetoVRT="1">{os.path.basename(npy)}</SourceFilename>',
+                f'    <ImageOffset>{arr.offset + b * size}</ImageOffset>',
+                f'    <PixelOffset>{bands * size}</PixelOffset>', f'    <LineOffset>{width * bands * size}</LineOffset>',
+                '    <ByteOrder>LSB</ByteOrder>', '  </VRTRasterBand>']
+    with open(npy + '.vrt', 'w') as f:
+        f.write('\n'.join(line for line in xml if line) + '\n</VRTDataset>\n')
+
+
+def _mosaic(source: str, dest: str, z: int, bbox: LLBb, decode: Callable, dtype, bands: int,
+            nodata, processes: int, batch: int, overwrite: bool, creation_options=CREATION_OPTIONS,
+            mask=False, log=print) -> tuple[tuple, 'np.ndarray|None', 'np.ndarray|None']:
+    """Decode the tiles of `z` (in `bbox`) with `decode(tile_data) -> array` into `dest`
+       (`.tif` or `.npy`), `nodata` where there are none.
+       :param mask: `decode` returns (array, valid), and `valid` (False where there are no tiles)
+          goes to `{dest}-mask.npy` or to the GeoTIFF mask band
+       :return: (geotransform, memmap and mask memmap, or None for a GeoTIFF)"""
+    source = os.path.expanduser(source)
+    dest = os.path.expanduser(dest)
+    assert dest.endswith('.tif') or dest.endswith('.npy'), dest
+    if os.path.exists(dest):
+        assert overwrite, f'not overwriting {dest}'
+        os.remove(dest)
+    ext = zoom_range(source, z, bbox)
+    assert ext, f'no tiles at z{z}'
+    x0, x1, y0, y1 = ext
+    first = first_tile(source, z, ext)
+    assert first, f'no tiles at z{z}'
+    t = tile_size(first)
+    width, height = (x1 - x0 + 1) * t, (y1 - y0 + 1) * t
+    gt = zoom_geotransform(z, x0, y0, t)
+    shape = (height, width, bands) if bands > 1 else (height, width)
+    log(f'mosaic z{z} x{x0}-{x1} y{y0}-{y1}: {width}x{height} px -> {dest}')
+    out, valid_out, ds = None, None, None
+    mask_npy = dest[:-4] + '-mask.npy' if mask and dest.endswith('.npy') else ''
+    if dest.endswith('.npy'):
+        out = np.lib.format.open_memmap(dest, 'w+', dtype, shape)
+        _write_vrt(dest, out, gt, nodata)
+        if mask:  # a new file is all zeros, ie False
+            valid_out = np.lib.format.open_memmap(mask_npy, 'w+', bool, (height, width))
+    else:
+        from osgeo import gdal
+        gdal.UseExceptions()
+        opts = [o for o in creation_options if not o.startswith('BLOCK')] + [f'BLOCKXSIZE={t}', f'BLOCKYSIZE={t}']
+        if np.dtype(dtype).kind == 'f':
+            opts = [o if not o.startswith('PREDICTOR') else 'PREDICTOR=3' for o in opts]
+        ds = gdal.GetDriverByName('GTiff').Create(dest, width, height, bands, gdal.GDT_Float32 if dtype == np.float32
+                                                  else gdal.GDT_Byte, options=opts)
+        ds.SetGeoTransform(gt)
+        ds.SetProjection('EPSG:3857')
+        for b in range(bands):
+            if nodata is not None:
+                ds.GetRasterBand(b + 1).SetNoDataValue(nodata)
+        if mask:
+            ds.CreateMaskBand(gdal.GMF_PER_DATASET)
+
+    present = np.zeros((y1 - y0 + 1, x1 - x0 + 1), bool)
+    def write(done):
+        for x, y, arr, valid in done:
+            present[y - y0, x - x0] = True
+            if ds is not None:
+                for b in range(bands):
+                    ds.GetRasterBand(b + 1).WriteArray(arr if bands == 1 else arr[..., b], (x - x0) * t, (y - y0) * t)
+                if mask:
+                    ds.GetRasterBand(1).GetMaskBand().WriteArray(valid.astype(np.uint8) * 255, (x - x0) * t, (y - y0) * t)
+    initargs = (decode, dest if out is not None else '', mask_npy, x0, y0, t)
+    pool = Pool(processes, _init_mosaic_worker, initargs) if processes > 1 else None
+    if not pool:
+        _init_mosaic_worker(*initargs)
+    inflight, rows = deque(), []
+    try:
+        def submit():
+            inflight.append(pool.apply_async(_mosaic_batch, (rows,)) if pool else _mosaic_batch(rows))
+            if len(inflight) >= 2 * processes:
+                write(inflight.popleft().get() if pool else inflight.popleft())
+        for row in zoom_tiles(source, z, *ext):
+            rows.append(row)
+            if len(rows) == batch:
+                submit()
+                rows = []
+        if rows:
+            submit()
+        while inflight:
+            write(inflight.popleft().get() if pool else inflight.popleft())
+    finally:
+        if pool:
+            pool.terminate()
+        _worker.clear()
+    log(f'mosaic: {present.sum()} tiles, {present.size - present.sum()} missing')
+    if out is not None:
+        if nodata is not None:
+            for ty, tx in zip(*np.nonzero(~present)):  # other pixels were written by the workers
+                out[ty * t:(ty + 1) * t, tx * t:(tx + 1) * t] = nodata
+        out.flush()
+        if valid_out is not None:
+            valid_out.flush()
+    else:
+        ds.FlushCache()
+        ds = None
+    return gt, out, valid_out
+
+
+class _DemDecoder:
+    """Picklable `decode` for `_mosaic`"""
+    def __init__(self, encoding, nodata):
+        self.encoding, self.nodata = encoding, nodata
+    def __call__(self, data):
+        return _decode_dem(data, self.encoding, self.nodata)
+
+
+def dem_mosaic(source: str, dest: str, z: int = None, encoding='terrarium', bbox: LLBb = None,
+               nodata=-9999., processes=os.cpu_count(), batch=64, overwrite=False,
+               creation_options=CREATION_OPTIONS, log=print) -> tuple[tuple, 'np.ndarray|None']:
+    """Float32 DTM of the elevation tiles of `source` (MBTiles or PMTiles), at zoom `z`
+       (the highest by default), within `bbox`, into `dest`: a GeoTIFF (`.tif`, compressed with
+       `creation_options`, blocks of one tile) or a `.npy` memmap (plus `.npy.vrt` for GDAL).
+       :param encoding: see `ENCODINGS`
+       :return: (geotransform, the memmap or None)"""
+    assert encoding in ENCODINGS, encoding
+    if z is None:
+        source = os.path.expanduser(source)
+        if source.endswith('.pmtiles'):
+            with PMTiles(source) as pmt:
+                z = pmt.header.max_zoom
+        else:
+            with MBTiles(source, readonly=True) as mbt, mbt.batch() as dbc:
+                z = max(zz for zz, *_ in zoom_extents(dbc))
+    gt, out, _ = _mosaic(source, dest, z, bbox, _DemDecoder(encoding, nodata), np.float32, 1, nodata,
+                         processes, batch, overwrite, creation_options, log=log)
+    return gt, out
+
+
+MODES = ('index', 'rgb')
+
+
+def _color_keys(rgba: np.ndarray) -> np.ndarray:
+    """uint32 of each RGBA color (n x 4), fully transparent ones as `CLEAR`"""
+    rgba = np.array(rgba, np.uint8)
+    rgba[rgba[:, 3] == 0] = CLEAR
+    return rgba.view(np.uint32)[:, 0]
+
+
+class IndexDecoder:
+    """-> (index in `palette` (RGBA, n x 4), valid) of each pixel, whatever the palette of the tile
+       (eg after `png_util.recompress_mbt`). Transparent pixels are not valid."""
+    def __init__(self, palette: np.ndarray):
+        keys = _color_keys(palette)
+        self.order = np.argsort(keys, kind='stable')
+        self.keys = keys[self.order]
+
+    def lookup(self, rgba: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        keys = _color_keys(rgba)
+        i = np.searchsorted(self.keys, keys).clip(0, len(self.keys) - 1)
+        valid = rgba[:, 3] > 0
+        missing = (self.keys[i] != keys) & valid
+        if missing.any():
+            raise ValueError(f'colors not in the palette: {np.unique(rgba[missing], axis=0)[:5].tolist()}')
+        return self.order[i].astype(np.uint8), valid
+
+    def __call__(self, data: bytes) -> tuple[np.ndarray, np.ndarray]:
+        im = PIL.Image.open(io.BytesIO(data))
+        if im.mode == 'P':  # look up the tile palette, not its pixels
+            idx, valid = self.lookup(rgba_palette(im))
+            pixels = np.asarray(im)
+            return idx[pixels], valid[pixels]
+        rgba = np.asarray(im.convert('RGBA'))
+        idx, valid = self.lookup(rgba.reshape(-1, 4))
+        return idx.reshape(rgba.shape[:2]), valid.reshape(rgba.shape[:2])
+
+
+def _decode_rgb(data: bytes) -> tuple[np.ndarray, np.ndarray]:
+    rgba = np.asarray(PIL.Image.open(io.BytesIO(data)).convert('RGBA'))
+    return rgba[..., :3], rgba[..., 3] > 0
+
+
+class Mosaic(NamedTuple):
+    data: np.ndarray  # (height, width) palette indices, or (height, width, 3) RGB
+    mask: np.ndarray  # True where there is a tile and its pixel is not transparent
+    geotransform: tuple
+    z: int
+    palette: 'np.ndarray|None'  # RGBA of the indices
+
+
+def mosaic(source: str, z: int, bbox: LLBb = None, mode='index', palette: 'np.ndarray|str' = None,
+           dest='', workdir='', processes=os.cpu_count(), batch=64, overwrite=False, log=print) -> Mosaic:
+    """Memory-mapped mosaic of the tiles of `source` (MBTiles or PMTiles) at zoom `z`, in `bbox`,
+       decoded on `processes`. It can be much larger than RAM.
+       :param mode: `index`: palette indices (uint8), `rgb`: uint8 RGB
+       :param palette: of the indices, RGBA (n x 4), or a `.clr` name or path colored like
+          `render_mbt` does. By default, that of the first tile (which must be indexed).
+       :param dest: `.npy` (+ `-mask.npy` and `.npy.vrt`) to keep. By default, temporary
+          files are deleted once mapped, so the space is freed with the arrays.
+       :param workdir: directory of those temporary files, by default that of `source`: not the
+          system temp dir, often a tmpfs, ie in RAM
+       :return: `Mosaic`"""
+    assert mode in MODES, mode
+    source = os.path.expanduser(source)
+    workdir = os.path.expanduser(workdir) if workdir else os.path.dirname(os.path.abspath(source))
+    tmp = '' if dest else tempfile.mkdtemp(prefix='.mosaic-', dir=workdir)
+    dest = dest or f'{tmp}/mosaic.npy'
+    assert dest.endswith('.npy'), dest
+    if mode == 'index':
+        if palette is None:
+            ext = zoom_range(source, z, bbox)
+            first = ext and first_tile(source, z, ext)
+            assert first, f'no tiles at z{z}'
+            im = PIL.Image.open(io.BytesIO(first))
+            assert im.mode == 'P', 'not indexed tiles, give a `palette`'
+            palette = rgba_palette(im)
+        elif isinstance(palette, str):
+            palette = Colorizer(clr_path(palette), nv=WHITE).palette
+        decode, bands = IndexDecoder(palette), 1
+    else:
+        decode, bands, palette = _decode_rgb, 3, None
+    try:
+        gt, data, mask = _mosaic(source, dest, z, bbox, decode, np.uint8, bands, None, processes, batch,
+                                 overwrite, mask=True, log=log)
+    finally:
+        if tmp:
+            for f in os.listdir(tmp):
+                os.remove(f'{tmp}/{f}')
+            os.rmdir(tmp)
+    return Mosaic(data, mask, gt, z, palette)
+
+
+def encode_terrarium(dem: np.ndarray) -> np.ndarray:
+    """RGB uint8 of elevations, for tests"""
+    v = np.round((dem + 32768) * 256).astype(np.int64)
+    return np.dstack([v >> 16, (v >> 8) & 255, v & 255]).astype(np.uint8)
+
+
+class TestMosaic(TestCase):
+    def test_dem(self):
+        rng = np.random.default_rng(0)
+        z, t = 10, 32
+        with tempfile.TemporaryDirectory() as tmp:
+            mbt, pmt = f'{tmp}/trr.mbtiles', f'{tmp}/trr.pmtiles'
+            dems = {}
+            rows = []
+            for x, y in ((530, 360), (531, 360), (531, 361)):  # XYZ, (530, 361) missing
+                dems[x, y] = (rng.random((t, t)) * 4000 - 100).astype(np.float32)
+                buf = io.BytesIO()
+                PIL.Image.fromarray(encode_terrarium(dems[x, y])).save(buf, 'PNG')
+                rows.append((z, x, (1 << z) - 1 - y, buf.getvalue()))
+            with MBTiles(mbt, create=True) as m:
+                insert_tiles(m, rows)
+            update_mbt_meta(mbt, name='trr', format='png', bounds=real_bounds(mbt)[2])
+            mbt_to_pmtiles(mbt, pmt, log=lambda *a: None)
+            for src, processes in ((mbt, 1), (pmt, 2)):
+                gt, out = dem_mosaic(src, f'{tmp}/dem.npy', processes=processes, overwrite=True, log=lambda *a: None)
+                self.assertEqual(out.shape, (2 * t, 2 * t))
+                self.assertAlmostEqual(gt[0], zoom_geotransform(z, 530, 360)[0])
+                self.assertAlmostEqual(gt[1] * t, zoom_geotransform(z, 530, 360)[1] * 256)
+                self.assertTrue(np.allclose(out[:t, :t], dems[530, 360], atol=1 / 256))
+                self.assertTrue(np.allclose(out[t:, t:], dems[531, 361], atol=1 / 256))
+                self.assertTrue((out[t:, :t] == -9999).all())
+                self.assertTrue((np.load(f'{tmp}/dem.npy', mmap_mode='r') == out).all())
+            self.assertIn('<ImageOffset>128</ImageOffset>', open(f'{tmp}/dem.npy.vrt').read())
+        rgb = np.array([[[1, 2, 3]]], np.uint8)
+        self.assertAlmostEqual(decode_terrarium(rgb)[0, 0], 256 + 2 + 3 / 256 - 32768, 3)
+        self.assertAlmostEqual(decode_terrain_rgb(rgb)[0, 0], -10000 + 66051 * .1, 3)
+
+    def test_mosaic(self):
+        z, t = 12, 16
+        colorize = Colorizer(clr_path('eslo13near'), nodata=255, nv=WHITE)
+        rng = np.random.default_rng(1)
+        slopes = {(x, y): rng.integers(0, 91, (t, t)).astype(np.uint8) for x, y in ((2000, 1400), (2001, 1401))}
+        with tempfile.TemporaryDirectory() as tmp:
+            with MBTiles(f'{tmp}/s.mbtiles', create=True) as m:
+                rows = []
+                for (x, y), v in slopes.items():
+                    idx = colorize(v)
+                    idx[0, 0] = colorize.transparent
+                    data = encode_png8(idx, colorize.palette)
+                    if x == 2000:  # without the unused palette entries
+                        data = optimize_png(data)
+                    rows.append((z, x, (1 << z) - 1 - y, data))
+                insert_tiles(m, rows)
+            for palette in ('eslo13near', None):
+                mos = mosaic(f'{tmp}/s.mbtiles', z, palette=palette, processes=2, log=lambda *a: None)
+                self.assertEqual(mos.data.shape, (2 * t, 2 * t))
+                rgba = mos.palette[mos.data]
+                expected = colorize.palette[colorize(slopes[2000, 1400])]
+                self.assertTrue((rgba[1:t, :t] == expected[1:]).all())
+                self.assertEqual((mos.mask.sum(), mos.mask[0, 0], mos.mask[t:, :t].any()), (2 * t * t - 2, False, False))
+                self.assertEqual(os.listdir(tmp), ['s.mbtiles'])  # temporary files next to it, deleted
+            rgb = mosaic(f'{tmp}/s.mbtiles', z, mode='rgb', dest=f'{tmp}/m.npy', processes=1, log=lambda *a: None)
+            self.assertTrue((rgb.data[t + 1:, t:] == colorize.palette[colorize(slopes[2001, 1401])][1:, :, :3]).all())
+            self.assertTrue(os.path.exists(f'{tmp}/m-mask.npy'))
@@ -0,0 +1,172 @@
+"""Color palettes from gdaldem `.clr` files (as in `data/`), applied to NumPy arrays
+   with the same semantics as `gdaldem color-relief`.
+"""
+import hashlib
+import os
+from unittest import TestCase
+
+import numpy as np
+
+
+def read_clr(clr_path: str) -> tuple[np.ndarray, np.ndarray, 'np.ndarray|None']:
+    """Parse a `.clr` file: `value r g b [a]` lines, and `nv r g b [a]` for nodata.
+       (Percent values and color names, also accepted by gdaldem, are not used in `data/`.)
+       :return: sorted values (float64), their RGBA colors (uint8, n x 4), nv RGBA or None"""
+    values, colors, nv = [], [], None
+    with open(os.path.expanduser(clr_path)) as f:
+        for line in f:
+            elems = line.replace(',', ' ').split()
+            if not elems or elems[0].startswith('#'):
+                continue
+            rgba = [int(float(e)) for e in elems[1:5]] + [255] * (5 - len(elems))
+            if elems[0] == 'nv':
+                nv = np.array(rgba, dtype=np.uint8)
+            else:
+                values.append(float(elems[0]))
+                colors.append(rgba)
+    order = np.argsort(values, kind='stable')
+    return np.array(values)[order], np.array(colors, dtype=np.uint8).reshape(-1, 4)[order], nv
+
+
+def nearest_entry(values: np.ndarray, arr: np.ndarray) -> np.ndarray:
+    """Index in `values` of the entry `gdaldem color-relief -nearest_color_entry` uses for each
+       element of `arr`: clamped to the first / last entry, ties go to the upper entry."""
+    i = np.searchsorted(values, arr, side='left')  # first entry >= value
+    i = np.clip(i, 1, max(len(values) - 1, 1))
+    lower, upper = values[i - 1], values[np.minimum(i, len(values) - 1)]
+    return np.where(arr - lower < upper - arr, i - 1, i).clip(0, len(values) - 1)
+
+
+CLRDIR = os.path.realpath(os.path.dirname(os.path.realpath(__file__)) + '/../data')
+MODES = ('nearest', 'interpolated')
+
+
+def clr_path(cname: str) -> str:
+    """`eslo13near` -> `data/gdaldem-slope-eslo13near.clr`; paths are returned as is"""
+    return cname if cname.endswith('.clr') else f'{CLRDIR}/gdaldem-slope-{cname}.clr'
+
+
+class Palette:
+    """A `.clr` compiled to lookup tables, to color a whole array in one vectorized gather.
+       Like gdaldem, `nv` is an entry at the `nodata` value (so it is ignored without `nodata`),
+       values out of the entries range get the first / last color, and `mode` is:
+       * `nearest`: `-nearest_color_entry`, ties go to the upper entry
+       * `interpolated`: the default, linear between entries and truncated after adding .45
+       Byte arrays go through the exact 256-entry `byte_lut`. Other arrays, through `float_lut`
+       which samples the entries range every `resolution` (1/100 degree by default): it may differ
+       from gdaldem within `resolution / 2` of a nearest cutoff, or by 1 level when interpolating.
+       Values out of that range (incl. nodata and NaN) are computed exactly.
+    """
+    def __init__(self, values: np.ndarray, colors: np.ndarray, nv: 'np.ndarray|None' = None,
+                 nodata: 'float|None' = None, mode='nearest', resolution=.01):
+        assert mode in MODES, mode
+        self.mode, self.nodata = mode, nodata
+        self.nv = nv if nv is not None else np.zeros(4, np.uint8)
+        self.lo, self.hi = values[0], values[-1]
+        if nodata is not None and not np.isnan(nodata):
+            i = np.searchsorted(values, nodata, side='right')
+            values, colors = np.insert(values, i, nodata), np.insert(colors, i, self.nv, axis=0)
+        self.values = values
+        self.colors = np.vstack([colors, self.nv]).astype(np.uint8)  # last: NaN nodata
+        self.byte_lut = self.color_of(np.arange(256))
+        n = int(np.ceil((self.hi - self.lo) / resolution)) + 1
+        self.scale = (n - 1) / (self.hi - self.lo) if n > 1 else 0.
+        self.float_lut = self.color_of(self.lo + np.arange(n) / (self.scale or 1))
+        if mode == 'nearest':
+            self.byte_entries = self.entry_of(np.arange(256))
+            self.float_entries = self.entry_of(self.lo + np.arange(n) / (self.scale or 1))
+
+    def entry_of(self, arr: np.ndarray) -> np.ndarray:
+        """Index in `colors` of the entry used for each value (nearest mode; NaN -> nv)"""
+        idx = nearest_entry(self.values, arr)
+        if np.issubdtype(np.asarray(arr).dtype, np.floating):
+            idx[np.isnan(arr)] = len(self.values)
+        return idx
+
+    def color_of(self, arr: np.ndarray) -> np.ndarray:
+        """Exact RGBA (uint8, `arr.shape + (4,)`) of the values, without the LUTs"""
+        arr = np.asarray(arr, dtype=np.float64)
+        if self.mode == 'nearest':
+            return self.colors[self.entry_of(arr)]
+        v = self.values
+        i = np.clip(np.searchsorted(v, arr, side='left'), 1, max(len(v) - 1, 1))
+        lower, upper = v[i - 1], v[np.minimum(i, len(v) - 1)]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            ratio = np.nan_to_num(np.clip(np.where(upper > lower, (arr - lower) / (upper - lower), 0.), 0, 1))
+        c0, c1 = self.colors[i - 1].astype(np.float64), self.colors[np.minimum(i, len(v) - 1)].astype(np.float64)
+        out = np.clip(.45 + c0 + ratio[..., None] * (c1 - c0), 0, 255).astype(np.uint8)
+        out[arr <= v[0]] = self.colors[0]
+        out[arr >= v[-1]] = self.colors[len(v) - 1]
+        out[np.isnan(arr)] = self.nv
+        return out
+
+    def _gather(self, arr: np.ndarray, byte_lut: np.ndarray, float_lut: np.ndarray, exact) -> np.ndarray:
+        if arr.dtype == np.uint8:
+            return byte_lut[arr]
+        inside = (arr >= self.lo) & (arr <= self.hi)
+        if self.nodata is not None:
+            inside &= arr != self.nodata
+        out = float_lut[((np.where(inside, arr, self.lo) - self.lo) * self.scale + .5).astype(np.intp)]
+        if not inside.all():
+            out[~inside] = exact(arr[~inside])
+        return out
+
+    def __call__(self, arr: np.ndarray) -> np.ndarray:
+        """RGBA (uint8, `arr.shape + (4,)`) of any array"""
+        return self._gather(arr, self.byte_lut, self.float_lut, self.color_of)
+
+    def entries(self, arr: np.ndarray) -> np.ndarray:
+        """Entry index (in `colors`) of any array, nearest mode only; eg for indexed PNGs"""
+        assert self.mode == 'nearest'
+        return self._gather(arr, self.byte_entries, self.float_entries, self.entry_of)
+
+
+_palettes: dict = {}
+
+def load_palette(clr: str, nodata: 'float|None' = None, mode='nearest', resolution=.01,
+                 nv: 'tuple|None' = None) -> Palette:
+    """`Palette` of a `.clr` path or color name (see `clr_path`), compiled once per file content
+       :param nv: override the `nv` color of the file, RGB (keeping the file's alpha) or RGBA"""
+    with open(os.path.expanduser(clr_path(clr)), 'rb') as f:
+        digest = hashlib.sha1(f.read()).hexdigest()
+    key = digest, nodata, mode, resolution, nv
+    if key not in _palettes:
+        values, colors, file_nv = read_clr(clr_path(clr))
+        if nv is not None:
+            file_nv = np.array((*nv, 255 if file_nv is None else file_nv[3])[:4], np.uint8)
+        _palettes[key] = Palette(values, colors, file_nv, nodata=nodata, mode=mode, resolution=resolution)
+    return _palettes[key]
+
+
+class TestPalette(TestCase):
+    def test_nearest(self):
+        values = np.array([0., 10., 20.])
+        got = nearest_entry(values, np.array([-5, 0, 4.9, 5, 5.1, 15, 19, 20, 90]))
+        self.assertEqual(got.tolist(), [0, 0, 0, 1, 1, 2, 2, 2, 2])
+
+    def test_read_clr(self):
+        clr = os.path.join(os.path.dirname(__file__), '../data/gdaldem-slope-eslo13near.clr')
+        values, colors, nv = read_clr(clr)
+        self.assertEqual(values[0], 17)
+        self.assertTrue((np.diff(values) > 0).all())
+        self.assertEqual(colors.shape, (len(values), 4))
+        self.assertEqual(nv.tolist(), [0, 0, 0, 255])
+
+    def test_compiled(self):
+        for mode in MODES:
+            pal = load_palette('eslo13near', nodata=255, mode=mode)
+            self.assertIs(pal, load_palette(clr_path('eslo13near'), nodata=255, mode=mode))
+            byte = np.arange(256, dtype=np.uint8)
+            self.assertTrue((pal(byte) == pal.color_of(byte)).all())
+            self.assertEqual(pal(byte)[255].tolist(), [0, 0, 0, 255])
+            floats = np.linspace(-10, 100, 11001).astype(np.float32)
+            floats[::7] += .5
+            lut, exact = pal(floats), pal.color_of(floats)
+            if mode == 'nearest':  # only differs near the cutoffs
+                self.assertGreater((lut == exact).all(axis=1).mean(), .999)
+            else:
+                self.assertLessEqual(np.abs(lut.astype(int) - exact).max(), 1)
+            self.assertTrue((pal(np.float32([np.nan])) == pal.nv).all())
+        pal = load_palette('eslo13near', nodata=255, mode='interpolated')
+        self.assertEqual(pal.color_of([17, 19.5, 22]).tolist(),
+                         [[255, 255, 255, 255], [212, 255, 255, 255], [170, 255, 255, 255]])
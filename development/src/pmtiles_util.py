@@ -0,0 +1,491 @@
+"""PMTiles v3 reader / writer, without the `pmtiles` package nor `pmtiles-convert` round trips.
+   Spec: https://github.com/protomaps/PMTiles/blob/main/spec/v3/spec.md
+   Tiles are exposed as MBTiles (TMS) `(z, x, y, tile_data)` rows, like `mbt_util.get_all_tiles`.
+"""
+from array import array
+from collections import OrderedDict
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import struct
+import tempfile
+from typing import Iterator, NamedTuple
+from unittest import TestCase
+
+import numpy as np
+
+from .mbt_util import DB, Tileset, create_mbt, cursor, get_meta, insert_tiles, mbt_path, \
+    parse_bounds, real_bounds, update_mbt_meta, validate_src_dst
+
+
+HEADER_LEN = 127
+ROOT_MAX = 16384 - HEADER_LEN  # header + root directory must fit in the first 16 KiB
+COMPRESSION = {'unknown': 0, 'none': 1, 'gzip': 2, 'brotli': 3, 'zstd': 4}
+TILE_TYPE = {'pbf': 1, 'mvt': 1, 'png': 2, 'jpg': 3, 'jpeg': 3, 'webp': 4, 'avif': 5}
+TILE_FORMAT = {1: 'pbf', 2: 'png', 3: 'jpg', 4: 'webp', 5: 'avif'}
+
+
+class Header(NamedTuple):
+    root_offset: int
+    root_length: int
+    metadata_offset: int
+    metadata_length: int
+    leaf_offset: int
+    leaf_length: int
+    data_offset: int
+    data_length: int
+    addressed_tiles: int
+    tile_entries: int
+    tile_contents: int
+    clustered: int
+    internal_compression: int
+    tile_compression: int
+    tile_type: int
+    min_zoom: int
+    max_zoom: int
+    min_lon_e7: int
+    min_lat_e7: int
+    max_lon_e7: int
+    max_lat_e7: int
+    center_zoom: int
+    center_lon_e7: int
+    center_lat_e7: int
+
+    FORMAT = '<7sB11QBBBBBBiiiiBii'
+
+    def pack(self) -> bytes:
+        return struct.pack(self.FORMAT, b'PMTiles', 3, *self)
+
+    @classmethod
+    def unpack(cls, buf: bytes) -> 'Header':
+        magic, version, *fields = struct.unpack(cls.FORMAT, buf[:HEADER_LEN])
+        assert magic == b'PMTiles' and version == 3, f'Not a PMTiles v3 archive: {magic} v{version}'
+        return cls(*fields)
+
+
+# == Tile ids: position along the Hilbert curve of each zoom level, zoom levels one after the other ==
+
+def _rotate(s, x, y, rx, ry):
+    if ry == 0:
+        if rx != 0:
+            x = s - 1 - x
+            y = s - 1 - y
+        return y, x
+    return x, y
+
+
+def zxy_to_tileid(z: int, x: int, y: int) -> int:
+    """`y` is XYZ (north origin), as in the spec"""
+    acc = ((1 << (z * 2)) - 1) // 3
+    for a in range(z - 1, -1, -1):
+        s = 1 << a
+        rx, ry = s & x, s & y
+        acc += ((3 * rx) ^ ry) * s
+        x, y = _rotate(s, x, y, rx, ry)
+    return acc
+
+
+def tileid_to_zxy(tile_id: int) -> tuple[int, int, int]:
+    acc, z = 0, 0
+    while acc + (1 << (2 * z)) <= tile_id:
+        acc += 1 << (2 * z)
+        z += 1
+    t, x, y = tile_id - acc, 0, 0
+    s = 1
+    while s < (1 << z):
+        rx = 1 & (t // 2)
+        ry = 1 & (t ^ rx)
+        x, y = _rotate(s, x, y, rx, ry)
+        x += s * rx
+        y += s * ry
+        t //= 4
+        s *= 2
+    return z, x, y
+
+
+def zxy_to_tileids(z: int, xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+    """Vectorized `zxy_to_tileid` for arrays of tiles of one zoom level"""
+    xs, ys = np.asarray(xs, dtype=np.int64), np.asarray(ys, dtype=np.int64)
+    acc = np.full(xs.shape, ((1 << (z * 2)) - 1) // 3, dtype=np.int64)
+    for a in range(z - 1, -1, -1):
+        s = 1 << a
+        rx, ry = (xs & s) != 0, (ys & s) != 0
+        acc += ((3 * rx) ^ ry).astype(np.int64) * (s * s)
+        flip = rx & ~ry
+        xs, ys = np.where(flip, s - 1 - xs, xs), np.where(flip, s - 1 - ys, ys)
+        xs, ys = np.where(ry, xs, ys), np.where(ry, ys, xs)
+    return acc
+
+
+# == Directories ==
+
+def _write_varint(buf: bytearray, n: int):
+    while n >= 0x80:
+        buf.append((n & 0x7F) | 0x80)
+        n >>= 7
+    buf.append(n)
+
+
+def _read_varint(buf: bytes, pos: int) -> tuple[int, int]:
+    n = shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        n |= (b & 0x7F) << shift
+        if b < 0x80:
+            return n, pos
+        shift += 7
+
+
+class Entries:
+    """Directory entries as compact arrays (24 bytes per entry instead of ~100 for tuples).
+       `run_length == 0` marks a pointer to a leaf directory."""
+    def __init__(self):
+        self.tile_id, self.offset = array('Q'), array('Q')
+        self.length, self.run_length = array('L'), array('L')
+        self._ids = None  # NumPy view of `tile_id`, once searched
+
+    def __len__(self):
+        return len(self.tile_id)
+
+    def append(self, tile_id, offset, length, run_length):
+        self.tile_id.append(tile_id)
+        self.offset.append(offset)
+        self.length.append(length)
+        self.run_length.append(run_length)
+
+    def find(self, tile_id: int) -> int:
+        """Index of the last entry with a tile id <= `tile_id`, -1 if none.
+           Don't `append` afterwards: the NumPy view locks `tile_id`."""
+        if self._ids is None:
+            self._ids = np.frombuffer(self.tile_id, np.uint64) if len(self) else np.zeros(0, np.uint64)
+        return int(np.searchsorted(self._ids, tile_id, side='right')) - 1
+
+    def slice(self, i, j) -> 'Entries':
+        res = Entries()
+        res.tile_id, res.offset = self.tile_id[i:j], self.offset[i:j]
+        res.length, res.run_length = self.length[i:j], self.run_length[i:j]
+        return res
+
+    def serialize(self, compression=COMPRESSION['gzip']) -> bytes:
+        buf = bytearray()
+        _write_varint(buf, len(self))
+        last = 0
+        for t in self.tile_id:
+            _write_varint(buf, t - last)
+            last = t
+        for r in self.run_length:
+            _write_varint(buf, r)
+        for n in self.length:
+            _write_varint(buf, n)
+        for i, o in enumerate(self.offset):
+            if i > 0 and o == self.offset[i - 1] + self.length[i - 1]:
+                _write_varint(buf, 0)
+            else:
+                _write_varint(buf, o + 1)
+        return _compress(bytes(buf), compression)
+
+    @classmethod
+    def deserialize(cls, data: bytes, compression=COMPRESSION['gzip']) -> 'Entries':
+        buf = _decompress(data, compression)
+        n, pos = _read_varint(buf, 0)
+        res = cls()
+        last = 0
+        for _ in range(n):
+            d, pos = _read_varint(buf, pos)
+            last += d
+            res.tile_id.append(last)
+        for col in (res.run_length, res.length):
+            for _ in range(n):
+                v, pos = _read_varint(buf, pos)
+                col.append(v)
+        for i in range(n):
+            v, pos = _read_varint(buf, pos)
+            res.offset.append(res.offset[i - 1] + res.length[i - 1] if v == 0 and i > 0 else v - 1)
+        return res
+
+
+def _compress(data: bytes, compression: int) -> bytes:
+    if compression == COMPRESSION['gzip']:
+        return gzip.compress(data, compresslevel=6, mtime=0)
+    assert compression in (COMPRESSION['none'], COMPRESSION['unknown']), f'Unsupported compression {compression}'
+    return data
+
+
+def _decompress(data: bytes, compression: int) -> bytes:
+    if compression == COMPRESSION['gzip']:
+        return gzip.decompress(data)
+    if compression == COMPRESSION['zstd']:
+        import zstandard  # optional
+        return zstandard.ZstdDecompressor().decompress(data)
+    if compression == COMPRESSION['brotli']:
+        import brotli  # optional
+        return brotli.decompress(data)
+    return data
+
+
+def build_directories(entries: Entries, root_max=ROOT_MAX, leaf_size=4096) -> tuple[bytes, bytes]:
+    """Root directory, and leaf directories if all entries do not fit in the root"""
+    root = entries.serialize()
+    if len(root) <= root_max:
+        return root, b''
+    while True:
+        root_entries, leaves = Entries(), bytearray()
+        for i in range(0, len(entries), leaf_size):
+            leaf = entries.slice(i, i + leaf_size).serialize()
+            root_entries.append(entries.tile_id[i], len(leaves), len(leaf), 0)
+            leaves += leaf
+        root = root_entries.serialize()
+        if len(root) <= root_max:
+            return root, bytes(leaves)
+        leaf_size *= 2
+
+
+# == Writer ==
+
+def _tms_blocks(ts: Tileset, z: int, k: int):
+    """Aligned blocks of 2^k x 2^k tiles of zoom `z` which hold tiles, in Hilbert order.
+       Each block is a contiguous range of tile ids, so concatenating them sorted
+       gives all tiles in tile id order, while reading a bounded amount at a time."""
+    blocks = ts.project(z, z - k)
+    if z - k not in blocks.z:
+        return []
+    bxs, bys = blocks.coords(z - k)
+    order = np.argsort(zxy_to_tileids(z - k, bxs, (1 << (z - k)) - 1 - bys))
+    return list(zip(bxs[order].tolist(), bys[order].tolist()))
+
+
+def mbt_to_pmtiles(source: DB, dest: str, block_zoom=5, dedup_max_bytes=1 << 16,
+                   root_max=ROOT_MAX, log=print) -> Header:
+    """Stream an MBTiles into a clustered PMTiles v3 archive.
+       Tiles are read by aligned blocks of `2^block_zoom` tiles squared (ie at most 1024),
+       so memory is bounded by one block of tiles plus the directory (24 bytes per entry).
+       Identical tiles of up to `dedup_max_bytes` (typically blank/uniform ones) are stored once;
+       consecutive ones become a single run-length entry.
+       Tile data goes to a temporary file first, as it comes after the directories."""
+    source = mbt_path(source)
+    assert dest.endswith('.pmtiles')
+    meta = get_meta(source)
+    fmt = meta.get('format', 'png')
+    entries = Entries()
+    seen: dict[bytes, tuple[int, int]] = {}  # hash -> offset, length
+    offset = addressed = contents = 0
+    last_id = last_offset = -1
+    with cursor(source) as dbc, \
+         tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(dest))) as data:
+        zmin, zmax, bounds = real_bounds(dbc)
+        ts = Tileset.from_db(dbc)
+        for z in sorted(ts.z):
+            k = min(block_zoom, z)
+            for bx, by in _tms_blocks(ts, z, k):
+                xs = ','.join(map(str, range(bx << k, (bx + 1) << k)))
+                rows = dbc.execute(f'''
+                    SELECT tile_column, tile_row, tile_data FROM tiles
+                    WHERE zoom_level = ? AND tile_column IN ({xs}) AND tile_row BETWEEN ? AND ?''',
+                    (z, by << k, ((by + 1) << k) - 1)).fetchall()
+                ids = zxy_to_tileids(z, [r[0] for r in rows], [(1 << z) - 1 - r[1] for r in rows])
+                for i in np.argsort(ids):
+                    tile_id, im = int(ids[i]), rows[i][2]
+                    addressed += 1
+                    key = hashlib.md5(im).digest() if len(im) <= dedup_max_bytes else None
+                    if key in seen:
+                        o, n = seen[key]
+                    else:
+                        o, n = offset, len(im)
+                        data.write(im)
+                        offset += n
+                        contents += 1
+                        if key:
+                            seen[key] = (o, n)
+                    if o == last_offset and tile_id == last_id + entries.run_length[-1]:
+                        entries.run_length[-1] += 1
+                    else:
+                        entries.append(tile_id, o, n, 1)
+                        last_id, last_offset = tile_id, o
+            log(f'z{z}: {addressed} tiles, {len(entries)} entries, {offset >> 20} MB')
+
+        root, leaves = build_directories(entries, root_max=root_max)
+        metadata = _compress(json.dumps(meta).encode(), COMPRESSION['gzip'])
+        if 'center' in meta:
+            clng, clat, cz = map(float, meta['center'].split(','))
+        else:
+            clng, clat, cz = (bounds.west + bounds.east) / 2, (bounds.south + bounds.north) / 2, zmin
+        bb = parse_bounds(meta['bounds']) if 'bounds' in meta else bounds
+        e7 = lambda f: int(round(f * 1e7))
+        moff = HEADER_LEN + len(root)
+        header = Header(
+            HEADER_LEN, len(root), moff, len(metadata), moff + len(metadata), len(leaves),
+            moff + len(metadata) + len(leaves), offset, addressed, len(entries), contents,
+            1, COMPRESSION['gzip'], COMPRESSION['gzip'] if fmt == 'pbf' else COMPRESSION['none'],
+            TILE_TYPE.get(fmt, 0), zmin, zmax, e7(bb.west), e7(bb.south), e7(bb.east), e7(bb.north),
+            int(cz), e7(clng), e7(clat))
+        with open(dest, 'wb') as f:
+            f.write(header.pack())
+            f.write(root)
+            f.write(metadata)
+            f.write(leaves)
+            data.seek(0)
+            shutil.copyfileobj(data, f, 1 << 24)
+    log(f'{dest}: {addressed} tiles, {header.tile_contents} distinct, {os.path.getsize(dest) >> 20} MB')
+    return header
+
+
+# == Reader ==
+
+class PMTiles:
+    """Random and sequential read access to a PMTiles v3 archive.
+       The last `leaf_cache` leaf directories read are kept decoded (~100 KB each)."""
+    def __init__(self, path: str, leaf_cache=64):
+        self.path = os.path.expanduser(path)
+        self.leaf_cache = leaf_cache
+        self._leaves: OrderedDict = OrderedDict()
+        self.f = open(self.path, 'rb')
+        self.header = Header.unpack(self._read(0, HEADER_LEN))
+        h = self.header
+        self.root = Entries.deserialize(self._read(h.root_offset, h.root_length), h.internal_compression)
+
+    def _read(self, offset, length) -> bytes:
+        self.f.seek(offset)
+        return self.f.read(length)
+
+    def close(self):
+        self.f.close()
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        self.close()
+
+    def metadata(self) -> dict:
+        h = self.header
+        return json.loads(_decompress(self._read(h.metadata_offset, h.metadata_length), h.internal_compression))
+
+    def _leaf(self, offset, length) -> Entries:
+        if offset in self._leaves:
+            self._leaves.move_to_end(offset)
+            return self._leaves[offset]
+        h = self.header
+        leaf = self._leaves[offset] = Entries.deserialize(self._read(h.leaf_offset + offset, length),
+                                                          h.internal_compression)
+        if len(self._leaves) > self.leaf_cache:
+            self._leaves.popitem(last=False)
+        return leaf
+
+    def _entries(self, d: Entries) -> Iterator[tuple[int, int, int, int]]:
+        """Depth-first, so in tile id order, loading one leaf directory at a time"""
+        for i in range(len(d)):
+            if d.run_length[i]:
+                yield d.tile_id[i], d.offset[i], d.length[i], d.run_length[i]
+            else:
+                yield from self._entries(self._leaf(d.offset[i], d.length[i]))
+
+    def get(self, z: int, x: int, y: int, flip_y=True) -> 'bytes|None':
+        """Tile data. `y` is TMS (as in MBTiles) unless `flip_y=False`"""
+        if flip_y:
+            y = (1 << z) - y - 1
+        tile_id = zxy_to_tileid(z, x, y)
+        d = self.root
+        for _depth in range(4):
+            i = d.find(tile_id)
+            if i < 0:
+                return None
+            if d.run_length[i] == 0:
+                d = self._leaf(d.offset[i], d.length[i])
+            elif tile_id < d.tile_id[i] + d.run_length[i]:
+                return _decompress(self._read(self.header.data_offset + d.offset[i], d.length[i]),
+                                   self.header.tile_compression)
+            else:
+                return None
+        return None
+
+    def __iter__(self) -> Iterator[tuple[int, int, int, bytes]]:
+        """(z, x, y, tile_data) with TMS `y`, in tile id order.
+           Clustered archives are thus read sequentially."""
+        h = self.header
+        for tile_id, offset, length, run_length in self._entries(self.root):
+            im = _decompress(self._read(h.data_offset + offset, length), h.tile_compression)
+            for t in range(tile_id, tile_id + run_length):
+                z, x, y = tileid_to_zxy(t)
+                yield z, x, (1 << z) - y - 1, im
+
+    def zoom(self, z: int) -> Iterator[tuple[int, int, int, bytes]]:
+        """Like iterating, for zoom level `z` only: the data of other levels is not read"""
+        h = self.header
+        first, end = zxy_to_tileid(z, 0, 0), zxy_to_tileid(z + 1, 0, 0)  # ids of z are contiguous
+        for tile_id, offset, length, run_length in self._entries(self.root):
+            if tile_id + run_length <= first or tile_id >= end:
+                continue
+            im = _decompress(self._read(h.data_offset + offset, length), h.tile_compression)
+            for t in range(max(tile_id, first), min(tile_id + run_length, end)):
+                _, x, y = tileid_to_zxy(t)
+                yield z, x, (1 << z) - y - 1, im
+
+
+def get_all_pmtiles(path: str) -> Iterator[tuple[int, int, int, bytes]]:
+    """Same rows as `mbt_util.get_all_tiles`"""
+    with PMTiles(path) as pmt:
+        yield from pmt
+
+
+def pmtiles_to_mbt(source: str, dest: str, batch=1000, dedup=False, overwrite=False, log=print):
+    """Convert, with metadata. Bounds/center/zooms come from the header if not in the metadata."""
+    _, dest = validate_src_dst(dest, dest, overwrite) if os.path.exists(dest) else (None, dest)
+    create_mbt(dest, dedup=dedup)
+    with PMTiles(source) as pmt, cursor(dest) as dbc:
+        h = pmt.header
+        meta = pmt.metadata()
+        dbc.executemany('INSERT INTO metadata (name, value) VALUES (?, ?) ON CONFLICT (name) DO NOTHING',
+                        [(k, v if isinstance(v, str) else json.dumps(v)) for k, v in meta.items()])
+        rows = []
+        for row in pmt:
+            rows.append(row)
+            if len(rows) >= batch:
+                insert_tiles(dbc, rows)
+                rows = []
+        insert_tiles(dbc, rows)
+        update_mbt_meta(dbc, format=TILE_FORMAT.get(h.tile_type), zmin=h.min_zoom, zmax=h.max_zoom,
+                        bounds=[v / 1e7 for v in (h.min_lon_e7, h.min_lat_e7, h.max_lon_e7, h.max_lat_e7)],
+                        center=((h.center_lon_e7 / 1e7, h.center_lat_e7 / 1e7), h.center_zoom),
+                        overwrite=False, log=log)
+    log(f'{source} -> {dest}: {h.addressed_tiles} tiles')
+
+
+class TestPMTiles(TestCase):
+    def test_tileid(self):
+        self.assertEqual([zxy_to_tileid(*t) for t in ((0, 0, 0), (1, 0, 0), (1, 0, 1), (1, 1, 1), (1, 1, 0))],
+                         [0, 1, 2, 3, 4])
+        for t in ((5, 3, 7), (12, 2111, 1470), (16, 34000, 23000)):
+            self.assertEqual(tileid_to_zxy(zxy_to_tileid(*t)), t)
+            self.assertEqual(zxy_to_tileids(t[0], [t[1]], [t[2]])[0], zxy_to_tileid(*t))
+
+    def test_roundtrip(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            mbt, pmt, back = (os.path.join(tmp, n) for n in ('a.mbtiles', 'a.pmtiles', 'b.mbtiles'))
+            create_mbt(mbt)
+            update_mbt_meta(mbt, name='a', format='png')
+            rows = [(z, x, y, b'blank' if (x + y) % 3 else b'%d/%d/%d' % (z, x, y))
+                    for z in (7, 8) for x in range(60, 80) for y in range(70, 90)]
+            insert_tiles(mbt, rows)
+            update_mbt_meta(mbt, bounds=real_bounds(mbt)[2])
+            header = mbt_to_pmtiles(mbt, pmt, block_zoom=2, root_max=200, log=lambda *a: None)
+            self.assertGreater(header.leaf_length, 0)
+            self.assertEqual(header.addressed_tiles, len(rows))
+            self.assertLess(header.tile_contents, len(rows))
+            with PMTiles(pmt) as p:
+                self.assertEqual(p.get(8, 60, 72), b'8/60/72')
+                self.assertIsNone(p.get(8, 0, 0))
+                self.assertEqual(p.metadata()['name'], 'a')
+                leaf = p.root.find(zxy_to_tileid(8, 60, (1 << 8) - 72 - 1))
+                self.assertIs(p._leaf(p.root.offset[leaf], p.root.length[leaf]), p._leaves[p.root.offset[leaf]])
+            with PMTiles(pmt, leaf_cache=1) as p:
+                for z, x, y, im in rows[::7]:
+                    self.assertEqual(p.get(z, x, y), im)
+                self.assertEqual(len(p._leaves), 1)
+            self.assertEqual(sorted(get_all_pmtiles(pmt)), sorted(rows))
+            with PMTiles(pmt) as p:
+                self.assertEqual(sorted(p.zoom(8)), sorted(r for r in rows if r[0] == 8))
+            pmtiles_to_mbt(pmt, back, log=lambda *a: None)
+            self.assertEqual(get_meta(back)['format'], 'png')
+            with cursor(back) as dbc:
+                self.assertEqual(sorted(dbc.execute('SELECT * FROM tiles')), sorted(rows))
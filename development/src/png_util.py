@@ -0,0 +1,411 @@
+"""PNG tiles optimization, in-process and multi-core, replacing the external
+   `pngquant` / `mbtcompress.py` round trip of the packaging notebooks:
+   `recompress_mbt` re-encodes the tiles of an MBTiles in place, keeping each one only if smaller.
+   `clean_uniform_tiles` removes (or shrinks) the tiles of a single color, eg white nodata.
+
+   `optimize_png` tries, for one tile of at most 8 bits per channel (others are kept as is):
+   * an indexed (PNG8) encoding with only the colors used, as few bits per pixel as possible,
+     and the opaque entries last so `tRNS` is short. Lossless, unless `max_colors` is given:
+     tiles with more colors are then quantized (lossy, like `pngquant`)
+   * zlib level 9 with each of `STRATEGIES`, and zopfli on the best one if installed
+     (`pip install zopfli`, optional: much slower, typically 3-8% smaller)
+"""
+import io
+import os
+import shutil
+import struct
+import tempfile
+from collections import deque
+from multiprocessing import Pool
+from unittest import TestCase
+import zlib
+
+import numpy as np
+import PIL.Image
+
+from .mbt_util import MBTiles, insert_tiles, iter_tile_batches, update_tiles, validate_src_dst
+
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+STRATEGIES = (zlib.Z_DEFAULT_STRATEGY, zlib.Z_FILTERED, zlib.Z_RLE)
+EXACT_MODES = {'1', 'L', 'LA', 'P', 'PA', 'RGB', 'RGBA'}  # 8 bits per channel at most: RGBA holds them
+
+
+def png_chunks(data: bytes) -> list[tuple[bytes, bytes]]:
+    """[(type, payload)] of a PNG, eg `b'IHDR'`"""
+    assert data[:8] == PNG_SIGNATURE, 'not a PNG'
+    chunks, i = [], 8
+    while i + 8 <= len(data):
+        n, typ = struct.unpack('>I4s', data[i:i + 8])
+        chunks.append((typ, data[i + 8:i + 8 + n]))
+        i += 12 + n
+    return chunks
+
+
+def make_png(chunks: list[tuple[bytes, bytes]]) -> bytes:
+    return PNG_SIGNATURE + b''.join(struct.pack('>I', len(p)) + t + p + struct.pack('>I', zlib.crc32(t + p))
+                                    for t, p in chunks)
+
+
+def _zopfli(data: bytes) -> bytes:
+    """`data` with its IDAT recompressed by zopfli, if installed"""
+    try:
+        import zopfli.zlib  # type: ignore
+    except ImportError:
+        return data
+    chunks = png_chunks(data)
+    raw = zlib.decompress(b''.join(p for t, p in chunks if t == b'IDAT'))
+    i = next(i for i, (t, _) in enumerate(chunks) if t == b'IDAT')
+    rest = [c for c in chunks[i:] if c[0] != b'IDAT']
+    return make_png([*chunks[:i], (b'IDAT', zopfli.zlib.compress(raw)), *rest])
+
+
+def _encode(im: 'PIL.Image.Image', **kw) -> bytes:
+    buf = io.BytesIO()
+    im.save(buf, 'PNG', **kw)
+    return buf.getvalue()
+
+
+def optimize_png(data: bytes, max_colors: int = None, zopfli=False) -> bytes:
+    """Smallest encoding found for the same pixels (see module doc), `data` itself if none is smaller
+       :param max_colors: quantize tiles with more colors to this many (lossy)"""
+    im = PIL.Image.open(io.BytesIO(data))
+    if im.mode not in EXACT_MODES or data[:8] == PNG_SIGNATURE and data[24] > 8:  # IHDR bit depth
+        return data  # eg 16 bits DEM or RGB, which PIL reads as 8 bits
+    rgba = np.asarray(im.convert('RGBA'))
+    h, w, _ = rgba.shape
+    colors, index = np.unique(rgba.reshape(-1, 4).view(np.uint32)[:, 0], return_inverse=True)
+    if max_colors and len(colors) > max_colors:
+        im = PIL.Image.fromarray(rgba, 'RGBA').quantize(max_colors, method=PIL.Image.Quantize.FASTOCTREE)
+        rgba = np.asarray(im.convert('RGBA'))
+        colors, index = np.unique(rgba.reshape(-1, 4).view(np.uint32)[:, 0], return_inverse=True)
+    if len(colors) <= 256:
+        palette = colors.view(np.uint8).reshape(-1, 4)
+        order = np.argsort(palette[:, 3] == 255, kind='stable')  # translucent entries first
+        palette, index = palette[order], np.argsort(order)[index]
+        out = PIL.Image.fromarray(index.reshape(h, w).astype(np.uint8), 'P')
+        out.putpalette(palette[:, :3].tobytes())  # its length sets the bit depth
+        translucent = int((palette[:, 3] < 255).sum())
+        kw = {'transparency': palette[:translucent, 3].tobytes()} if translucent else {}
+    else:
+        out, kw = PIL.Image.fromarray(rgba if (rgba[..., 3] < 255).any() else rgba[..., :3]), {}
+    best = min((_encode(out, compress_level=9, compress_type=s, **kw) for s in STRATEGIES), key=len)
+    if zopfli:
+        best = min(best, _zopfli(best), key=len)
+    return best if len(best) < len(data) else data
+
+
+_worker_opts: dict = {}
+
+def _init_png_worker(opts):
+    global _worker_opts
+    _worker_opts = opts
+
+
+def _optimize_batch(rows, opts=None):
+    """rows: list of (z, x, y, im) -> (list of (new_im, z, x, y) for smaller tiles only,
+       {z: [tiles, bytes before, bytes after]})"""
+    opts = opts if opts is not None else _worker_opts
+    updates, stats, done = [], {}, {}
+    for z, x, y, im in rows:
+        if im not in done:  # duplicate blobs are encoded once
+            done[im] = optimize_png(im, **opts)
+        new = done[im]
+        s = stats.setdefault(z, [0, 0, 0])
+        s[0] += 1
+        s[1] += len(im)
+        s[2] += len(new)
+        if new is not im:
+            updates.append((new, z, x, y))
+    return updates, stats
+
+
+def recompress_mbt(source: str, dest: str = '', zooms: list[int] = [], max_colors: int = None,
+                   zopfli=False, processes=os.cpu_count(), batch=256, vacuum=True, overwrite=False,
+                   log=print) -> dict[int, tuple[int, int, int]]:
+    """Re-encode the PNG tiles of `source` (in place if no `dest`) with `optimize_png`,
+       in batches across `processes`, like `apply_to_tiles`: one transaction per batch,
+       only tiles that got smaller are written.
+       :param vacuum: VACUUM at the end, for the file to actually shrink
+       :return: {z: (tiles, bytes before, bytes after)}"""
+    source, dest = validate_src_dst(source, dest or source, overwrite or not dest, fun_inplace=True)
+    if dest != source:
+        log(f'cp {source} {dest}')
+        shutil.copyfile(source, dest)
+    opts = {'max_colors': max_colors, 'zopfli': zopfli}
+    stats: dict[int, list[int]] = {}
+    pool = None
+    inflight = deque()
+
+    def write_oldest():
+        updates, batch_stats = inflight.popleft().get() if pool else inflight.popleft()
+        with mbt.batch() as dbc:
+            update_tiles(dbc, updates)
+        for z, s in batch_stats.items():
+            stats[z] = [a + b for a, b in zip(stats.get(z, [0, 0, 0]), s)]
+
+    with MBTiles(dest) as mbt:
+        try:  # the pool is terminated whatever fails
+            pool = Pool(processes, initializer=_init_png_worker, initargs=(opts,)) if processes > 1 else None
+            with mbt.batch() as dbc:
+                zooms = zooms or [z for z, in dbc.execute('SELECT DISTINCT zoom_level FROM tiles ORDER BY 1')]
+            reader = mbt.db.cursor()  # each batch is fully fetched before we write
+            for z in zooms:
+                for rows in iter_tile_batches(reader, z, batch):
+                    inflight.append(pool.apply_async(_optimize_batch, (rows,)) if pool
+                                    else _optimize_batch(rows, opts))
+                    if len(inflight) >= 2 * processes:
+                        write_oldest()
+                while inflight:
+                    write_oldest()
+                if z in stats:
+                    n, before, after = stats[z]
+                    log(f'z{z}: {n} tiles, {before >> 10} -> {after >> 10} KiB, saved {(before - after) >> 10} KiB'
+                        f' ({1 - after / before:.1%})')
+        finally:
+            if pool:
+                pool.terminate()
+        if vacuum:
+            mbt.db.execute('VACUUM')
+    return {z: tuple(s) for z, s in sorted(stats.items())}
+
+
+CLEAR = (0, 0, 0, 0)
+WHITE_BLACK_CLEAR = ((255, 255, 255, 255), (0, 0, 0, 255), CLEAR)
+
+
+def rgba_palette(im: 'PIL.Image.Image') -> np.ndarray:
+    """RGBA palette (uint8, n x 4) of an indexed image, with the alpha of its `tRNS`"""
+    rgb = np.asarray(im.getpalette('RGB'), np.uint8).reshape(-1, 3)
+    alpha = np.full(len(rgb), 255, np.uint8)
+    trns = im.info.get('transparency')
+    if isinstance(trns, bytes):
+        alpha[:len(trns)] = np.frombuffer(trns, np.uint8)[:len(rgb)]
+    elif isinstance(trns, int) and trns < len(rgb):
+        alpha[trns] = 0
+    return np.hstack([rgb, alpha[:, None]])
+
+
+def _pixel_counts(data: bytes) -> tuple[np.ndarray, np.ndarray]:
+    """(RGBA colors as uint32, pixel counts) of a PNG, fully transparent pixels counted as `CLEAR`"""
+    im = PIL.Image.open(io.BytesIO(data))
+    if im.mode == 'P':  # count indices, not pixels
+        palette = rgba_palette(im)
+        counts = np.bincount(np.asarray(im).ravel(), minlength=len(palette))
+        palette[palette[:, 3] == 0] = CLEAR
+        colors, inverse = np.unique(palette.view(np.uint32)[:, 0], return_inverse=True)
+        return colors, np.bincount(inverse, weights=counts[:len(palette)]).astype(np.int64)
+    rgba = np.asarray(im.convert('RGBA')).reshape(-1, 4).copy()
+    rgba[rgba[:, 3] == 0] = CLEAR
+    return np.unique(rgba.view(np.uint32)[:, 0], return_counts=True)
+
+
+def uniform_color(data: bytes, threshold=1.) -> 'tuple|None':
+    """RGBA color of at least `threshold` of the pixels of a PNG, if any (`CLEAR` for transparent ones).
+       Indexed PNGs whose palette has a single color are not decoded."""
+    chunks = dict(png_chunks(data)[:4])  # IHDR, and PLTE / tRNS come before IDAT
+    if chunks[b'IHDR'][9] == 3 and b'PLTE' in chunks:
+        rgb = np.frombuffer(chunks[b'PLTE'], np.uint8).reshape(-1, 3)
+        alpha = np.full(len(rgb), 255, np.uint8)
+        trns = np.frombuffer(chunks.get(b'tRNS', b''), np.uint8)[:len(rgb)]
+        alpha[:len(trns)] = trns
+        palette = np.hstack([rgb, alpha[:, None]])
+        palette[alpha == 0] = CLEAR
+        if (palette == palette[0]).all():
+            return tuple(palette[0].tolist())
+    colors, counts = _pixel_counts(data)
+    top = counts.argmax()
+    if counts[top] >= threshold * counts.sum():
+        return tuple(np.array([colors[top]], np.uint32).view(np.uint8).tolist())
+    return None
+
+
+def uniform_png(color: tuple, width=256, height=256) -> bytes:
+    """Smallest PNG of a single `color`: 1-bit indexed"""
+    im = PIL.Image.new('P', (width, height), 0)
+    im.putpalette(bytes(color[:3]))
+    return _encode(im, optimize=True, **({'transparency': bytes(color[3:])} if color[3] < 255 else {}))
+
+
+def _uniform_batch(blobs, threshold=None):
+    """-> [(color or None, replacement PNG or None)] of each blob, not uniform if not a valid PNG"""
+    threshold = threshold if threshold is not None else _worker_opts['threshold']
+    out = []
+    for blob in blobs:
+        try:
+            color = uniform_color(blob, threshold)
+        except (AssertionError, KeyError, OSError, ValueError, struct.error):
+            color = None
+        if color is None:
+            out.append((None, None))
+        else:
+            w, h = struct.unpack('>II', png_chunks(blob)[0][1][:8])
+            out.append((color, uniform_png(color, w, h)))
+    return out
+
+
+def clean_uniform_tiles(source: str, dest: str = '', zooms: list[int] = [], threshold=1.,
+                        colors: 'tuple|None' = WHITE_BLACK_CLEAR, replace=False, max_bytes=4096,
+                        dry_run=False, processes=os.cpu_count(), batch=256, vacuum=True,
+                        overwrite=False, log=print) -> dict[int, tuple[int, int]]:
+    """Delete the tiles that are (almost) a single color, eg white nodata, or with `replace`,
+       replace them by the smallest PNG of that color.
+       Candidate tiles are grouped by length and content: each distinct blob is decoded once,
+       across `processes`, and only blobs of at most `max_bytes` are candidates
+       (a uniform 256x256 PNG is a few hundred bytes, even RGB; raise it with a low `threshold`).
+       Then uniform tiles are removed / replaced with one statement.
+       :param threshold: minimum share of the pixels of one color, 1 for strictly uniform tiles
+       :param colors: RGBA colors to eliminate (transparent pixels are `CLEAR`), None for any
+       :param dry_run: only report, `dest` is not created
+       :return: {z: (tiles, bytes)} removed (or saved, when replacing)"""
+    if not dry_run:
+        source, dest = validate_src_dst(source, dest or source, overwrite or not dest, fun_inplace=True)
+        if dest != source:
+            log(f'cp {source} {dest}')
+            shutil.copyfile(source, dest)
+    allowed = None if colors is None else set(map(tuple, colors))
+    pool = None
+    report: dict[int, list[int]] = {}
+    uniform: list[tuple[bytes, 'bytes|None']] = []
+    inflight = deque()  # of ([(blob, [(z, count)])], async result)
+
+    def submit(groups):
+        blobs = [g[0] for g in groups]
+        inflight.append((groups, pool.apply_async(_uniform_batch, (blobs,)) if pool
+                         else _uniform_batch(blobs, threshold)))
+
+    def classify_oldest():
+        groups, results = inflight.popleft()
+        for (blob, zcounts), (color, replacement) in zip(groups, results.get() if pool else results):
+            if color is None or allowed is not None and color not in allowed:
+                continue
+            if replace and len(replacement) >= len(blob):
+                continue
+            uniform.append((blob, replacement if replace else None))
+            for z, n in zcounts:
+                r = report.setdefault(z, [0, 0])
+                r[0] += n
+                r[1] += n * (len(blob) - (len(replacement) if replace else 0))
+
+    with MBTiles(dest if not dry_run else source, readonly=dry_run) as mbt:
+        try:  # the pool is terminated whatever fails
+            pool = Pool(processes, initializer=_init_png_worker, initargs=({'threshold': threshold},)) \
+                if processes > 1 else None
+            zfilter = f'AND zoom_level IN ({",".join(map(str, map(int, zooms)))})' if zooms else ''
+            reader = mbt.db.execute(f'''
+                SELECT tile_data, zoom_level, COUNT(*) FROM tiles
+                WHERE length(tile_data) <= ? {zfilter}
+                GROUP BY length(tile_data), tile_data, zoom_level
+                ORDER BY length(tile_data), tile_data''', (max_bytes,))
+            groups, prev = [], None
+            for blob, z, n in reader:  # consecutive rows of the same blob (ORDER BY), one per zoom
+                if blob == prev:
+                    groups[-1][1].append((z, n))
+                    continue
+                if len(groups) == batch:
+                    submit(groups)
+                    if len(inflight) >= 2 * processes:
+                        classify_oldest()
+                    groups = []
+                groups.append((blob, [(z, n)]))
+                prev = blob
+            if groups:
+                submit(groups)
+            while inflight:
+                classify_oldest()
+        finally:
+            if pool:
+                pool.terminate()
+        for z, (n, size) in sorted(report.items()):
+            log(f'z{z}: {n} uniform tiles, {size >> 10} KiB{" (dry run)" if dry_run else ""}')
+        if dry_run or not uniform:
+            return {z: tuple(r) for z, r in sorted(report.items())}
+        with mbt.batch() as dbc:
+            dbc.execute('CREATE TEMP TABLE uniform (tile_data BLOB PRIMARY KEY, replacement BLOB)')
+            dbc.executemany('INSERT INTO temp.uniform VALUES (?, ?)', uniform)
+            if replace:
+                dbc.execute(f'''
+                    UPDATE tiles SET tile_data = (SELECT replacement FROM temp.uniform u WHERE u.tile_data = tiles.tile_data)
+                    WHERE length(tile_data) <= ? {zfilter} AND tile_data IN (SELECT tile_data FROM temp.uniform)''',
+                    (max_bytes,))
+            else:
+                dbc.execute(f'''
+                    DELETE FROM tiles
+                    WHERE length(tile_data) <= ? {zfilter} AND tile_data IN (SELECT tile_data FROM temp.uniform)''',
+                    (max_bytes,))
+            dbc.execute('DROP TABLE temp.uniform')
+        if vacuum:
+            mbt.db.execute('VACUUM')
+    return {z: tuple(r) for z, r in sorted(report.items())}
+
+
+class TestPng(TestCase):
+    def test_optimize(self):
+        rng = np.random.default_rng(0)
+        rgb = rng.integers(0, 4, (256, 256, 1)) * np.array([[[60, 50, 40]]])
+        rgba = np.dstack([rgb, np.where(rgb[..., :1] == 0, 0, 255)]).astype(np.uint8)
+        png = _encode(PIL.Image.fromarray(rgba, 'RGBA'), compress_level=1)
+        small = optimize_png(png)
+        self.assertLess(len(small), len(png))
+        decoded = lambda b: np.asarray(PIL.Image.open(io.BytesIO(b)).convert('RGBA'))
+        self.assertTrue((decoded(small) == rgba).all())
+        self.assertEqual(PIL.Image.open(io.BytesIO(small)).mode, 'P')
+        self.assertIs(optimize_png(small), small)  # not smaller: kept
+        deep = _encode(PIL.Image.fromarray(np.repeat(np.arange(4, dtype=np.uint16) * 1000, 256 * 64).reshape(256, 256)))
+        self.assertEqual(PIL.Image.open(io.BytesIO(deep)).mode, 'I;16')
+        self.assertIs(optimize_png(deep), deep)  # 16 bits: kept
+        noisy = rng.integers(0, 256, (256, 256, 3), dtype=np.uint8)
+        lossy = optimize_png(_encode(PIL.Image.fromarray(noisy)), max_colors=16)
+        self.assertLessEqual(len(PIL.Image.open(io.BytesIO(lossy)).getcolors(256)), 16)
+
+    def test_recompress(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            tile = np.zeros((256, 256, 3), np.uint8)
+            tile[:, 128:] = (10, 200, 30)
+            png = _encode(PIL.Image.fromarray(tile), compress_level=0)
+            with MBTiles(f'{tmp}/a.mbtiles', create=True) as mbt:
+                insert_tiles(mbt, [(5, 1, 2, png), (5, 1, 3, png), (6, 0, 0, png)])
+            stats = recompress_mbt(f'{tmp}/a.mbtiles', processes=1, log=lambda *a: None)
+            self.assertEqual(set(stats), {5, 6})
+            self.assertEqual(stats[5][:2], (2, 2 * len(png)))
+            self.assertLess(stats[5][2], stats[5][1] / 10)
+            with MBTiles(f'{tmp}/a.mbtiles') as mbt, mbt.batch() as dbc:
+                data, = dbc.execute('SELECT tile_data FROM tiles WHERE zoom_level=6').fetchone()
+            self.assertTrue((np.asarray(PIL.Image.open(io.BytesIO(data)).convert('RGB')) == tile).all())
+
+    def test_uniform(self):
+        white = np.full((256, 256, 3), 255, np.uint8)
+        nearly = white.copy()
+        nearly[:2, :100] = 0  # 99.7% white
+        mixed = np.random.default_rng(0).integers(0, 256, (256, 256, 3), dtype=np.uint8)
+        indexed = PIL.Image.fromarray((np.arange(256 * 256) % 300 == 0).reshape(256, 256).astype(np.uint8), 'P')
+        indexed.putpalette(bytes([9, 9, 9, 255, 0, 0]))
+        clear = PIL.Image.new('RGBA', (256, 256), (10, 20, 30, 0))
+        tiles = {(9, 0, 0): uniform_png((255, 255, 255, 255)), (9, 0, 1): _encode(PIL.Image.fromarray(white)),
+                 (9, 0, 2): _encode(PIL.Image.fromarray(nearly)), (9, 0, 3): _encode(PIL.Image.fromarray(mixed)),
+                 (10, 0, 0): _encode(clear), (10, 0, 1): _encode(PIL.Image.new('RGB', (256, 256), (1, 2, 3)))}
+        self.assertEqual(uniform_color(tiles[9, 0, 0]), (255, 255, 255, 255))
+        self.assertEqual(uniform_color(tiles[10, 0, 0]), CLEAR)
+        self.assertIsNone(uniform_color(tiles[9, 0, 2]))
+        self.assertEqual(uniform_color(tiles[9, 0, 2], .99), (255, 255, 255, 255))
+        self.assertEqual(uniform_color(_encode(indexed), .99), (9, 9, 9, 255))
+        self.assertEqual(uniform_color(_encode(indexed, transparency=0), .99), CLEAR)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = f'{tmp}/u.mbtiles'
+            with MBTiles(path, create=True) as mbt:
+                insert_tiles(mbt, [(*k, v) for k, v in tiles.items()] + [(9, 1, 1, tiles[9, 0, 1])])
+            quiet = lambda *a: None
+            report = clean_uniform_tiles(path, dry_run=True, processes=1, log=quiet)
+            size = len(tiles[9, 0, 0]) + 2 * len(tiles[9, 0, 1])
+            self.assertEqual(report, {9: (3, size), 10: (1, len(tiles[10, 0, 0]))})
+            self.assertEqual(clean_uniform_tiles(path, dry_run=True, threshold=.99, processes=1, log=quiet)[9][0], 4)
+            self.assertEqual(clean_uniform_tiles(f'{tmp}/u.mbtiles', f'{tmp}/r.mbtiles', colors=None,
+                                                 replace=True, processes=2, batch=1, log=quiet)[10][0], 2)
+            self.assertEqual(clean_uniform_tiles(path, processes=1, log=quiet), report)
+            with MBTiles(path) as mbt, mbt.batch() as dbc:
+                left = {(z, x, y) for z, x, y in dbc.execute('SELECT zoom_level, tile_column, tile_row FROM tiles')}
+                self.assertEqual(left, {(9, 0, 2), (9, 0, 3), (10, 0, 1)})
+            with MBTiles(f'{tmp}/r.mbtiles') as mbt, mbt.batch() as dbc:
+                data, = dbc.execute('SELECT tile_data FROM tiles WHERE zoom_level=10 AND tile_row=1').fetchone()
+                self.assertEqual(uniform_color(data), (1, 2, 3, 255))
+                self.assertLess(len(data), len(tiles[10, 0, 1]))
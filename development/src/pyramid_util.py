@@ -0,0 +1,275 @@
+"""Overview pyramid of slope *values*: each parent tile is resampled in memory from its 4 children,
+   level by level, instead of one full `gdalwarp -r q3` of the region per zoom (`make_ovr`).
+
+   Slopes are kept as "value tiles" in an MBTiles: grayscale + alpha PNGs (`LA`), the gray being
+   the Byte slope (nodata 255) and alpha 0 outside the source raster. They are made from the
+   z16 slope GeoTIFF by `tif_to_values`, reduced by `build_pyramid`, then colored with a palette
+   per zoom by `render_values`.
+   Note parents are computed from the children (q3 of q3s...), not from all the z16 pixels.
+"""
+from collections import deque
+import contextlib
+import io
+from multiprocessing import Pool
+import os
+from typing import Iterable, Iterator
+from unittest import TestCase
+
+import numpy as np
+import PIL.Image
+
+from .mbt_util import DB, MBTiles, cursor, insert_tiles, iter_tile_batches, remove_tiles, \
+    set_real_bounds, update_mbt_meta, validate_src_dst, zoom_extents
+from .render_util import TILE, WHITE, Colorizer, encode_png8, raster_tiles, tile_origin, zoom_of
+
+
+NODATA = 255
+RESAMPLING = ('q3', 'mode', 'max')
+
+
+def encode_values(v: np.ndarray, alpha: np.ndarray) -> bytes:
+    buf = io.BytesIO()
+    PIL.Image.fromarray(np.dstack([v, alpha]), 'LA').save(buf, 'PNG')
+    return buf.getvalue()
+
+
+def decode_values(png: bytes) -> tuple[np.ndarray, np.ndarray]:
+    """-> (values, alpha), 2 uint8 arrays"""
+    la = np.asarray(PIL.Image.open(io.BytesIO(png)).convert('LA'))
+    return la[..., 0], la[..., 1]
+
+
+def downsample(v: np.ndarray, alpha: np.ndarray, method='q3', nodata=NODATA) -> tuple[np.ndarray, np.ndarray]:
+    """Halve (values, alpha) with `method` over each 2x2 block of valid (not nodata, alpha > 0) values:
+       * `q3`: third quartile, nearest-rank: the 3rd of 4, 2nd of 2...
+       * `mode`: most frequent, ties to the highest
+       * `max`
+       A pixel is nodata if its block has no valid value, and transparent if all 4 are."""
+    assert method in RESAMPLING, method
+    h, w = v.shape[0] // 2, v.shape[1] // 2
+    def blocks(a):
+        return a.reshape(h, 2, w, 2).transpose(0, 2, 1, 3).reshape(h, w, 4)
+    valid = blocks((v != nodata) & (alpha > 0))
+    n = valid.sum(axis=-1)
+    s = np.sort(np.where(valid, blocks(v).astype(np.int16), 256), axis=-1)  # invalid last
+    if method == 'max':
+        idx = n - 1
+    elif method == 'q3':
+        idx = (3 * n + 3) // 4 - 1
+    else:
+        counts = ((s[..., :, None] == s[..., None, :]) & (s[..., None, :] < 256)).sum(axis=-1)
+        idx = 3 - np.argmax(counts[..., ::-1], axis=-1)
+    out = np.take_along_axis(s, np.maximum(idx, 0)[..., None], axis=-1)[..., 0]
+    out = np.where(n > 0, out, nodata).astype(np.uint8)
+    return out, np.where(blocks(alpha).max(axis=-1) > 0, 255, 0).astype(np.uint8)
+
+
+def assemble(children: dict, nodata=NODATA) -> tuple[np.ndarray, np.ndarray]:
+    """512x512 (values, alpha) from `{(dx, dy): png}` TMS children, missing ones transparent"""
+    v = np.full((2 * TILE, 2 * TILE), nodata, dtype=np.uint8)
+    alpha = np.zeros((2 * TILE, 2 * TILE), dtype=np.uint8)
+    for (dx, dy), png in children.items():
+        r, c = (1 - dy) * TILE, dx * TILE  # TMS: north child (dy=1) on top
+        v[r:r + TILE, c:c + TILE], alpha[r:r + TILE, c:c + TILE] = decode_values(png)
+    return v, alpha
+
+
+_worker_fun = None
+_worker_args = None
+
+def _init_worker(fun, *args):
+    global _worker_fun, _worker_args
+    _worker_fun, _worker_args = fun, args
+
+
+def _run_batch(batch):
+    return _worker_fun(batch, *_worker_args)
+
+
+def _pool_map(fun, batches: Iterable, processes: int, *args) -> Iterator:
+    """`fun(batch, *args)` for each batch, in order, on a pool with at most `2*processes` batches
+       in flight (like `apply_to_tiles`) so the producer does not run ahead"""
+    if processes <= 1:
+        yield from (fun(b, *args) for b in batches)
+        return
+    inflight = deque()
+    with Pool(processes, initializer=_init_worker, initargs=(fun, *args)) as pool:
+        for b in batches:
+            inflight.append(pool.apply_async(_run_batch, (b,)))
+            if len(inflight) >= 2 * processes:
+                yield inflight.popleft().get()
+        while inflight:
+            yield inflight.popleft().get()
+
+
+def _reduce_batch(parents, method, nodata):
+    """parents: list of (z, x, y, {(dx, dy): png}) -> rows for `insert_tiles`, or (z, x, y, None)"""
+    rows = []
+    for z, x, y, children in parents:
+        v, alpha = downsample(*assemble(children, nodata), method, nodata)
+        rows.append((z, x, y, encode_values(v, alpha) if alpha.any() else None))
+    return rows
+
+
+def build_pyramid(mbt: DB, zfrom: int, zto: int, method='q3', nodata=NODATA,
+                  changed: Iterable[tuple[int, int]] = None, processes=os.cpu_count(), batch=64,
+                  log=print) -> dict[int, int]:
+    """Compute value tiles of zooms `zfrom-1` down to `zto` from those of `zfrom`, in `mbt`.
+       Each level is done in parallel (this process reads the children and writes the parents),
+       and committed before the next one.
+       :param changed: incremental mode, only rebuild the ancestors of these (x, y) TMS tiles
+          of `zfrom` (parents left without children are removed)
+       :return: {z: tiles written}"""
+    counts = {}
+    with contextlib.nullcontext(mbt) if isinstance(mbt, MBTiles) else MBTiles(mbt, journal_mode='WAL') as handle:
+        with handle.batch() as dbc:
+            if changed is None:
+                changed = [(x, y) for _, x, y in dbc.execute(
+                    'SELECT zoom_level, tile_column, tile_row FROM tiles WHERE zoom_level = ?', (zfrom,))]
+        parents = sorted({(x >> 1, y >> 1) for x, y in changed}, key=lambda xy: (-xy[1], xy[0]))
+        for z in range(zfrom - 1, zto - 1, -1):
+            def read_children(xys):
+                with handle.batch() as dbc:
+                    out = []
+                    for x, y in xys:
+                        children = {(cx - 2 * x, cy - 2 * y): im for cx, cy, im in dbc.execute('''
+                            SELECT tile_column, tile_row, tile_data FROM tiles WHERE zoom_level = ?
+                            AND tile_column BETWEEN ? AND ? AND tile_row BETWEEN ? AND ?''',
+                            (z + 1, 2 * x, 2 * x + 1, 2 * y, 2 * y + 1))}
+                        out.append((z, x, y, children))
+                    return out
+            batches = (read_children(parents[i:i + batch]) for i in range(0, len(parents), batch))
+            n = 0
+            for rows in _pool_map(_reduce_batch, batches, processes, method, nodata):
+                with handle.batch() as dbc:
+                    insert_tiles(dbc, [row for row in rows if row[3]])
+                    remove_tiles(dbc, [row[:3] for row in rows if not row[3]])
+                n += sum(1 for row in rows if row[3])
+            counts[z] = n
+            log(f'pyramid z{z}: {n} tiles ({method})')
+            parents = sorted({(x >> 1, y >> 1) for x, y in parents}, key=lambda xy: (-xy[1], xy[0]))
+    return counts
+
+
+def _values_batch(xys, src, band, z):
+    from osgeo import gdal
+    gdal.UseExceptions()
+    ds = gdal.Open(src)
+    b, gt = ds.GetRasterBand(band), ds.GetGeoTransform()
+    rows = []
+    for x, y in xys:
+        col, row = tile_origin(gt, z, x, y)
+        c0, r0 = max(col, 0), max(row, 0)
+        c1, r1 = min(col + TILE, ds.RasterXSize), min(row + TILE, ds.RasterYSize)
+        v = np.full((TILE, TILE), NODATA, dtype=np.uint8)
+        alpha = np.zeros((TILE, TILE), dtype=np.uint8)
+        v[r0 - row:r1 - row, c0 - col:c1 - col] = b.ReadAsArray(c0, r0, c1 - c0, r1 - r0)
+        alpha[r0 - row:r1 - row, c0 - col:c1 - col] = 255
+        if (v[alpha > 0] != NODATA).any():
+            rows.append((z, x, 2 ** z - 1 - y, encode_values(v, alpha)))
+    return rows
+
+
+def tif_to_values(src: str, dest: str, band=1, processes=os.cpu_count(), batch=64,
+                  overwrite=False, reuse=False, log=print) -> str:
+    """Value tiles of a Byte slope GeoTIFF (EPSG:3857 at a zoom level resolution, nodata 255,
+       eg from `merge_slopes`), on the same tile grid as `render_util.render_mbt`.
+       All-nodata tiles are skipped."""
+    from osgeo import gdal
+    gdal.UseExceptions()
+    if reuse and os.path.isfile(dest): log('Reuse', dest); return dest
+    src, dest = validate_src_dst(src, dest, overwrite)
+    ds = gdal.Open(src)
+    gt, width, height = ds.GetGeoTransform(), ds.RasterXSize, ds.RasterYSize
+    ds = None
+    z = zoom_of(gt[1])
+    tiles = list(raster_tiles(gt, width, height, z))
+    n = 0
+    with MBTiles(dest, create=True, journal_mode='WAL') as mbt:
+        batches = (tiles[i:i + batch] for i in range(0, len(tiles), batch))
+        for rows in _pool_map(_values_batch, batches, processes, src, band, z):
+            with mbt.batch() as dbc:
+                insert_tiles(dbc, rows)
+            n += len(rows)
+        update_mbt_meta(mbt, name=os.path.basename(dest)[:-len('.mbtiles')], format='png', _type='overlay')
+    log(f'values z{z}: {n} tiles')
+    return dest
+
+
+def _color_batch(rows, clrs, nv, nodata):
+    # per batch, not per process: a `.clr` may be edited between renders at the same zoom,
+    # and `load_palette` already compiles each file content once
+    colorizers, out = {}, []
+    for z, x, y, png in rows:
+        if z not in colorizers:
+            colorizers[z] = Colorizer(clrs[z], nodata, nv)
+        colorize = colorizers[z]
+        v, alpha = decode_values(png)
+        idx = np.where(alpha > 0, colorize(v), colorize.transparent).astype(np.uint8)
+        out.append((z, x, y, encode_png8(idx, colorize.palette)))
+    return out
+
+
+def render_values(source: DB, dest: str, clrs: dict[int, str], nv=WHITE, nodata=NODATA,
+                  processes=os.cpu_count(), batch=256, overwrite=False, log=print) -> int:
+    """Color the value tiles of `source` into PNG8 tiles of `dest`, with palette `clrs[z]` at zoom z,
+       like `render_util.render_mbt` (`-nearest_color_entry`). Zooms not in `clrs` are skipped."""
+    source_path, dest = validate_src_dst(source if isinstance(source, str) else source.path, dest, overwrite)
+    n = 0
+    with cursor(source) as sdbc, MBTiles(dest, create=True) as out:
+        for z in sorted(clrs):
+            batches = iter_tile_batches(sdbc, z, batch)
+            for rows in _pool_map(_color_batch, batches, processes, clrs, nv, nodata):
+                with out.batch() as dbc:
+                    insert_tiles(dbc, rows)
+                n += len(rows)
+        name = os.path.basename(dest)[:-len('.mbtiles')]
+        update_mbt_meta(out, name=name, desc=name, format='png', _type='overlay')
+        set_real_bounds(out)
+    log(f'render: {n} tiles')
+    return n
+
+
+class TestPyramid(TestCase):
+    def test_downsample(self):
+        v = np.array([[10, 20, 255, 1],
+                      [30, 40, 255, 2],
+                      [5, 5, 255, 255],
+                      [7, 7, 255, 255]], dtype=np.uint8)
+        alpha = np.full_like(v, 255)
+        alpha[2:, 2:] = 0
+        self.assertEqual(downsample(v, alpha, 'q3')[0].tolist(), [[30, 2], [7, 255]])
+        self.assertEqual(downsample(v, alpha, 'max')[0].tolist(), [[40, 2], [7, 255]])
+        self.assertEqual(downsample(v, alpha, 'mode')[0].tolist(), [[40, 2], [7, 255]])
+        self.assertEqual(downsample(v, alpha)[1].tolist(), [[255, 255], [255, 0]])
+
+    def test_incremental(self):
+        import tempfile
+        rng = np.random.default_rng(0)
+        def tile():
+            return encode_values(rng.integers(0, 91, (TILE, TILE), dtype=np.uint8), np.full((TILE, TILE), 255, np.uint8))
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'values.mbtiles')
+            with MBTiles(path, create=True) as mbt:
+                insert_tiles(mbt, [(5, x, y, tile()) for x in range(4) for y in range(4)])
+                self.assertEqual(build_pyramid(mbt, 5, 3, processes=1, log=lambda *a: None), {4: 4, 3: 1})
+                insert_tiles(mbt, [(5, 3, 3, tile())])
+                self.assertEqual(build_pyramid(mbt, 5, 3, changed=[(3, 3)], processes=1, log=lambda *a: None),
+                                 {4: 1, 3: 1})
+                incremental = dict(((z, x, y), im) for z, x, y, im in
+                                   mbt.db.execute('SELECT * FROM tiles WHERE zoom_level < 5'))
+                build_pyramid(mbt, 5, 3, processes=2, log=lambda *a: None)
+                full = dict(((z, x, y), im) for z, x, y, im in
+                            mbt.db.execute('SELECT * FROM tiles WHERE zoom_level < 5'))
+                self.assertEqual(incremental, full)
+                with mbt.batch() as dbc:
+                    self.assertEqual([e[0] for e in zoom_extents(dbc)], [3, 4, 5])
+            clr = os.path.join(os.path.dirname(__file__), '../data/gdaldem-slope-eslo13near.clr')
+            dest = os.path.join(tmp, 'colored.mbtiles')
+            self.assertEqual(render_values(path, dest, {4: clr, 5: clr}, processes=1, log=lambda *a: None), 20)
+            grey = os.path.join(os.path.dirname(__file__), '../data/gdaldem-slope-greyscale.clr')
+            render_values(path, dest, {4: grey, 5: grey}, processes=1, overwrite=True, log=lambda *a: None)
+            with MBTiles(dest, readonly=True) as mbt:
+                (png,), = mbt.db.execute('SELECT tile_data FROM tiles WHERE zoom_level = 5 LIMIT 1')
+            palette = np.asarray(PIL.Image.open(io.BytesIO(png)).getpalette('RGB')).reshape(-1, 3)
+            self.assertTrue((palette[:, 0] == palette[:, 1]).all())  # greys, not the previous colors
@@ -0,0 +1,195 @@
+"""Slope (or any single band) EPSG:3857 raster -> PNG8 MBTiles, in-process and multi-core:
+   the equivalent of `gdaldem color-relief src.tif x.clr dest.mbtiles -nearest_color_entry
+   -co TILE_FORMAT=png8`, as `gdal_slope_util.slope_mbt` used to run.
+
+   Each worker process reads 256x256 windows from the raster, maps them through the palette
+   and encodes indexed PNGs; this process bulk-inserts them.
+   Decoded pixels equal gdaldem's color-relief output exactly (gdaldem's PNG8 quantization
+   may alter colors slightly, we never need to since palettes have < 256 colors).
+"""
+import io
+from multiprocessing import Pool
+import os
+from typing import Callable, Iterator
+from unittest import TestCase
+
+import numpy as np
+import PIL.Image
+
+from .mbt_util import MBTiles, insert_tiles, set_real_bounds, update_mbt_meta, validate_src_dst
+from .palette_util import load_palette, read_clr
+
+
+TILE = 256
+WORLD = 20037508.342789244  # half the EPSG:3857 extent
+WHITE = (255, 255, 255)
+
+
+def zoom_of(res: float, tol=1e-6) -> int:
+    """TMS zoom level whose pixel size is `res` (meters)"""
+    z = round(np.log2(2 * WORLD / TILE / res))
+    assert abs(res * TILE * 2 ** z / (2 * WORLD) - 1) < tol, f'{res}m is not a zoom level resolution'
+    return z
+
+
+def tile_origin(gt: tuple, z: int, x: int, y: int) -> tuple[int, int]:
+    """Raster (col, row) of the top left pixel of XYZ tile x, y. Rounded to the nearest pixel
+       if the raster is not aligned on the tile grid, like GDAL's MBTiles driver does."""
+    tm = 2 * WORLD / 2 ** z
+    return round((-WORLD + x * tm - gt[0]) / gt[1]), round((gt[3] - (WORLD - y * tm)) / -gt[5])
+
+
+def raster_tiles(gt: tuple, width: int, height: int, z: int) -> Iterator[tuple[int, int]]:
+    """XYZ (x, y) of the tiles overlapping the raster, row by row"""
+    col, row = tile_origin(gt, z, 0, 0)  # raster origin, in pixels of the whole world
+    x0, x1, y0, y1 = -col // TILE, (width - col - 1) // TILE, -row // TILE, (height - row - 1) // TILE
+    for y in range(max(y0, 0), min(y1, 2 ** z - 1) + 1):
+        for x in range(max(x0, 0), min(x1, 2 ** z - 1) + 1):
+            yield x, y
+
+
+class Colorizer:
+    """Maps raster values to PNG palette indices, like `gdaldem color-relief -nearest_color_entry`.
+       Index `transparent` is for pixels outside the raster."""
+    def __init__(self, clr_path: str, nodata=None, nv=None, alpha=False):
+        """:param nv: override the `nv` color of the file, RGB (keeping the file's alpha) or RGBA
+           :param alpha: keep the alpha of the colors, like gdaldem `-alpha`"""
+        self.clr = load_palette(clr_path, nodata, nv=nv)
+        colors = self.clr.colors.copy()
+        if not alpha:
+            colors[:, 3] = 255
+        pal, index = np.unique(np.vstack([colors, np.zeros(4, np.uint8)]), axis=0, return_inverse=True)
+        assert len(pal) <= 256, 'too many colors for PNG8'
+        self.palette = pal
+        self.entry_index, self.transparent = index[:-1].astype(np.uint8), index[-1]
+
+    def __call__(self, arr: np.ndarray) -> np.ndarray:
+        # exact for floats too, rather than through the float LUT
+        return self.entry_index[self.clr.entries(arr) if arr.dtype == np.uint8 else self.clr.entry_of(arr)]
+
+
+def encode_png8(idx: np.ndarray, palette: np.ndarray) -> bytes:
+    im = PIL.Image.fromarray(idx, 'P')
+    im.putpalette(palette[:, :3].tobytes())
+    buf = io.BytesIO()
+    alpha = palette[:, 3]
+    im.save(buf, 'PNG', **({'transparency': alpha.tobytes()} if (alpha < 255).any() else {}))
+    return buf.getvalue()
+
+
+def render_tile(read: Callable[[int, int, int, int], np.ndarray], width: int, height: int,
+                gt: tuple, z: int, x: int, y: int, colorize: Colorizer) -> 'bytes|None':
+    """PNG8 of XYZ tile x, y read through `read(col, row, w, h)`. None if fully outside the raster."""
+    col, row = tile_origin(gt, z, x, y)
+    c0, r0 = max(col, 0), max(row, 0)
+    c1, r1 = min(col + TILE, width), min(row + TILE, height)
+    if c0 >= c1 or r0 >= r1:
+        return None
+    idx = np.full((TILE, TILE), colorize.transparent, dtype=np.uint8)
+    idx[r0 - row:r1 - row, c0 - col:c1 - col] = colorize(read(c0, r0, c1 - c0, r1 - r0))
+    return encode_png8(idx, colorize.palette)
+
+
+_worker_ds = None
+_worker_args = None
+
+def _init_render_worker(src, band, clr_path, nv, alpha):
+    global _worker_ds, _worker_args
+    from osgeo import gdal
+    gdal.UseExceptions()
+    _worker_ds = gdal.Open(src)
+    b = _worker_ds.GetRasterBand(band)
+    _worker_args = b, Colorizer(clr_path, b.GetNoDataValue(), nv, alpha)
+
+
+def _render_batch(z, xys):
+    """-> list of (z, x, tms_y, png) ready for `insert_tiles`"""
+    b, colorize = _worker_args
+    ds = _worker_ds
+    read = lambda c, r, w, h: b.ReadAsArray(c, r, w, h)
+    rows = []
+    for x, y in xys:
+        png = render_tile(read, ds.RasterXSize, ds.RasterYSize, ds.GetGeoTransform(), z, x, y, colorize)
+        if png:
+            rows.append((z, x, 2 ** z - 1 - y, png))
+    return rows
+
+
+def render_mbt(src: str, dest: str, clr_path: str, *, nv=WHITE, alpha=False, band=1,
+               processes=os.cpu_count(), batch=64, overwrite=False, log=print) -> int:
+    """Color `src` (EPSG:3857, at a zoom level resolution) with `clr_path` into PNG8 tiles
+       of a new `dest` MBTiles, with its metadata (bounds, center, zooms).
+       :param nv: nodata RGB color, white by default so the mbtiles blend correctly
+       :param batch: tiles per worker task, in raster row order for locality
+       :return: number of tiles written"""
+    from osgeo import gdal
+    gdal.UseExceptions()
+    src, dest = validate_src_dst(src, dest, overwrite)
+    ds = gdal.Open(src)
+    gt, width, height = ds.GetGeoTransform(), ds.RasterXSize, ds.RasterYSize
+    ds = None
+    z = zoom_of(gt[1])
+    log(f'render {src} -> {dest}: z{z}, {os.path.basename(clr_path)}, {processes} processes')
+    tiles = list(raster_tiles(gt, width, height, z))
+    batches = [tiles[i:i + batch] for i in range(0, len(tiles), batch)]
+    n = 0
+    initargs = (src, band, clr_path, nv, alpha)
+    with MBTiles(dest, create=True) as mbt:
+        if processes > 1:
+            with Pool(processes, initializer=_init_render_worker, initargs=initargs) as pool:
+                for rows in pool.imap(_render_batch_z, [(z, b) for b in batches]):
+                    with mbt.batch() as dbc:
+                        insert_tiles(dbc, rows)
+                    n += len(rows)
+        else:
+            _init_render_worker(*initargs)
+            for b in batches:
+                rows = _render_batch(z, b)
+                with mbt.batch() as dbc:
+                    insert_tiles(dbc, rows)
+                n += len(rows)
+        name = os.path.basename(dest)[:-len('.mbtiles')]
+        update_mbt_meta(mbt, name=name, desc=name, format='png', _type='overlay')
+        set_real_bounds(mbt)
+    log(f'render: {n} tiles')
+    return n
+
+
+def _render_batch_z(args):
+    return _render_batch(*args)
+
+
+class TestRender(TestCase):
+    CLR = os.path.join(os.path.dirname(__file__), '../data/gdaldem-slope-eslo13near.clr')
+
+    def test_tile_grid(self):
+        res = 2 * WORLD / TILE / 2 ** 10
+        self.assertEqual(zoom_of(res), 10)
+        gt = (-WORLD + 3 * TILE * res, res, 0, WORLD - 2 * TILE * res, 0, -res)
+        self.assertEqual(tile_origin(gt, 10, 3, 2), (0, 0))
+        self.assertEqual(tile_origin(gt, 10, 4, 3), (TILE, TILE))
+        self.assertEqual(list(raster_tiles(gt, TILE + 1, TILE, 10)), [(3, 2), (4, 2)])
+
+    def test_same_as_nearest_color_entry(self):
+        colorize = Colorizer(self.CLR, nodata=255)
+        values, colors, _ = read_clr(self.CLR)
+        slope = np.random.default_rng(0).integers(0, 91, (300, 200)).astype(np.uint8)
+        slope[:10] = 255
+        res = 2 * WORLD / TILE / 2 ** 12
+        gt = (-WORLD + 5 * TILE * res, res, 0, WORLD - 7 * TILE * res, 0, -res)
+        read = lambda c, r, w, h: slope[r:r + h, c:c + w]
+        tiles = list(raster_tiles(gt, 200, 300, 12))
+        self.assertEqual(tiles, [(5, 7), (5, 8)])
+        rgba = np.vstack([np.asarray(PIL.Image.open(io.BytesIO(
+            render_tile(read, 200, 300, gt, 12, x, y, colorize))).convert('RGBA')) for x, y in tiles])
+        expected = np.zeros((2 * TILE, TILE, 4), dtype=np.uint8)
+        # naive gdaldem: closest entry, ties to the upper one
+        dist = np.abs(values[None, :] - slope.reshape(-1, 1))
+        closest = len(values) - 1 - np.argmin(dist[:, ::-1], axis=1)
+        expected[:300, :200] = np.where(slope[..., None] == 255, (0, 0, 0, 255), colors[closest].reshape(300, 200, 4))
+        expected[:, :, 3] = np.where(np.arange(TILE) < 200, 255, 0)[None, :]
+        expected[300:, :, 3] = 0
+        expected[expected[:, :, 3] == 0] = 0
+        rgba = rgba.copy()
+        rgba[rgba[:, :, 3] == 0] = 0
+        self.assertTrue((rgba == expected).all())
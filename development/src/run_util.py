@@ -0,0 +1,174 @@
+"""Instrumented commands: each `check_run` / `timed` step emits a JSON-lines record with wall time,
+   CPU time, peak RSS and block I/O (from `wait4` / `getrusage`), and the exact command.
+   Group them with `pipeline_run` to get a file per run and a summary telling which steps
+   are CPU, I/O or memory bound, and which regressed since a previous run.
+"""
+import contextlib
+from datetime import datetime
+import json
+import os
+import resource
+import shlex
+from subprocess import CalledProcessError, PIPE, STDOUT, Popen
+import sys
+import tempfile
+import threading
+from time import perf_counter, sleep
+from typing import Iterator
+from unittest import TestCase
+
+
+BLOCK = 512  # ru_inblock / ru_oublock unit
+# CPU and I/O of the calling thread only, so that steps running in threads (eg `BuildGraph.run`)
+# are not charged for each other
+RUSAGE_STEP = getattr(resource, 'RUSAGE_THREAD', resource.RUSAGE_SELF)
+
+
+class RunLog:
+    """Records of one pipeline run, appended to `path` (JSON lines) if given"""
+    def __init__(self, path='', name=''):
+        self.path = os.path.expanduser(path) if path else ''
+        self.name = name
+        self.records: list[dict] = []
+        self._lock = threading.Lock()
+
+    def add(self, record: dict):
+        record = {'run': self.name, 'ts': datetime.now().isoformat(timespec='seconds'), **record}
+        with self._lock:
+            self.records.append(record)
+            if self.path:
+                with open(self.path, 'a') as f:
+                    f.write(json.dumps(record) + '\n')
+
+    @staticmethod
+    def load(path: str) -> list[dict]:
+        with open(os.path.expanduser(path)) as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+
+_log = RunLog()
+_log_lock = threading.Lock()
+
+
+def _record(step: str, cmd: str, wall: float, ru, exit_code=0) -> dict:
+    """`ru`: rusage of the step (or the difference of 2)"""
+    rec = {'step': step, 'cmd': cmd, 'exit': exit_code, 'wall_s': round(wall, 3),
+           'user_s': round(ru['ru_utime'], 3), 'sys_s': round(ru['ru_stime'], 3),
+           'max_rss_mb': round(ru['ru_maxrss'] / 1024, 1),  # KiB on Linux
+           'read_bytes': ru['ru_inblock'] * BLOCK, 'write_bytes': ru['ru_oublock'] * BLOCK}
+    with _log_lock:
+        log = _log
+    log.add(rec)
+    return rec
+
+
+def _ru(r) -> dict:
+    return {k: getattr(r, k) for k in ('ru_utime', 'ru_stime', 'ru_maxrss', 'ru_inblock', 'ru_oublock')}
+
+
+def check_run(cmd: str, step='') -> int:
+    """Like `check_call(cmd, shell=True)`, streaming the output (also in notebooks),
+       and recording the resources of the command (see `RunLog`)"""
+    start = perf_counter()
+    p = Popen(cmd, shell=True, stdout=PIPE, stderr=STDOUT)
+    while out := os.read(p.stdout.fileno(), 4096):  # not line by line: GDAL progress has none
+        print(out.decode(errors='replace'), end='', flush=True)
+    p.stdout.close()
+    _, status, ru = os.wait4(p.pid, 0)
+    p.returncode = os.waitstatus_to_exitcode(status)
+    step = step or (shlex.split(cmd)[0] if cmd.strip() else '')
+    rec = _record(step, cmd, perf_counter() - start, _ru(ru), p.returncode)
+    if p.returncode:
+        raise CalledProcessError(p.returncode, cmd)
+    return rec['exit']
+
+
+@contextlib.contextmanager
+def timed(step: str):
+    """Record an in-process step: the CPU and I/O of the calling thread (of the process where
+       `RUSAGE_THREAD` is missing), plus those of the children waited for meanwhile. Children are
+       per process, so their figures are only exact when no other step runs concurrently.
+       Its `max_rss_mb` is the peak of this process (or of any child) so far, not of the step."""
+    start = perf_counter()
+    before = [_ru(resource.getrusage(w)) for w in (RUSAGE_STEP, resource.RUSAGE_CHILDREN)]
+    try:
+        yield
+    finally:
+        after = [_ru(resource.getrusage(w)) for w in (RUSAGE_STEP, resource.RUSAGE_CHILDREN)]
+        ru = {k: sum(a[k] - b[k] for a, b in zip(after, before)) for k in after[0]}
+        ru['ru_maxrss'] = max(a['ru_maxrss'] for a in after)
+        _record(step, '', perf_counter() - start, ru)
+
+
+def summary(records: list[dict], baseline: list[dict] = (), regression=1.2) -> str:
+    """One line per step: CPU utilization ((user+sys)/wall, >1 when multi-threaded), I/O rate,
+       peak RSS, and the bottleneck guess; plus the change vs. the same step in `baseline`"""
+    ram_mb = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / (1 << 20)
+    before = {r['step']: r for r in baseline}
+    lines = [f'{"step":<24} {"wall_s":>9} {"cpu":>6} {"io_MB/s":>8} {"rss_MB":>8}  bound']
+    for r in records:
+        cpu = (r['user_s'] + r['sys_s']) / r['wall_s'] if r['wall_s'] else 0
+        io = (r['read_bytes'] + r['write_bytes']) / (1 << 20) / r['wall_s'] if r['wall_s'] else 0
+        bound = 'memory' if r['max_rss_mb'] > ram_mb / 2 else 'cpu' if cpu >= .8 else 'io/wait'
+        line = f'{r["step"][:24]:<24} {r["wall_s"]:>9.1f} {cpu:>6.2f} {io:>8.1f} {r["max_rss_mb"]:>8.0f}  {bound}'
+        if r['step'] in before and before[r['step']]['wall_s']:
+            ratio = r['wall_s'] / before[r['step']]['wall_s']
+            line += f'  x{ratio:.2f}' + (' REGRESSION' if ratio > regression else '')
+        lines.append(line)
+    lines.append(f'{"total":<24} {sum(r["wall_s"] for r in records):>9.1f}')
+    return '\n'.join(lines)
+
+
+@contextlib.contextmanager
+def pipeline_run(path='', name='', baseline='') -> Iterator[RunLog]:
+    """Collect the records of the enclosed steps (appended to `path`), then print their summary,
+       compared with the records of run `baseline` (a JSON-lines path) if given"""
+    global _log
+    run = RunLog(path, name or datetime.now().isoformat(timespec='seconds'))
+    with _log_lock:
+        previous, _log = _log, run
+    try:
+        yield run
+    finally:
+        with _log_lock:
+            _log = previous
+        print(summary(run.records, RunLog.load(baseline) if baseline else ()), file=sys.stderr)
+
+
+class TestRunLog(TestCase):
+    def test_records(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'run.jsonl')
+            with contextlib.redirect_stderr(open(os.devnull, 'w')), pipeline_run(path, 'test') as run:
+                check_run('true', step='noop')
+                with timed('alloc'):
+                    bytearray(1 << 20)
+                with self.assertRaises(CalledProcessError):
+                    check_run('exit 3')
+            records = RunLog.load(path)
+            self.assertEqual([r['step'] for r in records], ['noop', 'alloc', 'exit'])
+            self.assertEqual(records, run.records)
+            self.assertEqual(records[2]['exit'], 3)
+            self.assertGreater(records[1]['max_rss_mb'], 0)
+            self.assertIn('REGRESSION', summary([{**records[0], 'wall_s': 10}], records))
+
+    def test_threads(self):
+        def busy():
+            with timed('busy'):
+                end = perf_counter() + .5
+                while perf_counter() < end:
+                    pass
+
+        def idle():
+            with timed('idle'):
+                sleep(.4)
+
+        with contextlib.redirect_stderr(open(os.devnull, 'w')), pipeline_run() as run:
+            threads = [threading.Thread(target=f) for f in (busy, idle)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        rec = {r['step']: r for r in run.records}
+        self.assertGreater(rec['busy']['user_s'] + rec['busy']['sys_s'], .2)
+        self.assertLess(rec['idle']['user_s'] + rec['idle']['sys_s'], .1)  # not charged for `busy`
@@ -0,0 +1,168 @@
+"""Values of the tiles of one zoom level at many points (eg a GPX track), in one vectorized call.
+
+   Points are grouped by tile, each tile is fetched and decoded once, and decoded tiles are kept
+   in a bounded LRU, so successive calls over neighbouring points (a track split in chunks, a
+   notebook loop) decode each tile once too:
+
+       lo, hi = sample_points('slopes.mbtiles', 16, lngs, lats, mode='class', clr='eslo13near')[0].T
+"""
+from collections import OrderedDict
+import io
+import os
+import tempfile
+from time import perf_counter
+from unittest import TestCase
+
+import numpy as np
+import PIL.Image
+
+from .mbt_util import MBTiles, insert_tiles
+from .mosaic_util import IndexDecoder
+from .pmtiles_util import PMTiles
+from .palette_util import clr_path
+from .render_util import WHITE, Colorizer, encode_png8
+from .stats_util import slope_classes
+from .tile_util import tile_pixels
+
+
+MODES = ('rgb', 'index', 'class')
+
+
+class TileSampler:
+    """Point sampler of zoom `z` of an MBTiles or PMTiles, with an LRU of decoded tiles
+       (at most `cache_mb`, plus `overhead` bytes per entry, so missing tiles count too).
+       Not thread-safe: use one per thread."""
+    def __init__(self, source: str, z: int, mode='rgb', clr: str = None, nv=WHITE, cache_mb=64, tile=256,
+                 overhead=100):
+        """:param mode: what `sample` returns per point:
+              `rgb`: RGB (uint8, n x 3)
+              `index`: index (uint8) in the palette `clr` renders to (see `stats_util.slope_classes`)
+              `class`: the slope range [lo, hi) (float, n x 2) of that palette index
+           :param clr: `.clr` name or path the tiles were rendered with, for `index` and `class`
+           :param tile: tile size, in pixels"""
+        assert mode in MODES, mode
+        assert clr or mode == 'rgb', f'{mode} needs the clr of the tiles'
+        self.source, self.z, self.mode, self.tile_size = os.path.expanduser(source), z, mode, tile
+        if clr:
+            self.palette, self.ranges = slope_classes(clr, nv)
+            self.decoder = IndexDecoder(self.palette)
+        self.max_bytes, self.overhead, self.size = cache_mb << 20, overhead, 0
+        self.hits = self.misses = 0
+        self._cache: OrderedDict = OrderedDict()
+        if self.source.endswith('.pmtiles'):
+            self.pmt, self.db = PMTiles(self.source), None
+        else:
+            self.pmt, self.db = None, MBTiles(self.source, readonly=True).db
+
+    def close(self):
+        if self.pmt:
+            self.pmt.close()
+        else:
+            self.db.close()
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        self.close()
+
+    def _fetch(self, x: int, y: int) -> 'bytes|None':
+        """Tile data of XYZ x, y"""
+        if self.pmt:
+            return self.pmt.get(self.z, x, y, flip_y=False)
+        row = self.db.execute('SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?',
+                              (self.z, x, (1 << self.z) - 1 - y)).fetchone()
+        return row[0] if row else None
+
+    def _decode(self, data: bytes) -> tuple[np.ndarray, np.ndarray]:
+        if self.mode == 'rgb':
+            rgba = np.asarray(PIL.Image.open(io.BytesIO(data)).convert('RGBA'))
+            return rgba[..., :3], rgba[..., 3] > 0
+        return self.decoder(data)
+
+    def tile(self, x: int, y: int) -> 'tuple[np.ndarray, np.ndarray]|None':
+        """(values, valid) of XYZ tile x, y, decoded, or None if there is none"""
+        key = x, y
+        if key in self._cache:
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        self.misses += 1
+        data = self._fetch(x, y)
+        tile = self._decode(data) if data else None
+        self._cache[key] = tile
+        self.size += (sum(a.nbytes for a in tile) if tile else 0) + self.overhead
+        while self.size > self.max_bytes and len(self._cache) > 1:
+            _, old = self._cache.popitem(last=False)
+            self.size -= (sum(a.nbytes for a in old) if old else 0) + self.overhead
+        return tile
+
+    def sample(self, lngs, lats) -> tuple[np.ndarray, np.ndarray]:
+        """-> (values, valid) of the pixels under the points (see `mode`). Points on missing tiles
+           or on transparent pixels are not valid: their values are 0, or nan for `class`."""
+        z, t = self.z, self.tile_size
+        x, y, cols, rows = tile_pixels(np.ravel(lngs), np.ravel(lats), z, t)
+        keys, inverse = np.unique(x << z | y, return_inverse=True)
+        order = np.argsort(inverse, kind='stable')
+        starts = np.searchsorted(inverse[order], np.arange(len(keys) + 1))
+        values = np.zeros((len(x), 3) if self.mode == 'rgb' else len(x), np.uint8)
+        valid = np.zeros(len(x), bool)
+        for i, key in enumerate(keys.tolist()):
+            tile = self.tile(key >> z, key & ((1 << z) - 1))
+            if tile is None:
+                continue
+            arr, ok = tile
+            assert arr.shape[0] == t, f'{arr.shape[0]}px tiles, not {t}'
+            pts = order[starts[i]:starts[i + 1]]
+            values[pts], valid[pts] = arr[rows[pts], cols[pts]], ok[rows[pts], cols[pts]]
+        if self.mode == 'class':
+            values = np.where(valid[:, None], self.ranges[values], np.nan)
+        return values, valid
+
+
+def sample_points(source: str, z: int, lngs, lats, mode='rgb', clr: str = None, nv=WHITE,
+                  cache_mb=64, tile=256) -> tuple[np.ndarray, np.ndarray]:
+    """(values, valid) of zoom `z` of `source` at each point, see `TileSampler`"""
+    with TileSampler(source, z, mode, clr, nv, cache_mb, tile) as sampler:
+        return sampler.sample(lngs, lats)
+
+
+class TestSample(TestCase):
+    def test_sample_points(self):
+        z, t = 12, 256
+        col = Colorizer(clr_path('eslo13near'), nv=WHITE)
+        rng = np.random.default_rng(3)
+        slopes = {x: rng.uniform(0, 60, (t, t)) for x in (2120, 2121)}
+        indices = {x: col(v) for x, v in slopes.items()}
+        with tempfile.TemporaryDirectory() as tmp:
+            with MBTiles(f'{tmp}/s.mbtiles', create=True) as m:
+                for idx in indices.values():
+                    idx[:, 0] = col.transparent
+                insert_tiles(m, [(z, x, (1 << z) - 1 - 1465, encode_png8(idx, col.palette)) for x, idx in indices.items()])
+            n, size = 1 << z, 100_000
+            px = rng.uniform(2120 * t, 2123 * t, size)  # a third of them on a missing tile
+            py = rng.uniform(1465 * t, 1466 * t, size)
+            lngs = px / (n * t) * 360 - 180
+            lats = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * py / (n * t)))))
+            x, c, r = px.astype(int) // t, px.astype(int) % t, py.astype(int) % t
+            expected_idx, expected_slope = np.zeros(size, np.uint8), np.zeros(size)
+            for xx in slopes:
+                on = x == xx
+                expected_idx[on], expected_slope[on] = indices[xx][r[on], c[on]], slopes[xx][r[on], c[on]]
+            expected_valid = (x < 2122) & (c > 0)
+
+            start = perf_counter()
+            rgb, valid = sample_points(f'{tmp}/s.mbtiles', z, lngs, lats)
+            self.assertLess(perf_counter() - start, 5)
+            self.assertTrue((valid == expected_valid).all())
+            self.assertTrue((rgb[valid] == col.palette[expected_idx[valid], :3]).all())
+            idx, _ = sample_points(f'{tmp}/s.mbtiles', z, lngs, lats, mode='index', clr='eslo13near')
+            self.assertTrue((idx[valid] == expected_idx[valid]).all())
+            with TileSampler(f'{tmp}/s.mbtiles', z, 'class', clr='eslo13near', cache_mb=0) as sampler:
+                for chunk in range(0, 1000, 100):  # evicted tiles are decoded again
+                    ranges, ok = sampler.sample(lngs[chunk:chunk + 100], lats[chunk:chunk + 100])
+                    v = expected_slope[chunk:chunk + 100][ok]
+                    self.assertTrue(((ranges[ok, 0] <= v) & (v < ranges[ok, 1])).all())
+                    self.assertTrue(np.isnan(ranges[~ok]).all())
+                self.assertGreater(sampler.misses, 10)
+            with TileSampler(f'{tmp}/s.mbtiles', z, cache_mb=1, overhead=1 << 19) as sampler:
+                sampler.sample(rng.uniform(-180, 180, 1000), rng.uniform(-80, 80, 1000))  # missing tiles
+                self.assertEqual(len(sampler._cache), 2)
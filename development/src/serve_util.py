@@ -0,0 +1,297 @@
+"""Local HTTP tile server over one or more MBTiles, eg to preview results in a web map
+   without converting them first:
+
+       python -m src.serve_util eslo-z16.mbtiles overviews.mbtiles --port 8080
+
+   * `/{name}/{z}/{x}/{y}.png`: XYZ tile (y flipped to TMS like `xyz2tile`),
+     `/{name}/tms/{z}/{x}/{y}.png`: TMS tile, as stored
+   * `/{name}.json`: TileJSON built from the `metadata` table (see `get_meta`)
+   * `/`: the names served
+   `name` is the file name without `.mbtiles`.
+
+   Each server thread has its own read-only connection per file, so requests never wait
+   on each other in SQLite. Hot tiles are kept in a bounded LRU (by bytes), missing ones
+   included; tiles carry an `ETag` (content md5) so browsers revalidate with `If-None-Match`.
+   `load_test` measures requests per second and latency percentiles of a running server.
+"""
+import argparse
+from collections import OrderedDict
+from http.client import HTTPConnection
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import random
+import re
+import tempfile
+import threading
+from time import perf_counter
+from unittest import TestCase
+from urllib.parse import urlsplit
+
+import numpy as np
+
+from .mbt_util import MBTiles, get_all_coords, get_meta, insert_tiles, tile_hash, update_mbt_meta
+
+
+MIME = {'png': 'image/png', 'jpg': 'image/jpeg', 'jpeg': 'image/jpeg', 'webp': 'image/webp',
+        'pbf': 'application/x-protobuf'}
+TILE_PATH = re.compile(r'^/(?P<name>[^/]+)/(?:(?P<tms>tms)/)?(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)(?:\.\w+)?$')
+MISSING = (b'', '')
+
+
+class LRUCache:
+    """Thread-safe LRU of `key -> (data, etag)`, bounded by the total size of `data`
+       (plus `overhead` bytes per entry, so missing tiles, with empty data, count too)"""
+    def __init__(self, max_bytes=64 << 20, overhead=100):
+        self.max_bytes, self.overhead = max_bytes, overhead
+        self.size = self.hits = self.misses = 0
+        self._d: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            v = self._d.get(key)
+            if v is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._d.move_to_end(key)
+            return v
+
+    def put(self, key, value: tuple[bytes, str]):
+        with self._lock:
+            if key in self._d:
+                return
+            self._d[key] = value
+            self.size += len(value[0]) + self.overhead
+            while self.size > self.max_bytes and self._d:
+                _, (data, _) = self._d.popitem(last=False)
+                self.size -= len(data) + self.overhead
+
+
+class TileServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, *mbtiles: str, host='127.0.0.1', port=8080, cache_mb=64, max_age=3600, log=print):
+        """:param max_age: `Cache-Control` of tiles, in seconds
+           :param log: request logger, eg `None` to be quiet"""
+        self.paths = {os.path.basename(p)[:-len('.mbtiles')]: os.path.expanduser(p) for p in mbtiles}
+        assert len(self.paths) == len(mbtiles), 'duplicate file names'
+        self.meta = {}
+        for name, path in self.paths.items():
+            with MBTiles(path, readonly=True) as mbt:
+                self.meta[name] = get_meta(mbt)
+        self.cache = LRUCache(cache_mb << 20)
+        self.max_age = max_age
+        self.log = log
+        self._local = threading.local()
+        super().__init__((host, port), TileHandler)
+
+    def _db(self, name: str) -> MBTiles:
+        """This thread's connection to `name`"""
+        dbs = self._local.__dict__.setdefault('dbs', {})
+        if name not in dbs:
+            dbs[name] = MBTiles(self.paths[name], readonly=True)
+        return dbs[name]
+
+    def tile(self, name: str, z: int, x: int, y: int) -> tuple[bytes, str]:
+        """(data, etag) of TMS tile z/x/y of `name`, `MISSING` if none"""
+        key = name, z, x, y
+        if (hit := self.cache.get(key)) is not None:
+            return hit
+        row = self._db(name).db.execute(
+            'SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?', (z, x, y)).fetchone()
+        value = (row[0], f'"{tile_hash(row[0])}"') if row else MISSING
+        self.cache.put(key, value)
+        return value
+
+    def tilejson(self, name: str, base_url: str) -> dict:
+        meta = self.meta[name]
+        fmt = meta.get('format', 'png')
+        tj = {'tilejson': '3.0.0', 'name': meta.get('name', name), 'scheme': 'xyz',
+              'tiles': [f'{base_url}/{name}/{{z}}/{{x}}/{{y}}.{fmt}']}
+        for key in ('description', 'attribution', 'version', 'type'):
+            if key in meta:
+                tj[key] = meta[key]
+        for key in ('minzoom', 'maxzoom'):
+            if key in meta:
+                tj[key] = int(meta[key])
+        for key in ('bounds', 'center'):
+            if key in meta:
+                tj[key] = [float(v) for v in meta[key].split(',')]
+        if 'center' in tj and len(tj['center']) == 3:
+            tj['center'][2] = int(tj['center'][2])
+        return tj
+
+
+class TileHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive
+    disable_nagle_algorithm = True  # else headers then body wait for the client's delayed ACK
+    server: TileServer
+
+    def _send(self, code: int, body=b'', headers: dict = {}):
+        self.send_response(code)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if body and self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _json(self, obj):
+        self._send(200, json.dumps(obj).encode(), {'Content-Type': 'application/json'})
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        if m := TILE_PATH.match(path):
+            name, z, x, y = m['name'], int(m['z']), int(m['x']), int(m['y'])
+            if name not in self.server.paths or not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+                return self._send(404)
+            data, etag = self.server.tile(name, z, x, y if m['tms'] else 2 ** z - 1 - y)
+            if not data:
+                return self._send(404)
+            cache = {'ETag': etag, 'Cache-Control': f'max-age={self.server.max_age}'}
+            if etag in self.headers.get('If-None-Match', ''):
+                return self._send(304, headers=cache)
+            fmt = self.server.meta[name].get('format', 'png')
+            headers = {'Content-Type': MIME.get(fmt, 'application/octet-stream'), **cache}
+            if data[:2] == b'\x1f\x8b':  # gzipped vector tiles
+                headers['Content-Encoding'] = 'gzip'
+            return self._send(200, data, headers)
+        if path.endswith('.json') and path[1:-5] in self.server.paths:
+            return self._json(self.server.tilejson(path[1:-5], f'http://{self.headers.get("Host", "localhost")}'))
+        if path == '/':
+            return self._json(sorted(self.server.paths))
+        self._send(404)
+
+    do_HEAD = do_GET
+
+    def log_message(self, format, *args):
+        if self.server.log:
+            self.server.log(format % args)
+
+
+def serve(*mbtiles: str, host='127.0.0.1', port=8080, background=False, **kw) -> TileServer:
+    """Serve `mbtiles` until interrupted, or in a daemon thread if `background`
+       (eg from a notebook; stop with `server.shutdown()`). See `TileServer` for `kw`."""
+    server = TileServer(*mbtiles, host=host, port=port, **kw)
+    print(f'Serving {", ".join(server.paths)} on http://{host}:{server.server_address[1]}/')
+    if background:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return server
+
+
+def sample_tiles(mbtiles: str, n=1000, seed=0) -> list[tuple[int, int, int]]:
+    """`n` random XYZ (z, x, y) of tiles of `mbtiles`, eg for `load_test`"""
+    coords = list(get_all_coords(mbtiles))
+    random.Random(seed).shuffle(coords)
+    return [(z, x, 2 ** z - 1 - y) for z, x, y in coords[:n]]
+
+
+def load_test(url: str, name: str, tiles: list[tuple[int, int, int]], requests=10_000, threads=8,
+              skew=3., revalidate=0., seed=0) -> dict:
+    """Request `requests` tiles of `name` from the server at `url` (eg `http://127.0.0.1:8080`),
+       over `threads` keep-alive connections.
+       :param tiles: XYZ tiles to pick from; tile `i` of `n` is picked with the density of
+          `(i/n) ** skew`, so a few are hot, like the visible area of a map
+       :param revalidate: share of requests sent with the `If-None-Match` of the previous response
+       :return: requests/s, latency percentiles (ms), and count per status"""
+    host = urlsplit(url).netloc
+    latencies, statuses, lock = [], {}, threading.Lock()
+
+    def client(i, count):
+        rng = random.Random(seed + i)
+        conn = HTTPConnection(host)
+        lat, st, etags = [], {}, {}
+        for _ in range(count):
+            z, x, y = tiles[int(rng.random() ** skew * len(tiles))]
+            headers = {'If-None-Match': etags[z, x, y]} if (z, x, y) in etags and rng.random() < revalidate else {}
+            start = perf_counter()
+            conn.request('GET', f'/{name}/{z}/{x}/{y}.png', headers=headers)
+            r = conn.getresponse()
+            r.read()
+            lat.append(perf_counter() - start)
+            st[r.status] = st.get(r.status, 0) + 1
+            if etag := r.getheader('ETag'):
+                etags[z, x, y] = etag
+        conn.close()
+        with lock:
+            latencies.extend(lat)
+            for k, v in st.items():
+                statuses[k] = statuses.get(k, 0) + v
+
+    workers = [threading.Thread(target=client, args=(i, requests // threads + (i < requests % threads)))
+               for i in range(threads)]
+    start = perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    seconds = perf_counter() - start
+    p50, p90, p99 = np.percentile(np.array(latencies) * 1000, [50, 90, 99]).tolist()
+    return {'requests': len(latencies), 'seconds': round(seconds, 2), 'rps': round(len(latencies) / seconds),
+            'p50_ms': round(p50, 2), 'p90_ms': round(p90, 2), 'p99_ms': round(p99, 2), 'status': statuses}
+
+
+class TestServe(TestCase):
+    def test_serve(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = f'{tmp}/t.mbtiles'
+            with MBTiles(path, create=True) as mbt:
+                insert_tiles(mbt, [(3, 1, 2, b'tms-3-1-2'), (3, 1, 5, b'tms-3-1-5')])
+                update_mbt_meta(mbt, name='t', desc='test', bounds=(5., 44., 8., 46.), center=((6., 45.), 3),
+                                format='png', zmin=3, zmax=3, overwrite=True, log=lambda *a: None)
+            server = serve(path, port=0, background=True, log=None, cache_mb=1)
+            try:
+                url = f'http://127.0.0.1:{server.server_address[1]}'
+                conn = HTTPConnection(url[7:])
+                def get(p, **headers):
+                    conn.request('GET', p, headers=headers)
+                    r = conn.getresponse()
+                    return r.status, r.read(), r.getheader('ETag')
+                status, data, etag = get('/t/3/1/5.png')  # XYZ y=5 is TMS y=2
+                self.assertEqual((status, data), (200, b'tms-3-1-2'))
+                self.assertEqual(get('/t/tms/3/1/5.png')[1], b'tms-3-1-5')
+                self.assertEqual(get('/t/3/1/5.png', **{'If-None-Match': etag})[0], 304)
+                self.assertEqual(get('/t/3/0/0.png')[0], 404)
+                self.assertEqual(get('/t/3/9/0.png')[0], 404)
+                status, data, _ = get('/t.json')
+                tj = json.loads(data)
+                self.assertEqual((tj['minzoom'], tj['bounds'], tj['center']), (3, [5, 44, 8, 46], [6, 45, 3]))
+                self.assertEqual(tj['tiles'], [url + '/t/{z}/{x}/{y}.png'])
+                res = load_test(url, 't', sample_tiles(path), requests=200, threads=4, revalidate=.5)
+                self.assertEqual(res['requests'], 200)
+                self.assertEqual(set(res['status']), {200, 304})
+                self.assertGreater(server.cache.hits, 0)
+            finally:
+                server.shutdown()
+                server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve MBTiles as XYZ tiles, with TileJSON')
+    parser.add_argument('mbtiles', nargs='+')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--cache-mb', type=int, default=64)
+    parser.add_argument('--quiet', action='store_true')
+    parser.add_argument('--load-test', type=int, metavar='REQUESTS', default=0,
+                        help='serve in background, load test the first file, and exit')
+    parser.add_argument('--threads', type=int, default=8)
+    a = parser.parse_args()
+    if a.load_test:
+        server = serve(*a.mbtiles, host=a.host, port=a.port, cache_mb=a.cache_mb, background=True, log=None)
+        name = next(iter(server.paths))
+        print(load_test(f'http://{a.host}:{server.server_address[1]}', name, sample_tiles(server.paths[name]),
+                        a.load_test, a.threads))
+        server.shutdown()
+    else:
+        serve(*a.mbtiles, host=a.host, port=a.port, cache_mb=a.cache_mb, log=None if a.quiet else print)
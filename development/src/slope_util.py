@@ -0,0 +1,227 @@
+"""In-process slope of DTM GeoTIFFs, with the same Horn kernel and edge handling as `gdaldem slope`,
+   computed by block windows (plus a 1-pixel halo) on a pool of worker processes.
+
+   Tolerance vs. `gdaldem slope` (GDAL 3.x, degrees, Horn):
+   * Float32 output: at most 1e-4 degree (same formula in float64, only the evaluation order differs)
+   * Byte output (rounded half up, like `gdalwarp -ot Byte`): equal, or 1 off where the float
+     slope is within 1e-4 of a .5 boundary
+   Requires GDAL python bindings (`osgeo`) for the file I/O only.
+"""
+from collections import deque
+from multiprocessing import Pool
+import os
+from typing import Callable, Iterator
+from unittest import TestCase
+
+import numpy as np
+
+
+BYTE_NODATA = 255  # as `merge_slopes`
+FLOAT_NODATA = -9999.  # as gdaldem
+CREATION_OPTIONS = ['COMPRESS=ZSTD', 'PREDICTOR=2', 'ZSTD_LEVEL=3', 'TILED=YES',
+                    'BLOCKXSIZE=1024', 'BLOCKYSIZE=1024', 'BIGTIFF=YES', 'SPARSE_OK=TRUE']
+
+
+def _extrapolate(inner: np.ndarray, next_: np.ndarray):
+    """gdaldem -compute_edges `INTERPOL`: linear extrapolation, NaN (nodata) if either is"""
+    return 2 * inner - next_
+
+
+def pad_edges(a: np.ndarray, top=True, bottom=True, left=True, right=True, compute_edges=False):
+    """Add the missing halo rows / columns on the sides of the raster.
+       Without `compute_edges` they are NaN so the border pixels get nodata, like gdaldem."""
+    def pad_rows(a, first, last):
+        rows = [a]
+        if first:
+            rows.insert(0, _extrapolate(a[:1], a[1:2]) if compute_edges else np.full_like(a[:1], np.nan))
+        if last:
+            rows.append(_extrapolate(a[-1:], a[-2:-1]) if compute_edges else np.full_like(a[:1], np.nan))
+        return np.concatenate(rows, axis=0)
+    a = pad_rows(a, top, bottom)
+    return pad_rows(a.T, left, right).T
+
+
+def horn(padded: np.ndarray, ewres: float, nsres: float, scale=1., compute_edges=False) -> np.ndarray:
+    """Slope in degrees of the inner pixels of `padded` (float64, nodata as NaN), as `GDALSlopeHornAlg`.
+       A nodata center gives nodata; a nodata neighbour too, unless `compute_edges`
+       where it is replaced by the center value."""
+    h, w = padded.shape[0] - 2, padded.shape[1] - 2
+    c = padded[1:-1, 1:-1]
+    a, b, cc, d, f, g, hh, i = (padded[dy:dy + h, dx:dx + w]
+                                for dy, dx in ((0, 0), (0, 1), (0, 2), (1, 0), (1, 2), (2, 0), (2, 1), (2, 2)))
+    if compute_edges:
+        a, b, cc, d, f, g, hh, i = (np.where(np.isnan(n), c, n) for n in (a, b, cc, d, f, g, hh, i))
+    dx = ((a + d + d + g) - (cc + f + f + i)) / ewres
+    dy = ((g + hh + hh + i) - (a + b + b + cc)) / nsres
+    with np.errstate(invalid='ignore'):
+        slope = np.degrees(np.arctan(np.sqrt(dx * dx + dy * dy) / (8 * scale)))
+    slope[np.isnan(c)] = np.nan
+    return slope
+
+
+def to_float(dem: np.ndarray, nodata=None) -> np.ndarray:
+    a = dem.astype(np.float64)
+    if nodata is not None and not np.isnan(nodata):
+        a[dem == nodata] = np.nan
+    return a
+
+
+def quantize(slope: np.ndarray, byte=True) -> np.ndarray:
+    """NaN -> nodata; for Byte, round half up like GDAL's float to Byte conversion"""
+    if byte:
+        out = np.floor(slope + .5)
+        out[np.isnan(slope)] = BYTE_NODATA
+        return out.astype(np.uint8)
+    out = slope.astype(np.float32)
+    out[np.isnan(slope)] = FLOAT_NODATA
+    return out
+
+
+def slope_array(dem: np.ndarray, ewres: float, nsres: float, nodata=None, scale=1.,
+                compute_edges=False, byte=False) -> np.ndarray:
+    """Slope of a whole in-memory DTM, like `gdaldem slope [-compute_edges]`"""
+    padded = pad_edges(to_float(dem, nodata), compute_edges=compute_edges)
+    return quantize(horn(padded, ewres, nsres, scale, compute_edges), byte)
+
+
+def windows(width: int, height: int, block=1024) -> Iterator[tuple[int, int, int, int]]:
+    """(col, row, w, h) of the blocks covering the raster, row by row"""
+    for row in range(0, height, block):
+        for col in range(0, width, block):
+            yield col, row, min(block, width - col), min(block, height - row)
+
+
+def slope_window(read: Callable[[int, int, int, int], np.ndarray], width: int, height: int,
+                 win: tuple[int, int, int, int], ewres: float, nsres: float, nodata=None, scale=1.,
+                 compute_edges=False, byte=True) -> 'np.ndarray|None':
+    """Slope of one block window, reading it with its halo through `read(col, row, w, h)`.
+       :return: None if the block has no data"""
+    col, row, w, h = win
+    c0, r0 = max(col - 1, 0), max(row - 1, 0)
+    c1, r1 = min(col + w + 1, width), min(row + h + 1, height)
+    dem = to_float(read(c0, r0, c1 - c0, r1 - r0), nodata)
+    if np.isnan(dem).all():
+        return None
+    padded = pad_edges(dem, top=row == 0, bottom=row + h == height, left=col == 0, right=col + w == width,
+                       compute_edges=compute_edges)
+    return quantize(horn(padded, ewres, nsres, scale, compute_edges), byte)
+
+
+_worker_ds = None
+_worker_args = None
+
+def _init_slope_worker(src, band, kw):
+    global _worker_ds, _worker_args
+    from osgeo import gdal
+    gdal.UseExceptions()
+    _worker_ds = gdal.Open(src)
+    _worker_args = band, kw
+
+
+def _slope_block(win):
+    from osgeo import gdal
+    band, kw = _worker_args
+    b = _worker_ds.GetRasterBand(band)
+    if hasattr(b, 'GetDataCoverageStatus'):
+        status, _ = b.GetDataCoverageStatus(*win)
+        if status == gdal.GDAL_DATA_COVERAGE_STATUS_EMPTY:
+            return win, None
+    read = lambda c, r, w, h: b.ReadAsArray(c, r, w, h)
+    return win, slope_window(read, _worker_ds.RasterXSize, _worker_ds.RasterYSize, win, **kw)
+
+
+def slope_tif(src: str, dest: str, *, byte=True, scale=1., compute_edges=False, band=1,
+              block=1024, processes=os.cpu_count(), creation_options=CREATION_OPTIONS,
+              reuse=False, log=print) -> str:
+    """`gdaldem slope src dest` (degrees, Horn), in-process.
+       Blocks are computed on `processes` workers, each reading its own windows from `src`;
+       this process writes them. Sparse (see `GetDataCoverageStatus`) or all-nodata blocks
+       are skipped, so stay sparse in `dest`.
+       :param byte: output Byte slopes with nodata 255, ready for `merge_slopes`;
+          else Float32 with nodata -9999 like gdaldem
+       :param scale: ratio of vertical to horizontal units, eg 111120 for a lat/lng DTM in meters
+       :param block: window size, should be a multiple of the output tile size
+    """
+    from osgeo import gdal
+    gdal.UseExceptions()
+    if reuse and os.path.isfile(dest): log('Reuse', dest); return dest
+    ds = gdal.Open(src)
+    gt = ds.GetGeoTransform()
+    nodata = ds.GetRasterBand(band).GetNoDataValue()
+    width, height = ds.RasterXSize, ds.RasterYSize
+    kw = dict(ewres=gt[1], nsres=gt[5], nodata=nodata, scale=scale, compute_edges=compute_edges, byte=byte)
+    out = gdal.GetDriverByName('GTiff').Create(
+        dest, width, height, 1, gdal.GDT_Byte if byte else gdal.GDT_Float32, options=creation_options)
+    out.SetGeoTransform(gt)
+    out.SetProjection(ds.GetProjection())
+    outband = out.GetRasterBand(1)
+    outband.SetNoDataValue(BYTE_NODATA if byte else FLOAT_NODATA)
+    ds = None
+    log(f'slope {src} -> {dest}: {width}x{height} in {block}px blocks, {processes} processes')
+
+    n = skipped = 0
+    pool = Pool(processes, initializer=_init_slope_worker, initargs=(src, band, kw)) if processes > 1 else None
+    if not pool:
+        _init_slope_worker(src, band, kw)
+    inflight = deque()
+
+    def write_oldest():
+        win, arr = inflight.popleft().get() if pool else inflight.popleft()
+        if arr is None:
+            return 0
+        outband.WriteArray(arr, win[0], win[1])
+        return 1
+
+    try:
+        for win in windows(width, height, block):
+            inflight.append(pool.apply_async(_slope_block, (win,)) if pool else _slope_block(win))
+            if len(inflight) >= 2 * processes:
+                written = write_oldest()
+                n += written
+                skipped += 1 - written
+        while inflight:
+            written = write_oldest()
+            n += written
+            skipped += 1 - written
+    finally:
+        if pool:
+            pool.terminate()
+    out.FlushCache()
+    out = None
+    log(f'slope: {n} blocks written, {skipped} skipped (no data)')
+    return dest
+
+
+class TestSlope(TestCase):
+    def test_plane(self):
+        # z = x * tan(30°), 10m pixels: 30° everywhere but on the nodata border
+        x = np.arange(8) * 10.
+        dem = np.tile(x * np.tan(np.radians(30)), (6, 1))
+        s = slope_array(dem, 10, -10)
+        self.assertTrue(np.isclose(s[1:-1, 1:-1], 30, atol=1e-4).all())
+        self.assertTrue((s[0] == FLOAT_NODATA).all() and (s[:, -1] == FLOAT_NODATA).all())
+        self.assertTrue(np.isclose(slope_array(dem, 10, -10, compute_edges=True), 30, atol=1e-4).all())
+        self.assertTrue((slope_array(dem, 10, -10, byte=True)[1:-1, 1:-1] == 30).all())
+
+    def test_nodata(self):
+        dem = np.arange(25, dtype=np.float32).reshape(5, 5)
+        dem[2, 2] = -1
+        s = slope_array(dem, 1, -1, nodata=-1)
+        self.assertTrue((s[1:4, 1:4] == FLOAT_NODATA).all())
+        s = slope_array(dem, 1, -1, nodata=-1, compute_edges=True)
+        self.assertEqual(s[2, 2], FLOAT_NODATA)
+        self.assertTrue((s[1, 1:4] != FLOAT_NODATA).all())
+
+    def test_windows_seamless(self):
+        rng = np.random.default_rng(0)
+        dem = rng.normal(1000, 50, (37, 53)).astype(np.float32)
+        dem[:5, :7] = -9999
+        read = lambda c, r, w, h: dem[r:r + h, c:c + w]
+        for compute_edges in (False, True):
+            whole = slope_array(dem, 5, -5, nodata=-9999, compute_edges=compute_edges, byte=True)
+            tiled = np.full_like(whole, BYTE_NODATA)
+            for win in windows(53, 37, block=16):
+                arr = slope_window(read, 53, 37, win, 5, -5, nodata=-9999, compute_edges=compute_edges)
+                if arr is not None:
+                    tiled[win[1]:win[1] + win[3], win[0]:win[0] + win[2]] = arr
+            self.assertTrue((tiled == whole).all())
@@ -0,0 +1,280 @@
+"""Slope statistics straight from PNG8 slope tiles, without going back to the float GeoTIFFs:
+   area-weighted histograms of the slope classes of a `.clr` palette, per zoom and per region
+   (bbox or polygon), eg for `aoste-slopes-repartition.png`.
+
+   Tiles are decoded to palette indices on a process pool (whatever their own palette, see
+   `mosaic_util.IndexDecoder`) and streamed, so memory does not depend on the tile count.
+   Each pixel weighs its ground area, `(res * cos(lat))²` on the EPSG:3857 sphere, rounded to
+   integers of `AREA_UNIT`: histograms are integer sums, identical whatever the batches,
+   the worker count or the merge order.
+"""
+from collections import deque
+from multiprocessing import Pool
+import os
+import tempfile
+from typing import NamedTuple
+from unittest import TestCase
+
+import numpy as np
+
+from .mbt_util import LLBb, MBTiles, insert_tiles, zoom_extents
+from .mosaic_util import IndexDecoder, zoom_range, zoom_tiles
+from .palette_util import clr_path
+from .pmtiles_util import PMTiles
+from .png_util import optimize_png
+from .render_util import WHITE, WORLD, Colorizer, encode_png8
+from .tile_util import lnglat_pixels
+
+
+AREA_UNIT = 1e-4  # m²: a whole zoom level of the world still fits in int64
+
+
+def slope_classes(clr: str, nv=WHITE) -> tuple[np.ndarray, np.ndarray]:
+    """Palette (RGBA, n x 4) of the tiles `render_util.render_mbt` colors with `clr`, and the slope
+       range [lo, hi) (degrees, n x 2) of each palette index, (nan, nan) if it has no values
+       (eg the transparent index). With `nv` white, nodata pixels count in the white class."""
+    col = Colorizer(clr_path(clr), nv=nv)
+    v = col.clr.values
+    cuts = np.clip(np.concatenate([[-np.inf], (v[1:] + v[:-1]) / 2, [np.inf]]), 0, 90)
+    ranges = np.full((len(col.palette), 2), np.nan)
+    for i, p in enumerate(col.entry_index[:len(v)]):  # entries sharing a color share its class
+        ranges[p] = np.fmin(ranges[p, 0], cuts[i]), np.fmax(ranges[p, 1], cuts[i + 1])
+    return col.palette, ranges
+
+
+def row_areas(z: int, y: int, tile=256) -> np.ndarray:
+    """Ground area of a pixel of each row of XYZ tile row `y`, in `AREA_UNIT` (int64)"""
+    res = 2 * WORLD / tile / 2 ** z
+    py = y * tile + np.arange(tile) + .5
+    cos = 1 / np.cosh(np.pi * (1 - 2 * py / (tile << z)))  # cos(lat) of the row centers
+    return np.rint((res * cos) ** 2 / AREA_UNIT).astype(np.int64)
+
+
+# == Regions ==
+
+def _rings(region) -> list[np.ndarray]:
+    """(lng, lat) rings (n x 2) of a bbox, a ring, or a GeoJSON (Multi)Polygon geometry or feature"""
+    if isinstance(region, dict):
+        geom = region.get('geometry', region)
+        polygons = geom['coordinates'] if geom['type'] == 'MultiPolygon' else [geom['coordinates']]
+        return [np.asarray(ring, float)[:, :2] for polygon in polygons for ring in polygon]
+    if len(region) == 4 and np.isscalar(region[0]):
+        w, s, e, n = region
+        return [np.array([(w, s), (e, s), (e, n), (w, n)], float)]
+    return [np.asarray(region, float)[:, :2]]
+
+
+def region_bbox(region) -> LLBb:
+    lnglat = np.vstack(_rings(region))
+    return LLBb(*lnglat.min(axis=0), *lnglat.max(axis=0))
+
+
+class _PixelRegion(NamedTuple):
+    rings: list  # in global pixels
+    box: tuple  # x0, y0, x1, y1
+    is_box: bool
+
+
+def _pixel_region(region, z: int, tile: int) -> '_PixelRegion|None':
+    if region is None:
+        return None
+    rings = [lnglat_pixels(r, z, tile) for r in _rings(region)]
+    xy = np.vstack(rings)
+    is_box = not isinstance(region, dict) and len(region) == 4 and np.isscalar(region[0])
+    return _PixelRegion(rings, (*xy.min(axis=0), *xy.max(axis=0)), is_box)
+
+
+def _inside(rings: list, cx: np.ndarray, cy: np.ndarray, chunk=32) -> np.ndarray:
+    """Even-odd rule: (len(cy), len(cx)) mask of the points with an odd number of ring edges on
+       their left. Edges left of all the points only flip rows."""
+    a = np.vstack(rings)
+    b = np.vstack([np.roll(r, -1, axis=0) for r in rings])
+    crosses = (a[:, 1, None] > cy) != (b[:, 1, None] > cy)  # (edges, rows)
+    keep = crosses.any(axis=1) & (np.minimum(a[:, 0], b[:, 0]) < cx[-1])
+    a, b, crosses = a[keep], b[keep], crosses[keep]
+    dy = b[:, 1] - a[:, 1]
+    slope = (b[:, 0] - a[:, 0]) / np.where(dy, dy, 1)
+    xc = a[:, 0, None] + (cy - a[:, 1, None]) * slope[:, None]  # (edges, rows)
+    left = np.maximum(a[:, 0], b[:, 0]) < cx[0]
+    count = np.zeros((len(cy), len(cx)), np.int64)
+    count += crosses[left].sum(axis=0)[:, None]
+    crosses, xc = crosses[~left], xc[~left]
+    for i in range(0, len(xc), chunk):
+        count += (crosses[i:i + chunk, :, None] & (xc[i:i + chunk, :, None] < cx)).sum(axis=0)
+    return (count % 2).astype(bool)
+
+
+def _region_mask(region: '_PixelRegion|None', x: int, y: int, tile: int) -> 'np.ndarray|bool':
+    if region is None:
+        return True
+    bx0, by0, bx1, by1 = region.box
+    x0, y0 = x * tile, y * tile
+    if bx1 <= x0 or bx0 >= x0 + tile or by1 <= y0 or by0 >= y0 + tile:
+        return False
+    cx, cy = x0 + np.arange(tile) + .5, y0 + np.arange(tile) + .5
+    if region.is_box:
+        return ((cy >= by0) & (cy < by1))[:, None] & ((cx >= bx0) & (cx < bx1))
+    return _inside(region.rings, cx, cy)
+
+
+# == Parallel histograms ==
+
+_worker: dict = {}
+
+def _init_stats_worker(palette: np.ndarray, regions: list):
+    _worker.update(decode=IndexDecoder(palette), n=len(palette), regions=regions, pixel_regions={})
+
+
+def _stats_batch(z: int, rows: list[tuple[int, int, bytes]]) -> np.ndarray:
+    """-> (regions, 2, palette) int64: pixel counts and areas (`AREA_UNIT`) per palette index"""
+    regions, n = _worker['regions'], _worker['n']
+    out = np.zeros((len(regions), 2, 256), np.int64)
+    for x, y, data in rows:
+        idx, valid = _worker['decode'](data)
+        t = idx.shape[0]
+        if (z, t) not in _worker['pixel_regions']:
+            _worker['pixel_regions'][z, t] = [_pixel_region(r, z, t) for r in regions]
+        areas = row_areas(z, y, t)
+        keys = np.arange(t)[:, None] * 256 + idx
+        for r, region in enumerate(_worker['pixel_regions'][z, t]):
+            mask = _region_mask(region, x, y, t)
+            if mask is False:
+                continue
+            per_row = np.bincount(keys[valid & mask], minlength=t * 256).reshape(t, 256)
+            out[r, 0] += per_row.sum(axis=0)
+            out[r, 1] += areas @ per_row
+    return out[:, :, :n]
+
+
+class ClassStats(NamedTuple):
+    pixels: np.ndarray  # int64 per palette index
+    area: np.ndarray  # int64 per palette index, in AREA_UNIT
+
+    def km2(self) -> np.ndarray:
+        return self.area * (AREA_UNIT / 1e6)
+
+    def share(self) -> np.ndarray:
+        total = self.area.sum()
+        return self.area / total if total else self.area * 0.
+
+
+def merge_stats(*stats: dict) -> dict:
+    """Sum the `slope_stats` of disjoint sources (or tile subsets), exactly"""
+    out = {}
+    for s in stats:
+        for k, v in s.items():
+            out[k] = ClassStats(*(a + b for a, b in zip(out[k], v))) if k in out else v
+    return out
+
+
+def _zooms(source: str) -> list[int]:
+    if source.endswith('.pmtiles'):
+        with PMTiles(source) as pmt:
+            return list(range(pmt.header.min_zoom, pmt.header.max_zoom + 1))
+    with MBTiles(source, readonly=True) as mbt, mbt.batch() as dbc:
+        return [z for z, *_ in zoom_extents(dbc)]
+
+
+def slope_stats(source: str, clr: str, regions: dict = None, zooms=None, nv=WHITE,
+                processes=os.cpu_count(), batch=64, log=print) -> dict[tuple[int, str], ClassStats]:
+    """Area-weighted histograms of the slope classes (see `slope_classes`) of the PNG8 tiles of
+       `source` (MBTiles or PMTiles), rendered with `clr`. Transparent pixels are not counted.
+       :param regions: {name: region}, a region being None (all the tiles), a (w, s, e, n) bbox,
+          a (lng, lat) ring, or a GeoJSON Polygon / MultiPolygon geometry or feature.
+          Pixels count in a region if their center is inside (even-odd rule, with straight
+          edges in Web Mercator).
+       :param zooms: all the zooms of `source` by default
+       :return: {(z, region name): ClassStats}"""
+    source = os.path.expanduser(source)
+    regions = regions or {'all': None}
+    names, geoms = list(regions), list(regions.values())
+    palette, _ = slope_classes(clr, nv)
+    bbox = None
+    if all(g is not None for g in geoms):
+        boxes = np.array([region_bbox(g) for g in geoms])
+        bbox = LLBb(*boxes[:, :2].min(axis=0), *boxes[:, 2:].max(axis=0))
+    initargs = (palette, geoms)
+    pool = Pool(processes, _init_stats_worker, initargs) if processes > 1 else None
+    if not pool:
+        _init_stats_worker(*initargs)
+    out = {}
+    try:
+        for z in (_zooms(source) if zooms is None else zooms):
+            acc = np.zeros((len(geoms), 2, len(palette)), np.int64)
+            ext = zoom_range(source, z, bbox)
+            inflight, rows, n = deque(), [], 0
+            def submit():
+                inflight.append(pool.apply_async(_stats_batch, (z, rows)) if pool else _stats_batch(z, rows))
+                if len(inflight) >= 2 * processes:
+                    acc[:] += inflight.popleft().get() if pool else inflight.popleft()
+            for row in zoom_tiles(source, z, *ext) if ext else ():
+                rows.append(row)
+                n += 1
+                if len(rows) == batch:
+                    submit()
+                    rows = []
+            if rows:
+                submit()
+            while inflight:
+                acc[:] += inflight.popleft().get() if pool else inflight.popleft()
+            log(f'stats z{z}: {n} tiles')
+            out.update({(z, name): ClassStats(acc[r, 0], acc[r, 1]) for r, name in enumerate(names)})
+    finally:
+        if pool:
+            pool.terminate()
+        _worker.clear()
+    return out
+
+
+def stats_table(stats: dict, clr: str, nv=WHITE) -> str:
+    """One line per slope class of each (zoom, region): range, km² and share of the area"""
+    _, ranges = slope_classes(clr, nv)
+    lines = []
+    for (z, name), s in sorted(stats.items()):
+        lines.append(f'z{z} {name}: {s.km2().sum():.2f} km²')
+        for i in np.argsort(ranges[:, 0]):
+            if not np.isnan(ranges[i, 0]):
+                lo, hi = ranges[i]
+                lines.append(f'  {lo:4.1f}-{hi:4.1f}°  {s.km2()[i]:12.3f} km²  {100 * s.share()[i]:5.1f}%')
+    return '\n'.join(lines)
+
+
+class TestStats(TestCase):
+    def test_slope_stats(self):
+        z, t = 12, 32
+        col = Colorizer(clr_path('eslo13near'), nv=WHITE)
+        rng = np.random.default_rng(2)
+        slopes = {(x, y): rng.uniform(0, 60, (t, t)) for x, y in ((2120, 1465), (2121, 1465), (2121, 1466))}
+        with tempfile.TemporaryDirectory() as tmp:
+            with MBTiles(f'{tmp}/s.mbtiles', create=True) as m:
+                rows = []
+                for (x, y), v in slopes.items():
+                    idx = col(v)
+                    idx[:, 0] = col.transparent
+                    data = encode_png8(idx, col.palette)
+                    rows.append((z, x, (1 << z) - 1 - y, optimize_png(data) if x == 2121 else data))
+                insert_tiles(m, rows)
+            palette, ranges = slope_classes('eslo13near')
+            self.assertTrue((palette == col.palette).all())
+            self.assertEqual(tuple(ranges[col(np.array([25.]))[0]]), (24.5, 28.5))
+            n = 1 << z
+            lng = lambda x: x / n * 360 - 180
+            west = LLBb(lng(2120), -80, lng(2121), 80)
+            poly = {'type': 'Polygon', 'coordinates': [[(lng(2120), 0), (lng(2122), 0), (lng(2122), 80), (lng(2120), 0)]]}
+            regions = {'all': None, 'west': west, 'tri': poly}
+            stats = slope_stats(f'{tmp}/s.mbtiles', 'eslo13near', regions, processes=2, batch=1, log=lambda *a: None)
+            serial = slope_stats(f'{tmp}/s.mbtiles', 'eslo13near', regions, processes=1, log=lambda *a: None)
+            for k in stats:
+                self.assertTrue((stats[k].area == serial[k].area).all())
+            counts = sum(np.bincount(col(v)[:, 1:].ravel(), minlength=len(palette)) for v in slopes.values())
+            self.assertTrue((stats[z, 'all'].pixels == counts).all())
+            self.assertEqual(stats[z, 'west'].pixels.sum(), t * (t - 1))
+            self.assertTrue(0 < stats[z, 'tri'].pixels.sum() < 3 * t * (t - 1))
+            merged = merge_stats({k: v for k, v in stats.items() if k[1] == 'west'}, {(z, 'west'): stats[z, 'west']})
+            self.assertTrue((merged[z, 'west'].area == 2 * stats[z, 'west'].area).all())
+            # area of the whole first tile, at ~45.5°N
+            top, bottom = (np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * y / n)))) for y in (1465, 1466))
+            r = 6378137.
+            tile_m2 = r * r * np.radians(360 / n) * (np.sin(np.radians(top)) - np.sin(np.radians(bottom)))
+            self.assertAlmostEqual(stats[z, 'west'].area.sum() * AREA_UNIT / tile_m2, (t - 1) / t, 4)
+            self.assertIn('24.5-28.5°', stats_table(stats, 'eslo13near'))
@@ -0,0 +1,178 @@
+"""Web Mercator tile math on NumPy arrays: lng/lat to XYZ / TMS tiles and pixels, and back.
+
+   Same formulas, float operations and edge semantics as mercantile's scalar functions (incl.
+   its `EPSILON`, which counts points a hair left of a tile edge in the next tile, and the
+   clamping to the first / last tile), for a whole array at once. Tile and pixel indices are
+   identical; coordinates (eg tile bounds) are too for scalars, but may differ in the last bits
+   for arrays (1e-12° at most), as NumPy's vectorized log, exp, tan, atan and sinh are not libm's.
+   mercantile is only needed for `bbox.BBox.xyz_chunks`; its namedtuples are reused if installed.
+   One difference: latitudes of ±90°, which mercantile rejects, go to the first / last tile row.
+"""
+import math
+from typing import NamedTuple
+from unittest import TestCase
+
+import numpy as np
+
+try:
+    from mercantile import LngLat, LngLatBbox, Tile
+except ImportError:
+    class LngLat(NamedTuple):
+        lng: float
+        lat: float
+
+    class LngLatBbox(NamedTuple):
+        west: float
+        south: float
+        east: float
+        north: float
+
+    class Tile(NamedTuple):
+        x: int
+        y: int
+        z: int
+
+
+EPSILON = 1e-14  # as mercantile
+RE = 6378137.0
+CE = 2 * math.pi * RE
+R2D = 180 / math.pi
+MAX_LAT = 85.0511287798066
+
+
+def _libm(np_fun, math_fun):
+    """`np_fun`, or `math_fun` on scalars, to give mercantile's results to the last bit"""
+    return lambda a: math_fun(a) if np.ndim(a) == 0 else np_fun(a)
+
+_log, _tan, _exp = _libm(np.log, math.log), _libm(np.tan, math.tan), _libm(np.exp, math.exp)
+_atan, _sinh = _libm(np.arctan, math.atan), _libm(np.sinh, math.sinh)
+
+
+def fractions(lng, lat) -> tuple[np.ndarray, np.ndarray]:
+    """XYZ position in the world, in [0, 1] (y southward), like `mercantile._xy`"""
+    lng, lat = np.asarray(lng, float), np.asarray(lat, float)
+    sinlat = np.sin(np.radians(lat))
+    with np.errstate(divide='ignore'):
+        y = 0.5 - 0.25 * _log((1.0 + sinlat) / (1.0 - sinlat)) / math.pi
+    return lng / 360.0 + 0.5, y
+
+
+def _index(f: np.ndarray, n: float) -> np.ndarray:
+    """`floor(f * n)` like `mercantile.tile`, clamped to [0, n - 1]"""
+    return np.where(f <= 0, 0, np.where(f >= 1, n - 1, np.floor((f + EPSILON) * n))).astype(np.int64)
+
+
+def xyz_tiles(lng, lat, z: int) -> tuple[np.ndarray, np.ndarray]:
+    """XYZ x, y (int64) of the tiles containing the points, like `mercantile.tile`"""
+    fx, fy = fractions(lng, lat)
+    n = math.pow(2, z)
+    return _index(fx, n), _index(fy, n)
+
+
+def tms_tiles(lng, lat, z: int) -> tuple[np.ndarray, np.ndarray]:
+    """TMS (MBTiles) x, y of the tiles containing the points"""
+    x, y = xyz_tiles(lng, lat, z)
+    return x, (1 << z) - 1 - y
+
+
+def tile_pixels(lng, lat, z: int, tile=256) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """XYZ x, y of the tiles containing the points (as `xyz_tiles`), and the column / row of the
+       pixel containing them in the tile. `tile` must be a power of 2, so the scaling is exact."""
+    assert tile & (tile - 1) == 0, tile
+    fx, fy = fractions(lng, lat)
+    px, py = _index(fx, math.pow(2, z) * tile), _index(fy, math.pow(2, z) * tile)
+    return px // tile, py // tile, px % tile, py % tile
+
+
+def lnglat_pixels(lnglat: np.ndarray, z: int, tile=256) -> np.ndarray:
+    """Global (float) pixel coordinates (x east, y south, n x 2) of (lng, lat) points (n x 2)
+       at zoom `z`, latitudes clamped to the world's"""
+    fx, fy = fractions(lnglat[:, 0], np.clip(lnglat[:, 1], -MAX_LAT, MAX_LAT))
+    return np.column_stack([fx, fy]) * float(tile << z)
+
+
+def ul(x, y, z: int) -> tuple[np.ndarray, np.ndarray]:
+    """lng, lat of the upper left corner of XYZ tiles, like `mercantile.ul`.
+       Fractional x, y (eg `x + col / 256`) give the position of pixels."""
+    n = math.pow(2, z)
+    x, y = np.asarray(x, float), np.asarray(y, float)
+    return x / n * 360.0 - 180.0, np.degrees(_atan(_sinh(math.pi * (1 - 2 * y / n))))
+
+
+def xyz_bounds(x, y, z: int) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """west, south, east, north of XYZ tiles, like `mercantile.bounds`"""
+    x, y = np.asarray(x), np.asarray(y)
+    w, n = ul(x, y, z)
+    e, s = ul(x + 1, y + 1, z)
+    return w, s, e, n
+
+
+def tms_bounds(z, x, y) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """west, south, east, north of TMS tiles, through their EPSG:3857 bounds, like
+       `mercantile.lnglat(*mercantile.xy_bounds(...))` (which may differ from `xyz_bounds` by 1 ulp)"""
+    n = np.power(2.0, z)  # exact, and `z` may be an array too
+    size = CE / n
+    x, y = np.asarray(x, float), n - 1 - np.asarray(y, float)
+    left, top = x * size - CE / 2, CE / 2 - y * size
+    lng = lambda mx: mx * R2D / RE
+    lat = lambda my: ((math.pi * 0.5) - 2.0 * _atan(_exp(-my / RE))) * R2D
+    return lng(left), lat(top - size), lng(left + size), lat(top)
+
+
+def bbox_tms(z: int, w, s, e, n, epsilon=0.1**5) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """West, south, east, north TMS tile ranges of the tiles intersecting the bboxes (border
+       included), `epsilon` inside them, as `mbt_util.bbox2tms`"""
+    xw, ys = tms_tiles(np.asarray(w, float) + epsilon, np.asarray(s, float) + epsilon, z)
+    xe, yn = tms_tiles(np.asarray(e, float) - epsilon, np.asarray(n, float) - epsilon, z)
+    return xw, ys, xe, yn
+
+
+def xy(lng, lat) -> tuple[np.ndarray, np.ndarray]:
+    """EPSG:3857 meters, like `mercantile.xy` (±inf at the poles)"""
+    lng, lat = np.asarray(lng, float), np.asarray(lat, float)
+    with np.errstate(divide='ignore'):
+        y = RE * _log(_tan((math.pi * 0.25) + (0.5 * np.radians(lat))))
+    return RE * np.radians(lng), np.where(lat <= -90, -np.inf, np.where(lat >= 90, np.inf, y))
+
+
+class TestTile(TestCase):
+    def test_same_as_mercantile(self):
+        import mercantile as T
+        rng = np.random.default_rng(4)
+        n = 4000
+        zs = rng.integers(0, 23, n)
+        # random points, tile corners, and points a hair around them
+        cx, cy = (np.floor(rng.random(n) * 2. ** zs).astype(int) for _ in range(2))
+        clng, clat = (np.array(v) for v in zip(*map(T.ul, cx.tolist(), cy.tolist(), zs.tolist())))
+        lngs = np.concatenate([rng.uniform(-180, 180, n), clng, clng + 1e-12, clng - 1e-12,
+                               np.nextafter(clng, -180), [-180, 180, 0]])
+        lats = np.concatenate([rng.uniform(-MAX_LAT, MAX_LAT, n), clat, clat - 1e-12, clat + 1e-12,
+                               np.nextafter(clat, 90), [MAX_LAT, -MAX_LAT, 0]])
+        lats = np.clip(lats, -89.9, 89.9)
+        zs = np.concatenate([zs] * 5 + [[3, 3, 0]])
+        close = lambda ours, theirs: np.testing.assert_allclose(np.column_stack(ours), np.array(theirs), 1e-14, 1e-12)
+        for z in np.unique(zs).tolist():
+            on = zs == z
+            points = list(zip(lngs[on].tolist(), lats[on].tolist()))
+            tiles = [T.tile(lng, lat, z) for lng, lat in points]
+            x, y = xyz_tiles(lngs[on], lats[on], z)
+            self.assertTrue((x == [t.x for t in tiles]).all() and (y == [t.y for t in tiles]).all(), z)
+            tx, ty, px, py = tile_pixels(lngs[on], lats[on], z)
+            self.assertTrue((tx == x).all() and (ty == y).all())
+            self.assertTrue(((px >= 0) & (px < 256) & (py >= 0) & (py < 256)).all())
+            xt, yt = tms_tiles(lngs[on], lats[on], z)
+            self.assertTrue((xt == x).all() and (yt == (1 << z) - 1 - y).all())
+            close(ul(x, y, z), [T.ul(t) for t in tiles])
+            close(xyz_bounds(x, y, z), [T.bounds(t) for t in tiles])
+            close(tms_bounds(z, x, yt), [(*T.lnglat(b.left, b.bottom), *T.lnglat(b.right, b.top))
+                                       for b in map(T.xy_bounds, tiles)])
+            close(xy(lngs[on], lats[on]), [T.xy(*p) for p in points])
+            for (lng, lat), t in list(zip(points, tiles))[:20]:  # scalars: to the last bit
+                self.assertEqual(tuple(map(float, ul(t.x, t.y, z))), tuple(T.ul(t)))
+                self.assertEqual(tuple(map(float, xy(lng, lat))), T.xy(lng, lat))
+                b = T.xy_bounds(t)
+                self.assertEqual(tuple(map(float, tms_bounds(z, t.x, (1 << z) - 1 - t.y))),
+                                 (*T.lnglat(b.left, b.bottom), *T.lnglat(b.right, b.top)))
+        # the corner of a pixel is in that pixel
+        lng, lat = ul(tx + px / 256, ty + py / 256, z)
+        self.assertTrue(all((a == b).all() for a, b in zip(tile_pixels(lng, lat, z), (tx, ty, px, py))))